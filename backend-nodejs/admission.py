@@ -0,0 +1,387 @@
+"""
+Admission control for upstream generations
+
+At most `limit` generations hold an upstream slot at once. Further callers
+wait in a bounded queue for up to `max_wait` seconds; when the queue is
+full, or the wait runs out, they are refused with `Overloaded` and a
+Retry-After estimate instead of piling onto the upstream.
+
+The queue is split into priority lanes served strictly in order. Within a
+lane, users take turns (round-robin), each user's own requests stay FIFO,
+so one user scripting many previews cannot starve the others.
+
+The limit can be driven by an `AIMDController`: additive increase while
+latency and errors look healthy, multiplicative decrease on 429s,
+timeouts and latency spikes.
+
+Callers may carry a deadline. When the expected queue wait plus the recent
+p90 upstream latency no longer fits in what is left of it, the caller is
+refused with `DeadlineExceeded` before spending an upstream call.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Callable, NamedTuple, Optional, Sequence
+
+# Outcomes of one upstream call, as seen by the concurrency controller
+OK = "ok"
+THROTTLED = "throttled"
+TIMEOUT = "timeout"
+ERROR = "error"
+
+
+def classify_outcome(error: Optional[BaseException]) -> str:
+    """Map an upstream exception (or None) to a controller outcome"""
+    if error is None:
+        return OK
+    if isinstance(error, asyncio.TimeoutError):
+        return TIMEOUT
+    message = str(error).lower()
+    if "429" in message or "rate limit" in message or "too many requests" in message:
+        return THROTTLED
+    if "timeout" in message or "timed out" in message:
+        return TIMEOUT
+    return ERROR
+
+
+class AIMDController:
+    """
+    Additive-increase / multiplicative-decrease concurrency limit.
+
+    Every `limit` consecutive healthy completions made while the limit was
+    saturated (all slots busy or callers queued) raise the limit by one;
+    completions with spare slots say nothing about whether more would be
+    tolerated, so quiet traffic does not drift the limit up. A throttle,
+    timeout or latency spike (latency above `spike_factor` times the
+    healthy-latency baseline) multiplies it by `backoff`, at most once per
+    `cooldown` seconds. Plain errors (e.g. rejected prompts) do not move
+    the limit. Pure bookkeeping with an injectable clock, so it can be
+    driven by a scripted upstream.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, backoff: float = 0.5,
+                 spike_factor: float = 2.0, cooldown: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.spike_factor = spike_factor
+        self.cooldown = cooldown
+        self.clock = clock
+        self.baseline = None  # EWMA of healthy latency (seconds)
+        self._healthy_streak = 0
+        self._last_decrease = float('-inf')
+        self.increases = 0
+        self.decreases = 0
+
+    def record(self, latency: float, outcome: str, saturated: bool = True) -> int:
+        """Feed one completed upstream call; returns the new limit"""
+        spike = (
+            outcome == OK and self.baseline is not None
+            and latency > self.baseline * self.spike_factor
+        )
+        if outcome == OK:
+            # Spikes also feed the baseline so a lasting shift is absorbed
+            self.baseline = latency if self.baseline is None else 0.9 * self.baseline + 0.1 * latency
+        if outcome in (THROTTLED, TIMEOUT) or spike:
+            self._healthy_streak = 0
+            now = self.clock()
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                self.limit = max(self.minimum, int(self.limit * self.backoff))
+                self.decreases += 1
+            return self.limit
+        if outcome != OK or not saturated:
+            return self.limit
+        self._healthy_streak += 1
+        if self._healthy_streak >= self.limit and self.limit < self.maximum:
+            self._healthy_streak = 0
+            self.limit += 1
+            self.increases += 1
+        return self.limit
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "baseline_latency_seconds": round(self.baseline, 3) if self.baseline is not None else None,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+
+class Caller(NamedTuple):
+    """Who a generation is for, as forwarded by the calling service"""
+    priority: str = "standard"
+    user_id: str = ""
+    deadline: Optional[float] = None  # time.monotonic() by which the caller gives up
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+
+def percentile(samples: Sequence[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Overloaded(Exception):
+    """No upstream capacity; maps to an HTTP error with Retry-After"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Overloaded):
+    """The caller's remaining time cannot cover the work; maps to a 504"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message, 504, retry_after)
+
+
+class AdmissionController:
+    def __init__(self, limit: int, max_queue: int, max_wait: float,
+                 controller: Optional[AIMDController] = None,
+                 priorities: Sequence[str] = ("premium", "standard", "batch"),
+                 default_priority: str = "standard", deadline_margin: float = 2.0):
+        self.limit = controller.limit if controller else limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.controller = controller
+        self.priorities = tuple(priorities)
+        self.default_priority = default_priority
+        self.deadline_margin = deadline_margin  # seconds kept back for the rest of the response
+        self.in_flight = 0
+        # lane -> user -> FIFO of futures resolved when a slot is handed over
+        self._lanes = {name: OrderedDict() for name in self.priorities}
+        self._queue_depth = 0
+        self.avg_hold = 30.0  # EWMA of seconds a slot is held, seeds Retry-After
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.timed_out = 0
+        self.cancelled_waiting = 0  # caller went away while queued
+        self.cancelled_in_flight = 0  # upstream call abandoned mid-flight
+        self.refused_deadline = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._wait_samples = {name: deque(maxlen=1000) for name in self.priorities}
+        self._hold_samples = deque(maxlen=200)  # successful upstream calls only
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue_depth
+
+    def lane_for(self, priority: str) -> str:
+        return priority if priority in self._lanes else self.default_priority
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free for a new arrival"""
+        rounds = (self._queue_depth + 1) / max(self.limit, 1)
+        return max(1, math.ceil(self.avg_hold * rounds))
+
+    def expected_hold(self) -> float:
+        """Rolling p90 of successful upstream call durations"""
+        return percentile(self._hold_samples, 0.90) if self._hold_samples else self.avg_hold
+
+    def expected_wait(self) -> float:
+        """Rough time a new arrival spends queued for a slot"""
+        if self.in_flight < self.limit and not self._queue_depth:
+            return 0.0
+        return self.avg_hold * (self._queue_depth + 1) / max(self.limit, 1)
+
+    def check_deadline(self, caller: Caller, queued: bool = True):
+        """Refuse the caller if its deadline cannot cover the wait and the upstream call"""
+        remaining = caller.remaining()
+        if remaining is None:
+            return
+        needed = self.expected_hold() + self.deadline_margin + (self.expected_wait() if queued else 0.0)
+        if remaining < needed:
+            self.refused_deadline += 1
+            raise DeadlineExceeded(
+                f"Not enough time left for image generation ({remaining:.1f}s left, about {needed:.1f}s needed)",
+                self.retry_after()
+            )
+
+    def _pop_next(self) -> Optional[asyncio.Future]:
+        """Next waiter: highest lane first, then the user at the front of its rotation"""
+        for name in self.priorities:
+            lane = self._lanes[name]
+            while lane:
+                user, waiters = next(iter(lane.items()))
+                waiter = waiters.popleft()
+                self._queue_depth -= 1
+                if waiters:
+                    lane.move_to_end(user)
+                else:
+                    del lane[user]
+                if not waiter.done():
+                    return waiter
+        return None
+
+    def _remove(self, lane_name: str, user: str, waiter: asyncio.Future):
+        waiters = self._lanes[lane_name].get(user)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+            self._queue_depth -= 1
+        except ValueError:
+            return
+        if not waiters:
+            del self._lanes[lane_name][user]
+
+    def _wake_next(self):
+        while self._queue_depth and self.in_flight < self.limit:
+            waiter = self._pop_next()
+            if waiter is None:
+                break
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake_next()
+
+    async def _acquire(self, lane_name: str, user: str, deadline_budget: Optional[float] = None):
+        if self.in_flight < self.limit and not self._queue_depth:
+            self.in_flight += 1
+            return
+        if self._queue_depth >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise Overloaded("Image generation queue is full", 429, self.retry_after())
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._lanes[lane_name].setdefault(user, deque()).append(waiter)
+        self._queue_depth += 1
+        self.queued += 1
+        # Not wait_for: before 3.12 it can swallow a cancellation that races
+        # with the slot being handed over, and the caller would run anyway
+        max_wait = self.max_wait
+        if deadline_budget is not None and deadline_budget < max_wait:
+            max_wait = max(deadline_budget, 0.0)
+        timer = loop.call_later(max_wait, self._expire, waiter)
+        try:
+            await waiter
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # The slot was handed over just as we gave up; pass it on
+                self._release()
+            else:
+                waiter.cancel()
+                self._remove(lane_name, user, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                if max_wait < self.max_wait:
+                    self.refused_deadline += 1
+                    raise DeadlineExceeded("Deadline passed while waiting for image generation capacity", self.retry_after())
+                raise Overloaded("Timed out waiting for image generation capacity", 503, self.retry_after())
+            if isinstance(e, asyncio.CancelledError):
+                self.cancelled_waiting += 1
+            raise
+        finally:
+            timer.cancel()
+
+    @staticmethod
+    def _expire(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_exception(asyncio.TimeoutError())
+
+    @asynccontextmanager
+    async def slot(self, caller: Caller = Caller()):
+        """Hold one upstream slot for the duration of the block"""
+        lane_name = self.lane_for(caller.priority)
+        self.check_deadline(caller)
+        queued_at = time.monotonic()
+        remaining = caller.remaining()
+        # Stop waiting once the upstream call could no longer finish in time
+        budget = None if remaining is None else remaining - self.expected_hold() - self.deadline_margin
+        await self._acquire(lane_name, caller.user_id, budget)
+        started_at = time.monotonic()
+        wait = started_at - queued_at
+        self.admitted += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self._wait_samples[lane_name].append(wait)
+        if caller.deadline is not None:
+            try:
+                self.check_deadline(caller, queued=False)
+            except DeadlineExceeded:
+                self._release()
+                raise
+        async with self._held(started_at):
+            yield
+
+    def try_slot(self):
+        """
+        A slot only if one is free right now with nobody queued, else None;
+        for extra work such as hedges, which should never wait or push the
+        upstream past the limit. Enter the returned context right away.
+        """
+        if self.in_flight >= self.limit or self._queue_depth:
+            return None
+        self.in_flight += 1
+        self.admitted += 1
+        return self._held(time.monotonic())
+
+    @asynccontextmanager
+    async def _held(self, started_at: float):
+        """Release an acquired slot at the end of the block, feeding its outcome to the controller"""
+        outcome = OK
+        try:
+            yield
+        except asyncio.CancelledError:
+            outcome = None  # says nothing about upstream health
+            self.cancelled_in_flight += 1
+            raise
+        except BaseException as e:
+            outcome = classify_outcome(e)
+            raise
+        finally:
+            hold = time.monotonic() - started_at
+            self.avg_hold = 0.8 * self.avg_hold + 0.2 * hold
+            if outcome == OK:
+                self._hold_samples.append(hold)
+            if self.controller and outcome is not None:
+                saturated = self.in_flight >= self.limit or self._queue_depth > 0
+                self.limit = self.controller.record(hold, outcome, saturated)
+            self._release()
+
+    def stats(self) -> dict:
+        lanes = {}
+        for name in self.priorities:
+            samples = self._wait_samples[name]
+            lanes[name] = {
+                "queued": sum(len(w) for w in self._lanes[name].values()),
+                "users_waiting": len(self._lanes[name]),
+                "wait_p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+                "wait_p90_ms": round(percentile(samples, 0.90) * 1000, 2),
+                "wait_p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+            }
+        return {
+            "limit": self.limit,
+            "adaptive": self.controller.stats() if self.controller else None,
+            "in_flight": self.in_flight,
+            "queue_depth": self._queue_depth,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_queue_full,
+            "timed_out": self.timed_out,
+            "cancelled_waiting": self.cancelled_waiting,
+            "cancelled_in_flight": self.cancelled_in_flight,
+            "refused_deadline": self.refused_deadline,
+            "expected_hold_seconds": round(self.expected_hold(), 2),
+            "avg_wait_ms": round(self.wait_total / self.admitted * 1000, 2) if self.admitted else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 2),
+            "avg_hold_seconds": round(self.avg_hold, 2),
+            "lanes": lanes,
+        }
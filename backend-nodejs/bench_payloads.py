@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Payload benchmark: base64 JSON (/generate) vs multipart binary (/generate/binary)
+
+Builds the request and response bodies both endpoints would carry for a
+synthetic logo, user photo, design and composite, and measures for each
+direction the bytes on the wire, the time to get from body to raw image
+bytes and the peak Python heap allocated on the way (tracemalloc). The
+parsing is done with the same code the service and its clients use:
+pydantic + decode_base64_image for JSON, Starlette's form parser for
+multipart. No upstream call is made.
+
+The binary endpoint also stores its uploads as assets before it can look
+up the render cache, so its request rows include that step: once for a
+new upload (full normalize, the photo is a JPEG as from a phone) and once
+for a repeat, which is found by the digest of the raw bytes. The assets
+go to a temporary directory.
+
+    python bench_payloads.py --photo-size 2048 --iterations 20
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from PIL import Image
+from starlette.requests import Request
+
+os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="bench_payloads_"))
+
+from image_generator import (ImageRequest, ImageResponse, binary_response, decode_base64_image,  # noqa: E402
+                             decode_image_bytes, multipart_body, prepare_asset, store_asset)
+
+
+def synthetic_png(size: tuple, mode: str, fmt: str = "PNG") -> bytes:
+    """Gradient plus noise, so PNG compresses it about as badly as a photo"""
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 48)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.convert(mode).save(buffer, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+async def parse_form(body: bytes, content_type: str) -> dict:
+    """Body to {name: bytes or str} with Starlette's multipart parser"""
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    request = Request({"type": "http", "headers": [(b"content-type", content_type.encode("latin-1"))]}, receive)
+    parsed = {}
+    async with request.form() as form:
+        for name, value in form.multi_items():
+            parsed[name] = value if isinstance(value, str) else await value.read()
+    return parsed
+
+
+def json_request(logo: bytes, photo: bytes) -> tuple:
+    body = json.dumps({
+        "prompt": "linen summer shirt with a small chest logo",
+        "logo_base64": "data:image/png;base64," + base64.b64encode(logo).decode("utf-8"),
+        "user_photo_base64": "data:image/jpeg;base64," + base64.b64encode(photo).decode("utf-8"),
+    }).encode("utf-8")
+    return body, "application/json"
+
+
+def binary_request(logo: bytes, photo: bytes) -> tuple:
+    return multipart_body([
+        ("prompt", None, "text/plain", b"linen summer shirt with a small chest logo"),
+        ("logo", "logo.png", "image/png", logo),
+        ("user_photo", "user_photo.jpg", "image/jpeg", photo),
+    ])
+
+
+async def parse_json_request(body: bytes, content_type: str):
+    request = ImageRequest.model_validate(json.loads(body))
+    return decode_base64_image(request.logo_base64), decode_base64_image(request.user_photo_base64)
+
+
+async def parse_binary_request(body: bytes, content_type: str):
+    form = await parse_form(body, content_type)
+    return decode_image_bytes(form["logo"]), decode_image_bytes(form["user_photo"])
+
+
+async def store_new_binary_request(body: bytes, content_type: str):
+    """Parse plus what store_asset does for uploads it has not seen (inline, without the pool hop)"""
+    form = await parse_form(body, content_type)
+    return prepare_asset(form["logo"], "logo"), prepare_asset(form["user_photo"], "user_photo")
+
+
+async def store_repeat_binary_request(body: bytes, content_type: str):
+    form = await parse_form(body, content_type)
+    return await store_asset(form["logo"], "logo"), await store_asset(form["user_photo"], "user_photo")
+
+
+def image_response(design: bytes, composite: bytes) -> ImageResponse:
+    # The pipeline hands both endpoints an ImageResponse
+    return ImageResponse(
+        success=True,
+        image_base64=base64.b64encode(design).decode("utf-8"),
+        composite_image_base64=base64.b64encode(composite).decode("utf-8"),
+        image_media_type="image/png",
+        composite_media_type="image/png",
+        revised_prompt="linen summer shirt with a small chest logo",
+        render_id="0" * 32,
+    )
+
+
+async def encode_json_response(response: ImageResponse):
+    return json.dumps(response.model_dump()).encode("utf-8"), "application/json"
+
+
+async def encode_binary_response(response: ImageResponse):
+    encoded = binary_response(response)
+    return encoded.body, encoded.headers["content-type"]
+
+
+async def parse_json_response(body: bytes, content_type: str):
+    data = json.loads(body)
+    return base64.b64decode(data["image_base64"]), base64.b64decode(data["composite_image_base64"])
+
+
+async def parse_binary_response(body: bytes, content_type: str):
+    form = await parse_form(body, content_type)
+    return form["design"], form["composite"]
+
+
+async def measure(fn, *args, iterations: int) -> dict:
+    """Median/p90 wall time and the peak traced allocation of one call"""
+    await fn(*args)  # warm up
+    times = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await fn(*args)
+        times.append((time.perf_counter() - started) * 1000)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    await fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times.sort()
+    return {
+        "median_ms": round(statistics.median(times), 2),
+        "p90_ms": round(times[int(len(times) * 0.9) - 1], 2),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--logo-size", type=int, default=1024)
+    parser.add_argument("--photo-size", type=int, default=2048)
+    parser.add_argument("--design-size", type=int, default=1024)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    logo = synthetic_png((args.logo_size, args.logo_size), "RGBA")
+    photo = synthetic_png((args.photo_size * 3 // 4, args.photo_size), "RGB", "JPEG")
+    design = synthetic_png((args.design_size, args.design_size), "RGB")
+    composite = synthetic_png((args.design_size * 7 // 4, args.design_size), "RGB")
+    print(f"images: logo {len(logo) // 1024} KB, photo {len(photo) // 1024} KB, "
+          f"design {len(design) // 1024} KB, composite {len(composite) // 1024} KB")
+
+    response = image_response(design, composite)
+    rows = []
+    for name, build, parse in (("json", json_request, parse_json_request),
+                               ("binary", binary_request, parse_binary_request)):
+        body, content_type = build(logo, photo)
+        rows.append((f"request/{name}", len(body),
+                     await measure(parse, body, content_type, iterations=args.iterations), "server parse"))
+    body, content_type = binary_request(logo, photo)
+    rows.append(("request/binary", len(body),
+                 await measure(store_new_binary_request, body, content_type, iterations=max(3, args.iterations // 4)),
+                 "+ store (new)"))
+    rows.append(("request/binary", len(body),
+                 await measure(store_repeat_binary_request, body, content_type, iterations=args.iterations),
+                 "+ store (rep.)"))
+    for name, encode, parse in (("json", encode_json_response, parse_json_response),
+                                ("binary", encode_binary_response, parse_binary_response)):
+        body, content_type = await encode(response)
+        rows.append((f"response/{name}", len(body),
+                     await measure(encode, response, iterations=args.iterations), "server encode"))
+        rows.append((f"response/{name}", len(body),
+                     await measure(parse, body, content_type, iterations=args.iterations), "client parse"))
+
+    print(f"{'payload':<18}{'step':<15}{'bytes':>12}{'median ms':>11}{'p90 ms':>9}{'peak KB':>11}")
+    for payload, size, result, step in rows:
+        print(f"{payload:<18}{step:<15}{size:>12}{result['median_ms']:>11}{result['p90_ms']:>9}{result['peak_kb']:>11}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Transport benchmark: loopback TCP vs Unix domain socket for the Node -> Python hop
+
+Starts an echo server in a subprocess on the same stack the image service
+uses (uvicorn on sockets from listeners.py), listening on both TCP and a
+Unix socket. Then for each payload size it measures:
+
+- round-trip latency of sequential requests (the body goes up and comes
+  back, as a preview request and its images do)
+- throughput with several concurrent requests
+
+    python bench_transport.py --sizes 64K,1M,4M,8M --requests 50 --concurrency 8
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+
+async def echo_app(scope, receive, send):
+    if scope["type"] != "http":
+        return
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body = b"".join(chunks)
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"application/octet-stream"),
+                            (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def serve(port: int, uds_path: str):
+    import uvicorn
+    from listeners import Listeners
+    listeners = Listeners("127.0.0.1", port, uds_path)
+    try:
+        uvicorn.Server(uvicorn.Config(echo_app, log_level="warning", lifespan="off")).run(sockets=listeners.sockets)
+    finally:
+        listeners.close()
+
+
+def parse_size(text: str) -> int:
+    units = {"K": 1024, "M": 1024 * 1024}
+    return int(text[:-1]) * units[text[-1].upper()] if text[-1].upper() in units else int(text)
+
+
+async def wait_ready(clients: dict, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    for client in clients.values():
+        while True:
+            try:
+                await client.post("/", content=b"ping")
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def latency(client: httpx.AsyncClient, payload: bytes, requests: int) -> list:
+    times = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = await client.post("/", content=payload)
+        times.append((time.perf_counter() - started) * 1000)
+        assert len(response.content) == len(payload)
+    return sorted(times)
+
+
+async def throughput(client: httpx.AsyncClient, payload: bytes, requests: int, concurrency: int) -> float:
+    """MB/s moved (both directions) by `concurrency` workers sending `requests` in total"""
+    remaining = [requests]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            await client.post("/", content=payload)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return 2 * len(payload) * requests / (time.perf_counter() - started) / (1024 * 1024)
+
+
+async def run(args, port: int, uds_path: str):
+    limits = httpx.Limits(max_connections=args.concurrency)
+    clients = {
+        "tcp": httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60),
+        "uds": httpx.AsyncClient(base_url="http://localhost", limits=limits, timeout=60,
+                                 transport=httpx.AsyncHTTPTransport(uds=uds_path, limits=limits)),
+    }
+    try:
+        await wait_ready(clients)
+        print(f"{'size':>8}{'transport':>11}{'p50 ms':>10}{'p99 ms':>10}{'MB/s':>10}")
+        for size in [parse_size(s) for s in args.sizes.split(",")]:
+            payload = os.urandom(size)
+            for name, client in clients.items():
+                await latency(client, payload, 3)  # warm up connections
+                times = await latency(client, payload, args.requests)
+                rate = await throughput(client, payload, args.requests, args.concurrency)
+                p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+                print(f"{size // 1024:>7}K{name:>11}{statistics.median(times):>10.2f}{p99:>10.2f}{rate:>10.1f}")
+    finally:
+        for client in clients.values():
+            await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="64K,1M,4M,8M")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=18002)
+    parser.add_argument("--serve", metavar="UDS_PATH", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.port, args.serve)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        uds_path = os.path.join(directory, "bench.sock")
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--port", str(args.port), "--serve", uds_path])
+        try:
+            asyncio.run(run(args, args.port, uds_path))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
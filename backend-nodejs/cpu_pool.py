@@ -0,0 +1,117 @@
+"""
+Bounded executor for CPU-bound Pillow work
+
+Keeps decoding, blending, compositing and PNG encoding off the event loop
+so /health and other requests stay responsive while images are processed.
+Either a thread pool (Pillow releases the GIL for most heavy operations) or
+a fork-based process pool can be selected. Each named stage records how
+long jobs waited in the queue and how long they ran.
+"""
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+
+
+def _timed_call(fn: Callable, args: tuple):
+    """Run fn in the worker, reporting when it actually started"""
+    started_at = time.monotonic()
+    return started_at, fn(*args)
+
+
+class StageStats:
+    __slots__ = ("submitted", "completed", "failed", "cancelled", "shed", "pending",
+                 "wait_total", "wait_max", "run_total", "run_max")
+
+    def __init__(self):
+        self.submitted = self.completed = self.failed = self.cancelled = self.shed = self.pending = 0
+        self.wait_total = self.wait_max = self.run_total = self.run_max = 0.0
+
+    def as_dict(self) -> dict:
+        done = self.completed
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,  # caller went away; dropped if not yet started
+            "shed": self.shed,  # skipped for lack of time
+            "pending": self.pending,  # queued or running
+            "avg_wait_ms": round(self.wait_total / done * 1000, 2) if done else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 2),
+            "avg_run_ms": round(self.run_total / done * 1000, 2) if done else 0.0,
+            "max_run_ms": round(self.run_max * 1000, 2),
+        }
+
+
+class CpuPool:
+    def __init__(self, kind: str = "thread", max_workers: int = 4):
+        if kind == "process":
+            # fork keeps module state (caches, config) without re-importing the app
+            self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+        elif kind == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pillow")
+        else:
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.stages = {}
+
+    def warm(self):
+        """
+        Fork the worker processes now. A fork copies only the calling thread,
+        so forking on the first submit, once other threads exist, can leave a
+        child holding a lock no thread will release; call this at startup,
+        after the app module has loaded and before any threads are started.
+        """
+        if self.kind == "process":
+            # A fork-context pool starts all of its workers on the first submit
+            self.executor.submit(time.monotonic).result()
+
+    async def run(self, stage: str, fn: Callable, *args):
+        """Run fn(*args) in the pool; in process mode fn, args and result must pickle"""
+        stats = self.stages.setdefault(stage, StageStats())
+        stats.submitted += 1
+        stats.pending += 1
+        submitted_at = time.monotonic()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, _timed_call, fn, args)
+        try:
+            started_at, result = await future
+        except asyncio.CancelledError:
+            stats.pending -= 1
+            stats.cancelled += 1
+            raise
+        except BaseException:
+            stats.pending -= 1
+            stats.failed += 1
+            raise
+        finished_at = time.monotonic()
+        wait, run = max(started_at - submitted_at, 0.0), finished_at - started_at
+        stats.pending -= 1
+        stats.completed += 1
+        stats.wait_total += wait
+        stats.wait_max = max(stats.wait_max, wait)
+        stats.run_total += run
+        stats.run_max = max(stats.run_max, run)
+        return result
+
+    def expected_seconds(self, stage: str, default: float) -> float:
+        """Average queue wait plus run time of the stage so far"""
+        stats = self.stages.get(stage)
+        if stats is None or not stats.completed:
+            return default
+        return (stats.wait_total + stats.run_total) / stats.completed
+
+    def shed(self, stage: str):
+        """Record that the stage was skipped instead of run"""
+        self.stages.setdefault(stage, StageStats()).shed += 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "stages": {name: stats.as_dict() for name, stats in self.stages.items()},
+        }
@@ -0,0 +1,57 @@
+"""
+Stop handling a request once its client has gone away
+
+FastAPI keeps running a handler after the caller disconnects (the Node
+side timed out, the browser tab closed). `DisconnectGuard.run` races the
+handler against the ASGI `http.disconnect` message and cancels the
+handler when it arrives, so coalesced work nobody waits for any more can
+be cancelled too (see SingleFlight's `cancel_abandoned`).
+"""
+import asyncio
+from typing import Awaitable
+
+
+class ClientDisconnected(Exception):
+    """The client disconnected before the response was ready"""
+
+
+class DisconnectGuard:
+    def __init__(self):
+        self.guarded = 0
+        self.disconnects = 0
+
+    @staticmethod
+    async def _wait_for_disconnect(http_request):
+        # The body has been read already, so the next message is the disconnect
+        while True:
+            message = await http_request.receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    async def run(self, http_request, work: Awaitable):
+        """Await work, cancelling it (ClientDisconnected) if the client leaves first"""
+        self.guarded += 1
+        task = asyncio.ensure_future(work)
+        watcher = asyncio.ensure_future(self._wait_for_disconnect(http_request))
+        try:
+            await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+        if not task.done():
+            self.disconnects += 1
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+            raise ClientDisconnected()
+        return task.result()
+
+    def stats(self) -> dict:
+        return {
+            "guarded": self.guarded,
+            "disconnects": self.disconnects,
+        }
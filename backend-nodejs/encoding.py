@@ -0,0 +1,152 @@
+"""
+Output image encoding: PNG, JPEG, WebP or AVIF
+
+The design and the composite are encoded separately, each with its own
+default format, which a caller can override (an explicit format, or a
+choice from its Accept header). Encoder parameters come from the
+`OutputEncoder` configuration:
+
+- lossy quality per format
+- WebP method
+- AVIF speed
+- PNG compress_level/optimize
+
+`encode` is pure, so it can run in the CPU pool (threads or forked
+processes). The event loop then records each result with `record`, which
+keeps per-format encode time and byte counts for /metrics.
+"""
+import io
+import time
+from typing import NamedTuple, Optional
+
+from PIL import Image, features
+
+MEDIA_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+_ALIASES = {"jpg": "jpeg", "image/jpg": "jpeg"}
+_ALIASES.update({media_type: fmt for fmt, media_type in MEDIA_TYPES.items()})
+
+
+class Encoded(NamedTuple):
+    data: bytes
+    format: str  # png, jpeg, webp, avif
+    encode_ms: float
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+
+class FormatStats:
+    __slots__ = ("images", "bytes", "encode_total", "encode_max")
+
+    def __init__(self):
+        self.images = self.bytes = 0
+        self.encode_total = self.encode_max = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "images": self.images,
+            "bytes": self.bytes,
+            "avg_bytes": self.bytes // self.images if self.images else 0,
+            "avg_encode_ms": round(self.encode_total / self.images, 2) if self.images else 0.0,
+            "max_encode_ms": round(self.encode_max, 2),
+        }
+
+
+class OutputEncoder:
+    def __init__(self, quality: Optional[dict] = None, webp_method: int = 4, avif_speed: int = 8,
+                 png_compress_level: int = 6, png_optimize: bool = False):
+        self.quality = {"jpeg": 85, "webp": 85, "avif": 70}
+        self.quality.update(quality or {})
+        self.webp_method = webp_method
+        self.avif_speed = avif_speed
+        self.png_compress_level = png_compress_level
+        self.png_optimize = png_optimize
+        # Pillow may be built without some codecs
+        self.available = [fmt for fmt, feature in (("png", "zlib"), ("jpeg", "jpg"), ("webp", "webp"), ("avif", "avif"))
+                          if features.check(feature)]
+        self._stats = {}
+
+    def resolve(self, requested: Optional[str], default: str) -> str:
+        """Normalize a requested format name or media type; ValueError if it cannot be produced"""
+        if not requested:
+            return default
+        fmt = requested.strip().lower()
+        fmt = _ALIASES.get(fmt, fmt)
+        if fmt not in MEDIA_TYPES:
+            raise ValueError(f"Unknown output format: {requested}")
+        if fmt not in self.available:
+            raise ValueError(f"Output format not supported by this server: {fmt}")
+        return fmt
+
+    def negotiate(self, accept: Optional[str], default: str, preference: tuple = ("avif", "webp", "jpeg", "png")) -> str:
+        """
+        Pick a format from an Accept header: the default when it is acceptable
+        or the header names no image types, else the first preferred one the
+        client takes.
+        """
+        accepted = set()
+        for item in (accept or "").split(","):
+            media_type, *params = [part.strip() for part in item.split(";")]
+            q = 1.0
+            for param in params:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q > 0:
+                accepted.add(media_type.lower())
+        if not any(media_type.startswith("image/") for media_type in accepted) or \
+                MEDIA_TYPES[default] in accepted or "image/*" in accepted:
+            return default
+        for fmt in preference:
+            if fmt in self.available and MEDIA_TYPES[fmt] in accepted:
+                return fmt
+        return default
+
+    def encode(self, image: Image.Image, fmt: str, quality: Optional[int] = None) -> Encoded:
+        """Encode `image` as `fmt`; `quality` overrides the configured lossy quality"""
+        started = time.perf_counter()
+        params = {}
+        if fmt == "png":
+            params = {"compress_level": self.png_compress_level, "optimize": self.png_optimize}
+        else:
+            params["quality"] = quality or self.quality[fmt]
+            if fmt == "webp":
+                params["method"] = self.webp_method
+            elif fmt == "avif":
+                params["speed"] = self.avif_speed
+            if fmt == "jpeg" and image.mode != "RGB":
+                # No alpha in JPEG
+                image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt.upper(), **params)
+        return Encoded(buffer.getvalue(), fmt, (time.perf_counter() - started) * 1000)
+
+    def record(self, encoded: Optional[Encoded]):
+        if encoded is None:
+            return
+        stats = self._stats.setdefault(encoded.format, FormatStats())
+        stats.images += 1
+        stats.bytes += len(encoded.data)
+        stats.encode_total += encoded.encode_ms
+        stats.encode_max = max(stats.encode_max, encoded.encode_ms)
+
+    def stats(self) -> dict:
+        return {
+            "available": self.available,
+            "quality": self.quality,
+            "webp_method": self.webp_method,
+            "avif_speed": self.avif_speed,
+            "png_compress_level": self.png_compress_level,
+            "png_optimize": self.png_optimize,
+            "formats": {fmt: stats.as_dict() for fmt, stats in self._stats.items()},
+        }
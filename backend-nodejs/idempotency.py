@@ -0,0 +1,104 @@
+"""
+Idempotency-Key handling for /generate
+
+The first request with a key starts the work; repeats within the TTL either
+attach to the still-running task or get the stored response back. Only
+responses accepted by `keep` are stored, so failed attempts can be retried.
+Stored responses are bounded by TTL and by total size. A caller that
+stops waiting (its client disconnected) leaves the task running: sending
+a key means the caller will retry, and the retry should find the result.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used with a different request body"""
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "task", "expires_at", "size")
+
+    def __init__(self, fingerprint: str, task: asyncio.Task, expires_at: float):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.expires_at = expires_at
+        self.size = 0
+
+
+class IdempotencyStore:
+    def __init__(self, ttl: float, max_bytes: int, sizeof: Callable[[object], int],
+                 keep: Callable[[object], bool] = lambda result: True):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.keep = keep
+        self.current_bytes = 0
+        self._entries = OrderedDict()  # key -> _Entry, oldest first
+        self.started = 0
+        self.replayed = 0
+        self.attached = 0
+        self.conflicts = 0
+        self.evictions = 0
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry.size
+
+    def _purge(self):
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e.expires_at <= now]:
+            self._drop(key)
+        # Over budget: evict the oldest finished responses
+        for key in list(self._entries):
+            if self.current_bytes <= self.max_bytes:
+                break
+            if self._entries[key].task.done():
+                self._drop(key)
+                self.evictions += 1
+
+    def _finished(self, key: str, entry: _Entry):
+        if self._entries.get(key) is not entry:
+            return
+        task = entry.task
+        if task.cancelled() or task.exception() is not None or not self.keep(task.result()):
+            self._drop(key)
+            return
+        entry.size = self.sizeof(task.result())
+        self.current_bytes += entry.size
+        self._purge()
+
+    async def run(self, key: str, fingerprint: str, fn: Callable[[], Awaitable]):
+        """Run fn() once per key; repeats replay or attach to the first call"""
+        self._purge()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflict("Idempotency-Key was already used with a different request")
+            if entry.task.done():
+                self.replayed += 1
+                return entry.task.result()
+            self.attached += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            entry = _Entry(fingerprint, task, time.monotonic() + self.ttl)
+            self._entries[key] = entry
+            task.add_done_callback(lambda _: self._finished(key, entry))
+            self.started += 1
+        # Shielded: a waiter being cancelled never cancels the work
+        return await asyncio.shield(entry.task)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "started": self.started,
+            "replayed": self.replayed,
+            "attached": self.attached,
+            "conflicts": self.conflicts,
+            "evictions": self.evictions,
+        }
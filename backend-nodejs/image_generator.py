@@ -4,17 +4,291 @@ AI Image Generation Service with Logo and User Photo Composition
 """
 import os
 import base64
+import hashlib
 import io
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+from fastapi import FastAPI, File, Form, Header, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional, Union
 from dotenv import load_dotenv
-from PIL import Image
+from PIL import Image, ImageOps
+
+from admission import AdmissionController, AIMDController, Caller, DeadlineExceeded, Overloaded
+from cpu_pool import CpuPool
+from disconnect import ClientDisconnected, DisconnectGuard
+from encoding import Encoded, OutputEncoder
+from idempotency import IdempotencyConflict, IdempotencyStore
+from job_queue import DurableJobQueue
+from jobs import BLENDING, COMPOSITING, GENERATING, QUEUED, JobStore, report_stage
+from listeners import UNIX_PEER, peer_host
+from peer_cache import PeerPool
+from prompt_canon import canonicalize_text
+from rate_limit import LocalBucketStore, RateLimiter, RedisBucketStore, client_identity
+from resilience import CircuitBreaker, ResilientUpstream, RetryBudget
+from render_cache import LogoCache, RejectionCache, ResultCache, TTLCache, digest_payload, make_cache_key
+from similar_index import SimilarPromptIndex
+from singleflight import SingleFlight
+from upstream import UpstreamClient
 
 # Load environment variables
 load_dotenv()
 
+IMAGE_MODEL = "gpt-image-1"
+
+# Render result cache (memory LRU + disk tier), sizes in MB
+CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.image_cache'))
+RENDER_CACHE_ENABLED = os.environ.get('RENDER_CACHE_ENABLED', '1') == '1'
+RENDER_CACHE_MEMORY_MB = int(os.environ.get('RENDER_CACHE_MEMORY_MB', '256'))
+RENDER_CACHE_DISK_MB = int(os.environ.get('RENDER_CACHE_DISK_MB', '2048'))
+
+render_cache = ResultCache(
+    memory_max_bytes=RENDER_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_dir=os.path.join(CACHE_DIR, 'renders'),
+    disk_max_bytes=RENDER_CACHE_DISK_MB * 1024 * 1024,
+) if RENDER_CACHE_ENABLED else None
+
+# Decoded/resized logo cache, bounded by decoded pixel bytes
+LOGO_CACHE_MB = int(os.environ.get('LOGO_CACHE_MB', '64'))
+logo_cache = LogoCache(LOGO_CACHE_MB * 1024 * 1024) if LOGO_CACHE_MB > 0 else None
+
+# Registered logos/user photos, stored normalized under their content hash
+ASSET_STORE_MEMORY_MB = int(os.environ.get('ASSET_STORE_MEMORY_MB', '64'))
+ASSET_STORE_DISK_MB = int(os.environ.get('ASSET_STORE_DISK_MB', '4096'))
+ASSET_MAX_DIMENSION = int(os.environ.get('ASSET_MAX_DIMENSION', '2048'))
+asset_store = ResultCache(
+    memory_max_bytes=ASSET_STORE_MEMORY_MB * 1024 * 1024,
+    disk_dir=os.path.join(CACHE_DIR, 'assets'),
+    disk_max_bytes=ASSET_STORE_DISK_MB * 1024 * 1024,
+)
+# Normalizing a photo means a full decode and PNG re-encode: at level 6 a
+# 1536x2048 photo takes ~2.7s, at level 1 ~0.5s for ~10% more bytes.
+# Uploads that are already normalized PNGs are stored as they are, and a
+# digest of the raw upload maps repeats (the same photo sent with every
+# preview) straight to their asset for ASSET_ALIAS_TTL seconds.
+ASSET_PNG_COMPRESS_LEVEL = int(os.environ.get('ASSET_PNG_COMPRESS_LEVEL', '1'))
+asset_aliases = TTLCache(
+    float(os.environ.get('ASSET_ALIAS_TTL', '86400')),
+    int(os.environ.get('ASSET_ALIAS_MAX_ENTRIES', '10000')),
+)
+
+# Un-logoed upstream images kept per render ID for /renders/{id}/reblend,
+# with the logo, its position and the user photo (asset IDs or inline
+# payloads) they were rendered with. Bounded by entries and by the bytes of
+# the images and inline payloads (MB).
+BASE_RENDER_TTL = float(os.environ.get('BASE_RENDER_TTL', '3600'))
+BASE_RENDER_MAX_ENTRIES = int(os.environ.get('BASE_RENDER_MAX_ENTRIES', '200'))
+BASE_RENDER_MAX_MB = int(os.environ.get('BASE_RENDER_MAX_MB', '256'))
+base_renders = TTLCache(
+    BASE_RENDER_TTL,
+    BASE_RENDER_MAX_ENTRIES,
+    max_bytes=BASE_RENDER_MAX_MB * 1024 * 1024,
+    sizeof=lambda base: len(base[0]) + sum(len(value) for value in base[2].values() if value),
+)
+
+# Near-duplicate prompt index over cached renders. POST /similar suggests a
+# past design; a request carrying its similar_render_key gets that design
+# instead of a new render. Designs are never substituted unasked: wording
+# scores cannot tell "red" from "blue", or front from back placement.
+SIMILAR_INDEX_ENABLED = os.environ.get('SIMILAR_INDEX_ENABLED', '1') == '1'
+SIMILAR_THRESHOLD = float(os.environ.get('SIMILAR_THRESHOLD', '0.8'))
+similar_index = SimilarPromptIndex(
+    path=os.path.join(CACHE_DIR, 'similar_index.jsonl'),
+    threshold=SIMILAR_THRESHOLD,
+) if SIMILAR_INDEX_ENABLED and render_cache else None
+
+# Fail fast on prompts the upstream recently rejected (seconds, 0 disables)
+REJECTION_CACHE_TTL = float(os.environ.get('REJECTION_CACHE_TTL', '600'))
+rejection_cache = RejectionCache(REJECTION_CACHE_TTL) if REJECTION_CACHE_TTL > 0 else None
+
+# Markers of a prompt refused by the upstream rather than a transient failure.
+# Not "invalid_request_error": OpenAI also uses it for a bad API key (401)
+# or an unknown model (404), which are not the prompt's fault.
+UPSTREAM_REJECTION_MARKERS = (
+    "content_policy", "content policy", "safety system", "moderation",
+)
+
+# Cancel work for /generate callers that disconnect; shared work is cancelled
+# once no caller waits for it. CANCEL_ON_DISCONNECT=0 lets it finish and
+# land in the caches instead. Work started under an Idempotency-Key always
+# finishes, so the caller's retry replays it rather than generating again.
+CANCEL_ON_DISCONNECT = os.environ.get('CANCEL_ON_DISCONNECT', '1') == '1'
+disconnect_guard = DisconnectGuard()
+
+# Identical concurrent requests share one upstream call and compositing run
+in_flight = SingleFlight(cancel_abandoned=CANCEL_ON_DISCONNECT)
+
+# Stored /generate responses per Idempotency-Key (seconds / MB)
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', '900'))
+IDEMPOTENCY_MAX_MB = int(os.environ.get('IDEMPOTENCY_MAX_MB', '128'))
+idempotency_store = IdempotencyStore(
+    ttl=IDEMPOTENCY_TTL,
+    max_bytes=IDEMPOTENCY_MAX_MB * 1024 * 1024,
+    sizeof=lambda response: len(response.image_base64) + len(response.composite_image_base64),
+    keep=lambda response: response.success,
+) if IDEMPOTENCY_TTL > 0 else None
+
+# Background jobs (POST /jobs): finished jobs kept for JOB_TTL seconds,
+# results bounded to JOB_MAX_MB, at most JOB_MAX_ENTRIES jobs tracked
+job_store = JobStore(
+    ttl=float(os.environ.get('JOB_TTL', '900')),
+    max_bytes=int(os.environ.get('JOB_MAX_MB', '256')) * 1024 * 1024,
+    max_jobs=int(os.environ.get('JOB_MAX_ENTRIES', '1000')),
+    sizeof=lambda response: len(response.image_base64) + len(response.composite_image_base64),
+    succeeded=lambda response: response.success,
+)
+
+# With JOB_QUEUE_DB set, jobs go to a SQLite queue instead, shared by every
+# process using the same file; each process runs JOB_WORKERS worker loops
+JOB_QUEUE_DB = os.environ.get('JOB_QUEUE_DB', '')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+job_queue = DurableJobQueue(
+    path=JOB_QUEUE_DB,
+    lease_seconds=float(os.environ.get('JOB_LEASE_SECONDS', '60')),
+    max_attempts=int(os.environ.get('JOB_MAX_ATTEMPTS', '3')),
+    ttl=float(os.environ.get('JOB_TTL', '900')),
+) if JOB_QUEUE_DB else None
+job_workers = []
+
+# A job waits out a full upstream queue (or an open circuit) for up to
+# JOB_OVERLOAD_MAX_WAIT seconds, then fails with the reason it was refused
+JOB_OVERLOAD_MAX_WAIT = float(os.environ.get('JOB_OVERLOAD_MAX_WAIT', '600'))
+
+# Replicas sharing renders: PEERS is a comma-separated list of base URLs,
+# SELF_URL is this instance's URL exactly as the peers list it. With
+# PEER_SECRET set, /peer/generate only serves callers sending it; without,
+# only the peer hosts themselves.
+PEERS = [p.strip() for p in os.environ.get('PEERS', '').split(',') if p.strip()]
+SELF_URL = os.environ.get('SELF_URL', '')
+peer_pool = PeerPool(
+    self_url=SELF_URL,
+    peers=PEERS,
+    vnodes=int(os.environ.get('PEER_VNODES', '100')),
+    retry_after=float(os.environ.get('PEER_RETRY_SECONDS', '30')),
+    secret=os.environ.get('PEER_SECRET', ''),
+) if PEERS and SELF_URL else None
+
+# Executor for Pillow work: "thread" or "process" (fork), COMPOSITE_WORKERS wide
+# (process workers are forked at startup, while the event loop is the only thread)
+COMPOSITE_EXECUTOR = os.environ.get('COMPOSITE_EXECUTOR', 'thread')
+COMPOSITE_WORKERS = int(os.environ.get('COMPOSITE_WORKERS', str(os.cpu_count() or 4)))
+cpu_pool = CpuPool(COMPOSITE_EXECUTOR, COMPOSITE_WORKERS)
+
+# Upstream client built once at startup; UPSTREAM_CLIENT_REUSE=0 restores
+# per-request construction for comparing setup overhead
+upstream = UpstreamClient(
+    api_key=os.environ.get('EMERGENT_LLM_KEY'),
+    model=IMAGE_MODEL,
+    reuse=os.environ.get('UPSTREAM_CLIENT_REUSE', '1') == '1',
+)
+
+# Jittered retries within a retry budget (UPSTREAM_RETRY_RATIO of calls plus
+# UPSTREAM_RETRY_MIN_PER_SECOND), optional hedging past the latency
+# percentile, and a circuit breaker opened by consecutive failures.
+# Rejected prompts are neither retried nor counted as failures.
+resilient_upstream = ResilientUpstream(
+    upstream,
+    is_failure=lambda e: not is_upstream_rejection(e),
+    max_attempts=int(os.environ.get('UPSTREAM_MAX_ATTEMPTS', '3')),
+    backoff_base=float(os.environ.get('UPSTREAM_RETRY_BACKOFF', '0.5')),
+    backoff_cap=float(os.environ.get('UPSTREAM_RETRY_BACKOFF_CAP', '8')),
+    attempt_timeout=float(os.environ.get('UPSTREAM_ATTEMPT_TIMEOUT', '0')),
+    budget=RetryBudget(
+        ratio=float(os.environ.get('UPSTREAM_RETRY_RATIO', '0.2')),
+        min_per_second=float(os.environ.get('UPSTREAM_RETRY_MIN_PER_SECOND', '0.2')),
+    ),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.environ.get('UPSTREAM_BREAKER_FAILURES', '5')),
+        reset_timeout=float(os.environ.get('UPSTREAM_BREAKER_RESET', '30')),
+    ),
+    hedge=os.environ.get('UPSTREAM_HEDGE', '0') == '1',
+    hedge_percentile=float(os.environ.get('UPSTREAM_HEDGE_PERCENTILE', '0.95')),
+)
+
+# Upstream concurrency cap and bounded wait queue (seconds), split into
+# priority lanes (X-Priority) with round-robin between users (X-User-Id). With
+# UPSTREAM_ADAPTIVE=1 the cap starts at UPSTREAM_MAX_CONCURRENCY and moves
+# between the MIN/MAX bounds (AIMD) based on latency, 429s and timeouts.
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', '8'))
+concurrency_controller = AIMDController(
+    initial=UPSTREAM_MAX_CONCURRENCY,
+    minimum=int(os.environ.get('UPSTREAM_MIN_CONCURRENCY', '1')),
+    maximum=int(os.environ.get('UPSTREAM_CONCURRENCY_CEILING', '32')),
+    spike_factor=float(os.environ.get('UPSTREAM_LATENCY_SPIKE_FACTOR', '2.0')),
+    cooldown=float(os.environ.get('UPSTREAM_DECREASE_COOLDOWN', '5')),
+) if os.environ.get('UPSTREAM_ADAPTIVE', '1') == '1' else None
+admission = AdmissionController(
+    limit=UPSTREAM_MAX_CONCURRENCY,
+    max_queue=int(os.environ.get('UPSTREAM_MAX_QUEUE', '32')),
+    max_wait=float(os.environ.get('UPSTREAM_MAX_QUEUE_WAIT', '30')),
+    controller=concurrency_controller,
+    priorities=[p.strip() for p in os.environ.get('PRIORITY_CLASSES', 'premium,standard,batch').split(',')],
+    default_priority=os.environ.get('DEFAULT_PRIORITY', 'standard'),
+    deadline_margin=float(os.environ.get('DEADLINE_MARGIN', '2')),
+)
+
+# Callers may send X-Deadline-Ms (how long they will still wait). Requests
+# that cannot make it are refused up front; the user photo composite is
+# skipped when its expected time (COMPOSITE_ESTIMATE seconds until measured)
+# no longer fits.
+COMPOSITE_ESTIMATE = float(os.environ.get('COMPOSITE_ESTIMATE', '1'))
+
+# Size the upstream is expected to return; logos and user photos are decoded
+# and pre-resized for it while the upstream call is in flight
+UPSTREAM_IMAGE_SIZE = tuple(int(n) for n in os.environ.get('UPSTREAM_IMAGE_SIZE', '1024x1024').lower().split('x'))
+
+# Hosts whose X-User-Id and X-Priority headers are believed: the Node
+# service ("unix" is anyone allowed on IMAGE_GENERATOR_UDS). Other callers
+# get DEFAULT_PRIORITY and are told apart by X-Api-Key or client IP.
+# RATE_LIMIT_TRUSTED_PROXIES is the older name.
+TRUSTED_PROXIES = {
+    p.strip() for p in os.environ.get(
+        'TRUSTED_PROXIES', os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', f'127.0.0.1,::1,{UNIX_PEER}')
+    ).split(',') if p.strip()
+}
+
+# Per-caller token buckets: RATE_LIMIT_BURST requests, refilled at
+# RATE_LIMIT_PER_MINUTE (0 disables limiting). Callers are keyed as above.
+# Blend/normalize-only endpoints and /similar cost RATE_LIMIT_CPU_COST of a token.
+# RATE_LIMIT_REDIS_URL shares the buckets between replicas.
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '20'))
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_PER_MINUTE', '30')) / 60
+RATE_LIMIT_CPU_COST = float(os.environ.get('RATE_LIMIT_CPU_COST', '0.25'))
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', '')
+local_buckets = LocalBucketStore(
+    burst=RATE_LIMIT_BURST,
+    rate=RATE_LIMIT_RATE,
+    max_keys=int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000')),
+) if RATE_LIMIT_RATE > 0 else None
+rate_limiter = RateLimiter(
+    store=RedisBucketStore(RATE_LIMIT_REDIS_URL, RATE_LIMIT_BURST, RATE_LIMIT_RATE) if RATE_LIMIT_REDIS_URL else local_buckets,
+    fallback=local_buckets,
+    trusted_proxies=TRUSTED_PROXIES,
+) if local_buckets is not None and os.environ.get('RATE_LIMIT_ENABLED', '1') == '1' else None
+
+# Output encoding. DESIGN_OUTPUT_FORMAT and COMPOSITE_OUTPUT_FORMAT (png,
+# jpeg, webp, avif) apply when a request names no output_format: the design
+# stays lossless PNG as it is stored, downloaded and printed, the composite
+# is a photo preview. <FORMAT>_QUALITY sets lossy quality; PNG compress
+# level 3 encodes ~2.5x faster than Pillow's default 6 for ~15% more bytes.
+output_encoder = OutputEncoder(
+    quality={fmt: int(os.environ[f'{fmt.upper()}_QUALITY']) for fmt in ('jpeg', 'webp', 'avif')
+             if os.environ.get(f'{fmt.upper()}_QUALITY')},
+    webp_method=int(os.environ.get('WEBP_METHOD', '4')),
+    avif_speed=int(os.environ.get('AVIF_SPEED', '8')),
+    png_compress_level=int(os.environ.get('PNG_COMPRESS_LEVEL', '3')),
+    png_optimize=os.environ.get('PNG_OPTIMIZE', '0') == '1',
+)
+DESIGN_OUTPUT_FORMAT = output_encoder.resolve(os.environ.get('DESIGN_OUTPUT_FORMAT'), 'png')
+COMPOSITE_OUTPUT_FORMAT = output_encoder.resolve(os.environ.get('COMPOSITE_OUTPUT_FORMAT'), 'jpeg')
+
 app = FastAPI(title="Image Generator Service")
 
 # CORS
@@ -39,10 +313,20 @@ class ImageRequest(BaseModel):
     clothing_type: str = "t-shirt"
     color: str = ""
     logo_base64: Optional[str] = None
+    logo_asset_id: Optional[str] = None  # from POST /assets, instead of logo_base64
     logo_description: Optional[str] = None
     logo_position: Optional[str] = "center"  # center, left, right, bottom
     user_photo_base64: Optional[str] = None
+    user_photo_asset_id: Optional[str] = None  # from POST /assets, instead of user_photo_base64
     view_angle: Optional[str] = "front"
+    similar_render_key: Optional[str] = None  # a design suggested by /similar, returned instead of generating
+    output_format: Optional[str] = None  # png, jpeg, webp, avif for both images; else per-image defaults
+    output_quality: Optional[int] = None  # 1-100, lossy formats only
+
+class SimilarDesign(BaseModel):
+    render_key: str
+    prompt: str
+    similarity: float
 
 class ImageResponse(BaseModel):
     success: bool
@@ -50,27 +334,176 @@ class ImageResponse(BaseModel):
     composite_image_base64: str = ""
     revised_prompt: str = ""
     error: str = ""
+    rejected: bool = False  # the upstream refused this prompt
+    similar_design: Optional[SimilarDesign] = None
+    render_id: str = ""  # pass to /renders/{id}/reblend while the base image is kept
+    skipped_stages: List[str] = []  # optional stages shed to meet the deadline, e.g. "composite"
+    stage_timings_ms: Dict[str, float] = {}  # fresh generations only
+    image_media_type: str = "image/png"
+    composite_media_type: str = ""  # set with composite_image_base64
 
-def decode_base64_image(base64_str: str) -> Image.Image:
-    """Decode a base64 string to PIL Image"""
+class JobStage(BaseModel):
+    stage: str
+    at_ms: float  # since the job was submitted
+
+class JobResponse(BaseModel):
+    success: bool
+    job_id: str = ""
+    stage: str = ""  # queued, generating, blending, compositing, done, failed
+    stages: List[JobStage] = []
+    result: Optional[ImageResponse] = None  # set once the job is done or failed
+    error: str = ""
+
+class SimilarResponse(BaseModel):
+    success: bool
+    similar_design: Optional[SimilarDesign] = None  # None when nothing close enough is cached
+    error: str = ""
+
+class ReblendRequest(BaseModel):
+    # An omitted logo, position or user photo means the one the render was made with
+    logo_base64: Optional[str] = None
+    logo_asset_id: Optional[str] = None
+    logo_position: Optional[str] = None  # center, left, right, bottom
+    user_photo_base64: Optional[str] = None
+    user_photo_asset_id: Optional[str] = None
+    output_format: Optional[str] = None
+    output_quality: Optional[int] = None
+
+# Asset kinds and the mode they are normalized to
+ORIENTATION_TAG = 0x0112  # EXIF
+
+ASSET_MODES = {
+    "logo": "RGBA",
+    "user_photo": "RGB",
+}
+
+class AssetRequest(BaseModel):
+    image_base64: str
+    kind: str = "logo"  # logo, user_photo
+
+class AssetResponse(BaseModel):
+    success: bool
+    asset_id: str = ""
+    width: int = 0
+    height: int = 0
+    size_bytes: int = 0
+    error: str = ""
+
+def decode_base64_bytes(base64_str: str) -> bytes:
+    """Decode a base64 image payload (with or without data URL prefix) to its bytes"""
     try:
         # Remove data URL prefix if present
         if ',' in base64_str:
             base64_str = base64_str.split(',')[1]
-        image_data = base64.b64decode(base64_str)
+        return base64.b64decode(base64_str)
+    except Exception as e:
+        raise ValueError(f"Failed to decode image: {e}")
+
+def decode_base64_image(base64_str: str) -> Image.Image:
+    """Decode a base64 string to PIL Image"""
+    return decode_image_bytes(decode_base64_bytes(base64_str))
+
+def decode_image_bytes(image_data: bytes) -> Image.Image:
+    """Open raw image bytes (a multipart upload) as a PIL Image"""
+    try:
         return Image.open(io.BytesIO(image_data))
     except Exception as e:
         raise ValueError(f"Failed to decode image: {e}")
 
-def encode_image_to_base64(image: Image.Image, format: str = "PNG") -> str:
-    """Encode PIL Image to base64 string"""
-    buffer = io.BytesIO()
-    image.save(buffer, format=format)
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+def output_formats(request) -> tuple:
+    """(design, composite) formats: the request's output_format for both, else the per-output defaults"""
+    if request.output_quality is not None and not 1 <= request.output_quality <= 100:
+        raise ValueError("output_quality must be between 1 and 100")
+    if request.output_format:
+        fmt = output_encoder.resolve(request.output_format, DESIGN_OUTPUT_FORMAT)
+        return fmt, fmt
+    return DESIGN_OUTPUT_FORMAT, COMPOSITE_OUTPUT_FORMAT
+
+def encode_design(design_with_logo: Image.Image, request) -> Encoded:
+    return output_encoder.encode(design_with_logo.convert('RGB'), output_formats(request)[0], request.output_quality)
+
+def encoded_fields(design: Encoded, composite: Optional[Encoded]) -> dict:
+    """Response fields for the encoded images; records their encode stats"""
+    output_encoder.record(design)
+    output_encoder.record(composite)
+    return {
+        "image_base64": base64.b64encode(design.data).decode('utf-8'),
+        "image_media_type": design.media_type,
+        "composite_image_base64": base64.b64encode(composite.data).decode('utf-8') if composite else "",
+        "composite_media_type": composite.media_type if composite else "",
+    }
+
+def normalize_asset(image: Image.Image, kind: str) -> Image.Image:
+    """Apply EXIF orientation, convert to the kind's mode and cap the size"""
+    image = ImageOps.exif_transpose(image)
+    image = image.convert(ASSET_MODES[kind])
+    if max(image.size) > ASSET_MAX_DIMENSION:
+        image.thumbnail((ASSET_MAX_DIMENSION, ASSET_MAX_DIMENSION), Image.Resampling.LANCZOS)
+    return image
+
+def load_asset(asset_id: str) -> Image.Image:
+    """Open a registered asset"""
+    data = asset_store.get(asset_id)
+    if data is None:
+        raise ValueError(f"Unknown asset: {asset_id}")
+    return Image.open(io.BytesIO(data))
+
+def logo_digest(request) -> str:
+    """Identity of the request's logo: its asset ID or a digest of the inline payload"""
+    if request.logo_asset_id:
+        return f"asset:{request.logo_asset_id}"
+    return digest_payload(request.logo_base64)
+
+def user_photo_digest(request) -> str:
+    """Identity of the request's user photo: its asset ID or a digest of the inline payload"""
+    if request.user_photo_asset_id:
+        return f"asset:{request.user_photo_asset_id}"
+    return digest_payload(request.user_photo_base64)
+
+def load_logo(request) -> Image.Image:
+    """Decode the request's logo to RGBA, reusing the cached decode when possible"""
+    if request.logo_asset_id:
+        decode = lambda: load_asset(request.logo_asset_id).convert('RGBA')
+    else:
+        decode = lambda: ImageOps.exif_transpose(decode_base64_image(request.logo_base64)).convert('RGBA')
+    if logo_cache:
+        return logo_cache.get_decoded(logo_digest(request), decode)
+    return decode()
 
-def blend_logo_on_design(design_image: Image.Image, logo_image: Image.Image, position: str = "center") -> Image.Image:
+def load_user_photo(request) -> Image.Image:
+    """Open the request's user photo from its asset or inline payload"""
+    if request.user_photo_asset_id:
+        return load_asset(request.user_photo_asset_id)
+    return ImageOps.exif_transpose(decode_base64_image(request.user_photo_base64))
+
+def logo_box(design_size: tuple) -> tuple:
+    """Largest logo size for a design: about 25% of each dimension"""
+    return int(design_size[0] * 0.25), int(design_size[1] * 0.25)
+
+def fit_logo(logo_image: Image.Image, box: tuple) -> Image.Image:
+    """
+    Resize the logo to fit the box, keeping its aspect ratio. A logo fitted
+    already (truncation can leave it 1px short of the box) is returned as is.
+    """
+    logo = logo_image if logo_image.mode == 'RGBA' else logo_image.convert('RGBA')
+    logo_width, logo_height = logo.size
+    if logo_width <= box[0] and logo_height <= box[1] and min(box[0] - logo_width, box[1] - logo_height) <= 1:
+        return logo
+    ratio = min(box[0] / logo_width, box[1] / logo_height)
+    new_logo_size = (int(logo_width * ratio), int(logo_height * ratio))
+    return logo.resize(new_logo_size, Image.Resampling.LANCZOS)
+
+def fit_user_photo(user_photo: Image.Image, height: int) -> Image.Image:
+    """RGB user photo scaled to the design height, as the composite needs it"""
+    user = user_photo.convert('RGB')
+    ratio = height / user.height
+    return user.resize((int(user.width * ratio), height), Image.Resampling.LANCZOS)
+
+def blend_logo_on_design(design_image: Image.Image, logo_image: Image.Image, position: str = "center", logo_key: Optional[str] = None) -> Image.Image:
     """
-    Blend a logo onto the design image at the specified position
+    Blend a logo onto the design image at the specified position.
+    When logo_key (the logo payload digest) is given, the resized logo is
+    taken from / stored in the logo cache.
     """
     design = design_image.copy()
     
@@ -80,15 +513,16 @@ def blend_logo_on_design(design_image: Image.Image, logo_image: Image.Image, pos
     
     # Resize logo to appropriate size (about 20-30% of design width)
     design_width, design_height = design.size
-    logo_max_width = int(design_width * 0.25)
-    logo_max_height = int(design_height * 0.25)
+    box = logo_box(design.size)
     
     # Maintain aspect ratio
-    logo_image = logo_image.convert('RGBA')
-    logo_width, logo_height = logo_image.size
-    ratio = min(logo_max_width / logo_width, logo_max_height / logo_height)
-    new_logo_size = (int(logo_width * ratio), int(logo_height * ratio))
-    logo_resized = logo_image.resize(new_logo_size, Image.Resampling.LANCZOS)
+    def resize_logo() -> Image.Image:
+        return fit_logo(logo_image, box)
+    
+    if logo_key and logo_cache:
+        logo_resized = logo_cache.get_resized(logo_key, box, resize_logo)
+    else:
+        logo_resized = resize_logo()
     
     # Calculate position based on option
     logo_w, logo_h = logo_resized.size
@@ -131,10 +565,9 @@ def create_composite_with_user_photo(design_image: Image.Image, user_photo: Imag
     design_width, design_height = design.size
     
     # Resize user photo to match design height while maintaining aspect ratio
-    user_width, user_height = user.size
-    ratio = design_height / user_height
-    new_user_width = int(user_width * ratio)
-    user_resized = user.resize((new_user_width, design_height), Image.Resampling.LANCZOS)
+    # (a no-op copy when it was pre-resized for this design)
+    user_resized = fit_user_photo(user, design_height)
+    new_user_width = user_resized.width
     
     # Create composite canvas
     total_width = design_width + new_user_width + 40  # 40px gap
@@ -154,90 +587,931 @@ def create_composite_with_user_photo(design_image: Image.Image, user_photo: Imag
     
     return composite
 
+def build_enhanced_prompt(request: ImageRequest) -> str:
+    """Build the upstream prompt with logo description and position if provided"""
+    logo_part = ""
+    logo_position_text = LOGO_POSITIONS.get(request.logo_position, "center chest")
+    
+    if request.logo_description:
+        logo_part = f" The clothing has a custom logo/design on the {logo_position_text}: {request.logo_description}."
+    elif request.logo_base64 or request.logo_asset_id:
+        logo_part = f" The clothing features a custom printed logo/design prominently displayed on the {logo_position_text}."
+    
+    # Create enhanced prompt for fashion design
+    return f"""Professional fashion photography: A {request.clothing_type} clothing item displayed on a mannequin or flat lay.
+Design details: {request.prompt}.
+{f'Primary color: {request.color}.' if request.color else ''}
+{logo_part}
+Style: High-end fashion catalog photography, clean white/light gray background, professional studio lighting, sharp details, fabric texture visible, premium quality clothing, fashion e-commerce style photo."""
+
+def canonical_request(request: ImageRequest) -> ImageRequest:
+    """Copy of the request with free-text fields canonicalized, for cache keys only"""
+    return request.model_copy(update={
+        "prompt": canonicalize_text(request.prompt),
+        "clothing_type": canonicalize_text(request.clothing_type),
+        "color": canonicalize_text(request.color),
+        "logo_description": canonicalize_text(request.logo_description) or None,
+        "logo_position": request.logo_position if request.logo_position in LOGO_POSITIONS else "center",
+    })
+
+def render_cache_key(request: ImageRequest, canonical: ImageRequest) -> str:
+    """
+    Content-address a request by everything that affects the rendered output.
+    The prompt is rebuilt from canonicalized fields, so spelling variants of
+    the same request share a key while the original text still goes upstream.
+    """
+    return make_cache_key({
+        "model": IMAGE_MODEL,
+        "prompt": build_enhanced_prompt(canonical),
+        "logo": logo_digest(request),
+        "logo_position": canonical.logo_position,
+        "user_photo": user_photo_digest(request),
+        "output": [request.output_format or f"{DESIGN_OUTPUT_FORMAT}/{COMPOSITE_OUTPUT_FORMAT}", request.output_quality],
+    })
+
+def rejection_key(canonical: ImageRequest) -> str:
+    """Rejections depend only on the text sent upstream, not on the images"""
+    return make_cache_key({"model": IMAGE_MODEL, "prompt": build_enhanced_prompt(canonical)})
+
+def is_upstream_rejection(error: Exception) -> bool:
+    """Whether an upstream error means the prompt itself was refused"""
+    if getattr(error, 'status_code', None) == 400:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in UPSTREAM_REJECTION_MARKERS)
+
+def similar_group(request: ImageRequest, canonical: ImageRequest) -> str:
+    """Everything except the prompt text must match exactly for a near-duplicate"""
+    return make_cache_key({
+        "model": IMAGE_MODEL,
+        "clothing_type": canonical.clothing_type,
+        "color": canonical.color,
+        "logo_description": canonical.logo_description,
+        "logo": logo_digest(request),
+        "logo_position": canonical.logo_position,
+        "user_photo": user_photo_digest(request),
+    })
+
+@app.on_event("startup")
+async def startup():
+    # Before the upstream client, job workers or to_thread calls start threads
+    cpu_pool.warm()
+    try:
+        upstream.start()
+    except Exception as e:
+        print(f"Warning: Could not initialize upstream image client: {e}")
+    if job_queue:
+        worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for i in range(JOB_WORKERS):
+            job_workers.append(asyncio.create_task(job_queue.work(run_queued_job, f"{worker_prefix}:{i}")))
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Unfinished durable jobs are picked up again once their lease expires
+    for task in job_workers:
+        task.cancel()
+    await upstream.close()
+    if peer_pool:
+        await peer_pool.close()
+    if rate_limiter:
+        await rate_limiter.close()
+    cpu_pool.shutdown()
+
 @app.get("/health")
 async def health():
     return {"status": "ok", "service": "image-generator"}
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "render_cache": render_cache.stats() if render_cache else None,
+        "logo_cache": logo_cache.stats() if logo_cache else None,
+        "similar_index": similar_index.stats() if similar_index is not None else None,
+        "rejection_cache": rejection_cache.stats() if rejection_cache else None,
+        "in_flight": in_flight.stats(),
+        "disconnects": disconnect_guard.stats(),
+        "idempotency": idempotency_store.stats() if idempotency_store else None,
+        "peers": peer_pool.stats() if peer_pool else None,
+        "assets": asset_store.stats(),
+        "asset_aliases": len(asset_aliases),
+        "base_renders": {"entries": len(base_renders), "bytes": base_renders.current_bytes},
+        "cpu_pool": cpu_pool.stats(),
+        "upstream_client": upstream.stats(),
+        "upstream_resilience": resilient_upstream.stats(),
+        "admission": admission.stats(),
+        "encoding": output_encoder.stats(),
+        "rate_limit": rate_limiter.stats() if rate_limiter else None,
+        "jobs": await asyncio.to_thread(job_queue.stats) if job_queue else job_store.stats(),
+    }
+
+def has_user_photo(request) -> bool:
+    return bool(request.user_photo_base64 or request.user_photo_asset_id)
+
+class PreparedInputs(NamedTuple):
+    """Logo and user photo decoded and pre-resized for a design of `design_size`"""
+    design_size: tuple
+    logo: Optional[Image.Image] = None
+    user_photo: Optional[Image.Image] = None
+    prepare_ms: float = 0.0
+
+def has_logo(request) -> bool:
+    return bool(request.logo_base64 or request.logo_asset_id)
+
+def blend_inputs(request) -> dict:
+    """The request's logo and user photo fields, kept with its base render for reblend"""
+    return {
+        "logo_base64": request.logo_base64,
+        "logo_asset_id": request.logo_asset_id,
+        "logo_position": request.logo_position,
+        "user_photo_base64": request.user_photo_base64,
+        "user_photo_asset_id": request.user_photo_asset_id,
+    }
+
+def prepare_inputs(request, design_size: tuple) -> PreparedInputs:
+    """
+    Decode, validate, orient and pre-resize the logo and user photo for the
+    expected design size; runs in the CPU pool while the upstream generates.
+    An input that fails to decode is left out, as it would be when blending.
+    """
+    started = time.perf_counter()
+    logo = user_photo = None
+    if has_logo(request):
+        try:
+            box = logo_box(design_size)
+            decoded = load_logo(request)
+            if logo_cache:
+                logo = logo_cache.get_resized(logo_digest(request), box, lambda: fit_logo(decoded, box))
+            else:
+                logo = fit_logo(decoded, box)
+        except Exception as e:
+            print(f"Warning: Could not prepare logo: {e}")
+    if has_user_photo(request):
+        try:
+            user_photo = fit_user_photo(load_user_photo(request), design_size[1])
+        except Exception as e:
+            print(f"Warning: Could not prepare user photo: {e}")
+    return PreparedInputs(design_size, logo, user_photo, (time.perf_counter() - started) * 1000)
+
+def apply_logo(generated_image: Image.Image, request, inputs: Optional[PreparedInputs] = None) -> Image.Image:
+    """Blend the request's logo (if any) onto the generated image"""
+    design_with_logo = generated_image
+    if inputs is not None:
+        if inputs.logo is None:
+            return design_with_logo
+        # Prepared for this size, so fit_logo keeps it and only the paste is left
+        return blend_logo_on_design(generated_image, inputs.logo, request.logo_position or "center")
+    if has_logo(request):
+        try:
+            logo_key = logo_digest(request)
+            logo_image = load_logo(request)
+            design_with_logo = blend_logo_on_design(
+                generated_image, 
+                logo_image, 
+                request.logo_position or "center",
+                logo_key
+            )
+            print(f"Logo blended successfully at position: {request.logo_position}")
+        except Exception as e:
+            print(f"Warning: Could not blend logo: {e}")
+            design_with_logo = generated_image
+    return design_with_logo
+
+def composite_design(design_with_logo: Image.Image, request, inputs: Optional[PreparedInputs] = None) -> Optional[Encoded]:
+    """Side-by-side composite with the request's user photo, or None without one"""
+    composite = None
+    if inputs is not None and inputs.user_photo is None:
+        return composite
+    if has_user_photo(request):
+        try:
+            user_photo = inputs.user_photo if inputs is not None else load_user_photo(request)
+            composite_image = create_composite_with_user_photo(design_with_logo, user_photo)
+            composite = output_encoder.encode(composite_image, output_formats(request)[1], request.output_quality)
+            print("Composite image with user photo created successfully")
+        except Exception as e:
+            print(f"Warning: Could not create composite with user photo: {e}")
+    return composite
+
+def compose_design(generated_image: Image.Image, request) -> tuple:
+    """
+    Blend the request's logo onto the generated image and build the user
+    photo composite. Returns (design, composite) as Encoded, composite None without one.
+    """
+    design_with_logo = apply_logo(generated_image, request)
+    return encode_design(design_with_logo, request), composite_design(design_with_logo, request)
+
+def render_design(image_bytes: bytes, request) -> tuple:
+    """Decode upstream image bytes and compose them; runs in the CPU pool"""
+    return compose_design(Image.open(io.BytesIO(image_bytes)), request)
+
+def blend_design(image_bytes: bytes, request, inputs: Optional[PreparedInputs] = None) -> tuple:
+    """
+    Decode upstream image bytes, blend the logo and encode the design; runs
+    in the CPU pool. The blended image is handed back only when a composite
+    still has to be built from it.
+    """
+    generated_image = Image.open(io.BytesIO(image_bytes))
+    if inputs is not None and inputs.design_size != generated_image.size:
+        # Upstream returned another size than expected; prepare again from the originals
+        inputs = None
+    design_with_logo = apply_logo(generated_image, request, inputs)
+    return (design_with_logo if has_user_photo(request) else None), encode_design(design_with_logo, request)
+
+def is_normalized(image: Image.Image, kind: str) -> bool:
+    """Whether an opened (not yet decoded) upload is already what normalize_asset would produce"""
+    return (
+        image.format == "PNG" and image.mode == ASSET_MODES[kind]
+        and max(image.size) <= ASSET_MAX_DIMENSION
+        and image.getexif().get(ORIENTATION_TAG, 1) == 1
+    )
+
+def prepare_asset(image_data: Union[str, bytes], kind: str) -> tuple:
+    """
+    Decode, normalize and PNG-encode an upload (base64 or raw bytes); runs
+    in the CPU pool. An upload that is already normalized is kept as is.
+    """
+    data = image_data if isinstance(image_data, bytes) else decode_base64_bytes(image_data)
+    image = decode_image_bytes(data)
+    if is_normalized(image, kind):
+        try:
+            # Checks the chunk CRCs without decoding the pixels
+            decode_image_bytes(data).verify()
+        except Exception as e:
+            raise ValueError(f"Failed to decode image: {e}")
+        return data, image.width, image.height
+    image = normalize_asset(image, kind)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=ASSET_PNG_COMPRESS_LEVEL)
+    return buffer.getvalue(), image.width, image.height
+
+async def run_generation(request: ImageRequest, canonical: ImageRequest, enhanced_prompt: str,
+                         cache_key: str, reject_key: str, caller: Caller) -> ImageResponse:
+    """Upstream generation plus logo blending and composition for one request"""
+    # Decode and pre-resize the logo and user photo while the upstream works
+    prepared = None
+    if has_logo(request) or has_user_photo(request):
+        prepared = asyncio.ensure_future(cpu_pool.run("prepare", prepare_inputs, request, UPSTREAM_IMAGE_SIZE))
+        prepared.add_done_callback(lambda task: task.cancelled() or task.exception())
+    try:
+        return await generate_and_compose(request, canonical, enhanced_prompt, cache_key, reject_key, caller, prepared)
+    finally:
+        # Not needed after a rejection, failure or cancellation; drop it if still queued
+        if prepared is not None and not prepared.done():
+            prepared.cancel()
+
+@asynccontextmanager
+async def upstream_slot(caller: Caller):
+    """An admission slot for one upstream attempt (retries queue again)"""
+    async with admission.slot(caller):
+        report_stage(GENERATING)
+        yield
+
+async def generate_and_compose(request: ImageRequest, canonical: ImageRequest, enhanced_prompt: str,
+                               cache_key: str, reject_key: str, caller: Caller,
+                               prepared: Optional[asyncio.Future]) -> ImageResponse:
+    timings = {}
+    # Generate image, waiting for an upstream slot (unless the upstream is known to be down)
+    try:
+        resilient_upstream.check()
+        started = time.perf_counter()
+        images = await resilient_upstream.generate(enhanced_prompt, caller.deadline,
+                                                   slot=lambda: upstream_slot(caller), hedge_slot=admission.try_slot)
+        timings["upstream_ms"] = (time.perf_counter() - started) * 1000
+    except Exception as e:
+        if not is_upstream_rejection(e):
+            raise
+        print(f"Upstream rejected prompt: {e}")
+        if rejection_cache:
+            rejection_cache.reject(reject_key, str(e))
+        return ImageResponse(success=False, rejected=True, error=str(e))
+    
+    if not images or len(images) == 0:
+        return ImageResponse(
+            success=False,
+            error="No image was generated"
+        )
+    
+    # Keep the un-logoed image so the logo can be moved without regenerating
+    render_id = uuid.uuid4().hex
+    base_renders.put(render_id, (images[0], enhanced_prompt, blend_inputs(request)))
+    
+    # Normally finished during the upstream call; any wait here is on the critical path
+    inputs = None
+    if prepared is not None:
+        started = time.perf_counter()
+        inputs = await prepared
+        timings["prepare_ms"] = inputs.prepare_ms
+        timings["prepare_blocked_ms"] = (time.perf_counter() - started) * 1000
+    
+    # Paste, composite and encode off the event loop
+    report_stage(BLENDING)
+    started = time.perf_counter()
+    design_image, design = await cpu_pool.run("blend", blend_design, images[0], request, inputs)
+    timings["blend_ms"] = (time.perf_counter() - started) * 1000
+    timings["design_encode_ms"] = design.encode_ms
+    composite = None
+    skipped_stages = []
+    if design_image is not None:
+        if inputs is not None and inputs.design_size != design_image.size:
+            inputs = None
+        if can_afford(caller, cpu_pool.expected_seconds("composite", COMPOSITE_ESTIMATE)):
+            report_stage(COMPOSITING)
+            started = time.perf_counter()
+            composite = await cpu_pool.run("composite", composite_design, design_image, request, inputs)
+            timings["composite_ms"] = (time.perf_counter() - started) * 1000
+            if composite is not None:
+                timings["composite_encode_ms"] = composite.encode_ms
+        else:
+            # Out of time: return the design alone; reblend can add the composite later
+            print(f"Composite skipped for deadline: {cache_key[:12]}")
+            cpu_pool.shed("composite")
+            skipped_stages.append("composite")
+    
+    result = {
+        **encoded_fields(design, composite),
+        "revised_prompt": enhanced_prompt,
+        "render_id": render_id,
+    }
+    stage_timings_ms = {stage: round(ms, 2) for stage, ms in timings.items()}
+    if skipped_stages:
+        # Not cached: later callers with more time should get the full result
+        return ImageResponse(success=True, skipped_stages=skipped_stages, stage_timings_ms=stage_timings_ms, **result)
+    if render_cache:
+        await render_cache.put_async(cache_key, json.dumps(result).encode('utf-8'))
+        if similar_index is not None:
+            # MinHash plus a log append, off the event loop like the query
+            await asyncio.to_thread(similar_index.add, cache_key, similar_group(request, canonical), canonical.prompt)
+    
+    return ImageResponse(success=True, stage_timings_ms=stage_timings_ms, **result)
+
+def make_caller(priority: Optional[str], user_id: Optional[str], deadline_ms: Optional[str] = None,
+                http_request: Optional[Request] = None) -> Caller:
+    """
+    Caller from the X-Priority, X-User-Id and X-Deadline-Ms headers. Given
+    the `http_request` they came with, priority and user are only taken
+    from a trusted proxy; other callers get the default priority and their
+    API key or address as user. Without it they were vetted already (a
+    queued job, a peer replica).
+    """
+    deadline = None
+    if deadline_ms:
+        try:
+            deadline = time.monotonic() + float(deadline_ms) / 1000
+        except ValueError:
+            print(f"Warning: Ignoring malformed X-Deadline-Ms: {deadline_ms}")
+    if http_request is not None:
+        client_host = peer_host(http_request.scope)
+        if client_host not in TRUSTED_PROXIES:
+            priority = None
+        user_id = client_identity(client_host, user_id, http_request.headers.get('X-Api-Key'), TRUSTED_PROXIES)
+    return Caller(priority or admission.default_priority, user_id or "", deadline)
+
+def can_afford(caller: Caller, seconds: float) -> bool:
+    """Whether the caller's deadline leaves room for `seconds` more work"""
+    remaining = caller.remaining()
+    return remaining is None or remaining >= seconds + admission.deadline_margin
+
+def caller_headers(caller: Caller) -> dict:
+    """Headers carrying the caller's priority class, user ID and deadline to a peer"""
+    headers = {"X-Priority": caller.priority}
+    if caller.user_id:
+        headers["X-User-Id"] = caller.user_id
+    remaining = caller.remaining()
+    if remaining is not None:
+        headers["X-Deadline-Ms"] = str(max(int(remaining * 1000), 0))
+    return headers
+
+async def peer_request_body(request: ImageRequest) -> dict:
+    """Assets are per replica, so inline them before forwarding to a peer"""
+    body = request.model_dump()
+    for field in ("logo", "user_photo"):
+        asset_id = body.pop(f"{field}_asset_id")
+        if asset_id:
+            data = await asset_store.get_async(asset_id)
+            if data is None:
+                # Evicted since generate_design checked it
+                raise ValueError(f"Unknown asset: {asset_id}")
+            body[f"{field}_base64"] = base64.b64encode(data).decode('utf-8')
+    return body
+
+def can_afford_full_render(caller: Caller) -> bool:
+    """Whether the caller's deadline leaves room for an upstream call plus the composite"""
+    return can_afford(caller, admission.expected_hold() + cpu_pool.expected_seconds("composite", COMPOSITE_ESTIMATE))
+
+async def render_coalesced(request: ImageRequest, canonical: ImageRequest, enhanced_prompt: str,
+                           cache_key: str, reject_key: str, caller: Caller, from_peer: bool) -> ImageResponse:
+    """
+    render_shared through single-flight. The shared work runs under the
+    leader's deadline, so a follower it cut short (refused for time, or the
+    composite shed) runs again under its own when that leaves more room.
+    """
+    while True:
+        led = False
+
+        def lead():
+            nonlocal led
+            led = True
+            return render_shared(request, canonical, enhanced_prompt, cache_key, reject_key, caller, from_peer)
+
+        try:
+            response = await in_flight.do(cache_key, lead)
+        except DeadlineExceeded:
+            if led:
+                raise
+            continue
+        if led or not response.skipped_stages or not can_afford_full_render(caller):
+            return response
+
+async def render_shared(request: ImageRequest, canonical: ImageRequest, enhanced_prompt: str,
+                        cache_key: str, reject_key: str, caller: Caller, from_peer: bool) -> ImageResponse:
+    """Fetch the render from the key's owner replica, or generate it here"""
+    if peer_pool and not from_peer:
+        owner = peer_pool.owner(cache_key)
+        if owner:
+            report_stage(GENERATING)
+            data = await peer_pool.fetch(owner, await peer_request_body(request), caller_headers(caller))
+            if data is not None:
+                response = ImageResponse(**data)
+                # Keep a local hot copy so repeats here skip the hop (not shed results,
+                # which later callers with more time should get in full)
+                if response.success and not response.skipped_stages and render_cache:
+                    await render_cache.put_async(cache_key, json.dumps({
+                        "image_base64": response.image_base64,
+                        "image_media_type": response.image_media_type,
+                        "composite_image_base64": response.composite_image_base64,
+                        "composite_media_type": response.composite_media_type,
+                        "revised_prompt": response.revised_prompt,
+                        "render_id": response.render_id,
+                    }).encode('utf-8'))
+                elif response.rejected and rejection_cache:
+                    rejection_cache.reject(reject_key, response.error)
+                return response
+    return await run_generation(request, canonical, enhanced_prompt, cache_key, reject_key, caller)
+
 @app.post("/generate", response_model=ImageResponse)
-async def generate_image(request: ImageRequest):
+async def generate_image(request: ImageRequest, http_request: Request,
+                         idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                         priority: Optional[str] = Header(None, alias="X-Priority"),
+                         user_id: Optional[str] = Header(None, alias="X-User-Id"),
+                         deadline_ms: Optional[str] = Header(None, alias="X-Deadline-Ms")):
+    caller = make_caller(priority, user_id, deadline_ms, http_request)
     try:
-        from emergentintegrations.llm.openai.image_generation import OpenAIImageGeneration
-        
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        if not api_key:
-            raise HTTPException(status_code=500, detail="API key not configured")
-        
-        # Build the prompt with logo description and position if provided
-        logo_part = ""
-        logo_position_text = LOGO_POSITIONS.get(request.logo_position, "center chest")
-        
-        if request.logo_description:
-            logo_part = f" The clothing has a custom logo/design on the {logo_position_text}: {request.logo_description}."
-        elif request.logo_base64:
-            logo_part = f" The clothing features a custom printed logo/design prominently displayed on the {logo_position_text}."
-        
-        # Create enhanced prompt for fashion design
-        enhanced_prompt = f"""Professional fashion photography: A {request.clothing_type} clothing item displayed on a mannequin or flat lay.
-Design details: {request.prompt}.
-{f'Primary color: {request.color}.' if request.color else ''}
-{logo_part}
-Style: High-end fashion catalog photography, clean white/light gray background, professional studio lighting, sharp details, fabric texture visible, premium quality clothing, fashion e-commerce style photo."""
-        
-        # Initialize image generator
-        image_gen = OpenAIImageGeneration(api_key=api_key)
-        
-        # Generate image
-        images = await image_gen.generate_images(
-            prompt=enhanced_prompt,
-            model="gpt-image-1",
-            number_of_images=1
+        await enforce_rate_limit(http_request, user_id)
+        return await serve_generation(request, http_request, caller, idempotency_key)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ClientDisconnected:
+        return disconnected_response()
+
+@app.post("/generate/binary", response_model=None)
+async def generate_image_binary(http_request: Request,
+                                prompt: str = Form(...),
+                                clothing_type: str = Form("t-shirt"),
+                                color: str = Form(""),
+                                logo: Optional[UploadFile] = File(None),
+                                logo_asset_id: Optional[str] = Form(None),
+                                logo_description: Optional[str] = Form(None),
+                                logo_position: Optional[str] = Form("center"),
+                                user_photo: Optional[UploadFile] = File(None),
+                                user_photo_asset_id: Optional[str] = Form(None),
+                                view_angle: Optional[str] = Form("front"),
+                                similar_render_key: Optional[str] = Form(None),
+                                output_format: Optional[str] = Form(None),
+                                output_quality: Optional[int] = Form(None),
+                                part: Optional[str] = None,
+                                idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                                priority: Optional[str] = Header(None, alias="X-Priority"),
+                                user_id: Optional[str] = Header(None, alias="X-User-Id"),
+                                deadline_ms: Optional[str] = Header(None, alias="X-Deadline-Ms")):
+    """
+    /generate without base64: the logo and user photo arrive as multipart
+    file parts (stored as assets), and the result is a multipart/form-data
+    body with a JSON "metadata" part and "design"/"composite" image parts,
+    or just one image with ?part=design or ?part=composite. Without
+    output_format, the image format is negotiated from the Accept header.
+    """
+    if part not in (None, "design", "composite"):
+        raise HTTPException(status_code=422, detail=f"Unknown part: {part}")
+    if not output_format:
+        default = COMPOSITE_OUTPUT_FORMAT if part == "composite" else DESIGN_OUTPUT_FORMAT
+        negotiated = output_encoder.negotiate(http_request.headers.get('Accept'), default)
+        # Keep the per-image defaults unless the client cannot take them
+        output_format = negotiated if negotiated != default else None
+    caller = make_caller(priority, user_id, deadline_ms, http_request)
+    try:
+        await enforce_rate_limit(http_request, user_id)
+        try:
+            logo_asset_id = await store_upload(logo, "logo") or logo_asset_id
+            user_photo_asset_id = await store_upload(user_photo, "user_photo") or user_photo_asset_id
+        except Exception as e:
+            print(f"Error storing upload: {e}")
+            return JSONResponse(content=ImageResponse(success=False, error=str(e)).model_dump())
+        request = ImageRequest(
+            prompt=prompt,
+            clothing_type=clothing_type,
+            color=color,
+            logo_asset_id=logo_asset_id,
+            logo_description=logo_description,
+            logo_position=logo_position,
+            user_photo_asset_id=user_photo_asset_id,
+            view_angle=view_angle,
+            similar_render_key=similar_render_key,
+            output_format=output_format,
+            output_quality=output_quality
         )
-        
-        if not images or len(images) == 0:
-            return ImageResponse(
-                success=False,
-                error="No image was generated"
+        response = await serve_generation(request, http_request, caller, idempotency_key)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ClientDisconnected:
+        return disconnected_response()
+    return binary_response(response, part)
+
+async def serve_generation(request: ImageRequest, http_request: Request, caller: Caller,
+                           idempotency_key: Optional[str]) -> ImageResponse:
+    """Generate for /generate and /generate/binary, cancelled if the client leaves"""
+    # Retries carrying the same key replay or join the original attempt
+    if idempotency_key and idempotency_store:
+        fingerprint = render_cache_key(request, canonical_request(request))
+        try:
+            work = idempotency_store.run(idempotency_key, fingerprint, lambda: generate_design(request, caller))
+            return await guarded(http_request, work)
+        except IdempotencyConflict as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    return await guarded(http_request, generate_design(request, caller))
+
+async def store_upload(upload: Optional[UploadFile], kind: str) -> Optional[str]:
+    """Register a multipart image part as an asset; None when the part is absent or empty"""
+    if upload is None:
+        return None
+    data = await upload.read()
+    if not data:
+        return None
+    asset_id, _, _, _ = await store_asset(data, kind)
+    return asset_id
+
+def multipart_body(parts: List[tuple]) -> tuple:
+    """
+    Encode (name, filename, content_type, data) parts as multipart/form-data,
+    which fetch's Response.formData() reads back as fields and Blobs.
+    Returns (body, content_type).
+    """
+    boundary = uuid.uuid4().hex
+    chunks = []
+    for name, filename, content_type, data in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else '')
+        chunks.append(
+            f"--{boundary}\r\nContent-Disposition: {disposition}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n\r\n".encode('utf-8')
+        )
+        chunks.append(data)
+        chunks.append(b"\r\n")
+    chunks.append(f"--{boundary}--\r\n".encode('utf-8'))
+    return b"".join(chunks), f"multipart/form-data; boundary={boundary}"
+
+def binary_response(response: ImageResponse, part: Optional[str] = None) -> Response:
+    """The images of a successful ImageResponse as binary; failures stay JSON"""
+    if not response.success:
+        return JSONResponse(content=response.model_dump())
+    metadata = response.model_dump(exclude={"image_base64", "composite_image_base64"})
+    if part is not None:
+        if part == "design":
+            image_base64, media_type = response.image_base64, response.image_media_type
+        else:
+            image_base64, media_type = response.composite_image_base64, response.composite_media_type
+        if not image_base64:
+            return JSONResponse(
+                status_code=404,
+                content=ImageResponse(success=False, error=f"No {part} image in this result").model_dump()
             )
+        headers = {"X-Render-Id": response.render_id, "X-Revised-Prompt": quote(response.revised_prompt)}
+        if response.skipped_stages:
+            headers["X-Skipped-Stages"] = ",".join(response.skipped_stages)
+        return Response(content=base64.b64decode(image_base64), media_type=media_type, headers=headers)
+    parts = [("metadata", None, "application/json", json.dumps(metadata).encode('utf-8')),
+             ("design", "design." + response.image_media_type.split("/")[1], response.image_media_type,
+              base64.b64decode(response.image_base64))]
+    if response.composite_image_base64:
+        parts.append(("composite", "composite." + response.composite_media_type.split("/")[1],
+                      response.composite_media_type, base64.b64decode(response.composite_image_base64)))
+    body, content_type = multipart_body(parts)
+    return Response(content=body, media_type=content_type)
+
+async def enforce_rate_limit(http_request: Request, user_id: Optional[str], cost: float = 1.0):
+    """Charge the caller's token bucket; raises RateLimited (an Overloaded)"""
+    if rate_limiter is None:
+        return
+    identity = rate_limiter.identity(peer_host(http_request.scope), user_id, http_request.headers.get('X-Api-Key'))
+    await rate_limiter.check(identity, cost)
+
+async def guarded(http_request: Request, work):
+    """Await the work, cancelling it if the client disconnects first"""
+    if not CANCEL_ON_DISCONNECT:
+        return await work
+    return await disconnect_guard.run(http_request, work)
+
+def disconnected_response() -> JSONResponse:
+    """Nobody reads this; 499 keeps access logs honest"""
+    return JSONResponse(
+        status_code=499,
+        content=ImageResponse(success=False, error="Client disconnected").model_dump()
+    )
+
+def job_response(job) -> JobResponse:
+    return JobResponse(
+        success=True,
+        job_id=job.id,
+        stage=job.stage,
+        stages=job.timings(),
+        result=job.result,
+        error=job.error
+    )
+
+@app.post("/jobs", response_model=JobResponse, status_code=202)
+async def submit_job(request: ImageRequest, http_request: Request,
+                     priority: Optional[str] = Header(None, alias="X-Priority"),
+                     user_id: Optional[str] = Header(None, alias="X-User-Id")):
+    """Start a generation in the background; poll /jobs/{id} or follow /jobs/{id}/events"""
+    caller = make_caller(priority, user_id, http_request=http_request)
+    try:
+        await enforce_rate_limit(http_request, user_id)
+    except Overloaded as e:
+        return overloaded_response(e, JobResponse)
+    if job_queue:
+        job_id = await asyncio.to_thread(job_queue.enqueue, {
+            "request": request.model_dump(),
+            "priority": caller.priority,
+            "user_id": caller.user_id,
+        })
+        return JobResponse(success=True, job_id=job_id, stage=QUEUED, stages=[JobStage(stage=QUEUED, at_ms=0.0)])
+    job = job_store.submit(lambda: generate_for_job(request, caller))
+    if job is None:
+        return JSONResponse(
+            status_code=503,
+            content=JobResponse(success=False, error="Too many unfinished jobs").model_dump(),
+            headers={"Retry-After": str(admission.retry_after())}
+        )
+    return job_response(job)
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    if job_queue:
+        job = await asyncio.to_thread(job_queue.get, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found or expired")
+        return JobResponse(
+            success=True,
+            job_id=job_id,
+            stage=job["stage"],
+            stages=job["stages"],
+            result=job["result"],
+            error=job["error"]
+        )
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job_response(job)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent stage transitions; fetch /jobs/{id} for the result after done"""
+    if job_queue:
+        if await asyncio.to_thread(job_queue.get, job_id) is None:
+            raise HTTPException(status_code=404, detail="Job not found or expired")
+        events = job_queue.events(job_id)
+    else:
+        job = job_store.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found or expired")
+        events = job_store.events(job)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def generate_for_job(request: ImageRequest, caller: Caller) -> ImageResponse:
+    """generate_design for a background job, waiting out a full queue for up to JOB_OVERLOAD_MAX_WAIT"""
+    give_up_at = time.monotonic() + JOB_OVERLOAD_MAX_WAIT
+    while True:
+        try:
+            return await generate_design(request, caller)
+        except Overloaded as e:
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                return ImageResponse(success=False, error=str(e))
+            # Keep the job (and a durable job's lease) and try again once capacity frees up
+            await asyncio.sleep(min(e.retry_after, remaining))
+
+async def run_queued_job(payload: dict) -> tuple:
+    """Durable queue handler: returns (ImageResponse JSON, error)"""
+    request = ImageRequest(**payload["request"])
+    caller = make_caller(payload["priority"], payload["user_id"])
+    response = await generate_for_job(request, caller)
+    return response.model_dump_json(), "" if response.success else response.error or "Generation failed"
+
+def overloaded_response(error: Overloaded, response_model=ImageResponse) -> JSONResponse:
+    """429/503/504 with Retry-After when there is no capacity (or budget) for the caller"""
+    return JSONResponse(
+        status_code=error.status_code,
+        content=response_model(success=False, error=str(error)).model_dump(),
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+async def store_asset(image_data: Union[str, bytes], kind: str) -> tuple:
+    """Normalize an image and keep it under its content hash; returns (asset_id, width, height, size_bytes)"""
+    if kind not in ASSET_MODES:
+        raise ValueError(f"Unknown asset kind: {kind}")
+    # A repeat of a known upload skips the decode and re-encode
+    raw_digest = hashlib.sha256(image_data).hexdigest() if isinstance(image_data, bytes) else digest_payload(image_data)
+    alias = f"{kind}:{raw_digest}"
+    known = asset_aliases.get(alias)
+    if known is not None and known[0] in asset_store:
+        return known
+    data, width, height = await cpu_pool.run("normalize_asset", prepare_asset, image_data, kind)
+    asset_id = hashlib.sha256(data).hexdigest()
+    if asset_id not in asset_store:
+        await asset_store.put_async(asset_id, data)
+    stored = (asset_id, width, height, len(data))
+    asset_aliases.put(alias, stored)
+    return stored
+
+@app.post("/assets", response_model=AssetResponse)
+async def register_asset(request: AssetRequest, http_request: Request,
+                         user_id: Optional[str] = Header(None, alias="X-User-Id")):
+    """Store a normalized logo/user photo under its content hash and return its ID"""
+    try:
+        await enforce_rate_limit(http_request, user_id, RATE_LIMIT_CPU_COST)
+    except Overloaded as e:
+        return overloaded_response(e, AssetResponse)
+    try:
+        asset_id, width, height, size_bytes = await store_asset(request.image_base64, request.kind)
+        return AssetResponse(
+            success=True,
+            asset_id=asset_id,
+            width=width,
+            height=height,
+            size_bytes=size_bytes
+        )
+    except Exception as e:
+        print(f"Error registering asset: {e}")
+        return AssetResponse(success=False, error=str(e))
+
+@app.post("/renders/{render_id}/reblend", response_model=ImageResponse)
+async def reblend_render(render_id: str, request: ReblendRequest, http_request: Request,
+                         user_id: Optional[str] = Header(None, alias="X-User-Id")):
+    """Re-run logo blending and composition on a kept base image"""
+    try:
+        await enforce_rate_limit(http_request, user_id, RATE_LIMIT_CPU_COST)
+    except Overloaded as e:
+        return overloaded_response(e)
+    base = base_renders.get(render_id)
+    if base is None:
+        raise HTTPException(status_code=404, detail="Render not found or expired")
+    image_bytes, enhanced_prompt, inputs = base
+    # Fall back to the logo and user photo the render was made with
+    update = {}
+    if not has_logo(request):
+        update.update(logo_base64=inputs["logo_base64"], logo_asset_id=inputs["logo_asset_id"])
+    if not request.logo_position:
+        update["logo_position"] = inputs["logo_position"]
+    if not has_user_photo(request):
+        update.update(user_photo_base64=inputs["user_photo_base64"], user_photo_asset_id=inputs["user_photo_asset_id"])
+    request = request.model_copy(update=update)
+    try:
+        for asset_id in (request.logo_asset_id, request.user_photo_asset_id):
+            if asset_id and asset_id not in asset_store:
+                return ImageResponse(success=False, error=f"Unknown asset: {asset_id}")
+        output_formats(request)
+        design, composite = await cpu_pool.run("reblend", render_design, image_bytes, request)
+        return ImageResponse(
+            success=True,
+            **encoded_fields(design, composite),
+            revised_prompt=enhanced_prompt,
+            render_id=render_id
+        )
+    except Exception as e:
+        print(f"Error reblending render: {e}")
+        return ImageResponse(success=False, error=str(e))
+
+async def peer_generate(request: ImageRequest, http_request: Request,
+                        priority: Optional[str] = Header(None, alias="X-Priority"),
+                        user_id: Optional[str] = Header(None, alias="X-User-Id"),
+                        deadline_ms: Optional[str] = Header(None, alias="X-Deadline-Ms"),
+                        peer_secret: Optional[str] = Header(None, alias="X-Peer-Secret")):
+    """Render a key this replica owns on behalf of a peer"""
+    # Not rate limited here (the forwarding replica charged its caller), so replicas only
+    if not peer_pool.allows(peer_host(http_request.scope), peer_secret):
+        raise HTTPException(status_code=403, detail="Not a peer replica")
+    peer_pool.served_for_peers += 1
+    caller = make_caller(priority, user_id, deadline_ms)
+    try:
+        # The forwarding replica drops the connection when its own caller leaves
+        return await guarded(http_request, generate_design(request, caller, from_peer=True))
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ClientDisconnected:
+        return disconnected_response()
+
+if peer_pool:
+    app.post("/peer/generate", response_model=ImageResponse)(peer_generate)
+
+async def accepted_similar(request: ImageRequest, canonical: ImageRequest) -> Optional[ImageResponse]:
+    """
+    The cached design named by similar_render_key, if it is still a near
+    duplicate of this request; None (generate as usual) otherwise
+    """
+    key = request.similar_render_key
+    scored = similar_index.score(key, similar_group(request, canonical), canonical.prompt)
+    if scored is None or scored[1] < similar_index.threshold:
+        print(f"Similar design not applicable: {key[:12]}")
+        return None
+    cached = await render_cache.get_async(key)
+    if cached is None:
+        # The render was evicted; stop offering it
+        await asyncio.to_thread(similar_index.discard, key)
+        return None
+    print(f"Similar design accepted: {key[:12]} ({scored[1]:.2f})")
+    return ImageResponse(
+        success=True,
+        similar_design=SimilarDesign(render_key=key, prompt=scored[0], similarity=scored[1]),
+        **json.loads(cached)
+    )
+
+@app.post("/similar", response_model=SimilarResponse)
+async def find_similar(request: ImageRequest, http_request: Request,
+                       user_id: Optional[str] = Header(None, alias="X-User-Id")):
+    """
+    Suggest a cached design whose request differs only in prompt wording.
+    Nothing is generated; send the suggestion's render_key back as
+    similar_render_key to get that design.
+    """
+    try:
+        await enforce_rate_limit(http_request, user_id, RATE_LIMIT_CPU_COST)
+    except Overloaded as e:
+        return overloaded_response(e, SimilarResponse)
+    if similar_index is None:
+        return SimilarResponse(success=True)
+    try:
+        canonical = canonical_request(request)
+        cache_key = render_cache_key(request, canonical)
+        # Pure-Python MinHash: a few ms, more with crowded buckets
+        match = await asyncio.to_thread(
+            similar_index.query, similar_group(request, canonical), canonical.prompt, cache_key
+        )
+        if match is None:
+            return SimilarResponse(success=True)
+        key, prompt, similarity = match
+        if key not in render_cache:
+            await asyncio.to_thread(similar_index.discard, key)
+            return SimilarResponse(success=True)
+        return SimilarResponse(
+            success=True,
+            similar_design=SimilarDesign(render_key=key, prompt=prompt, similarity=similarity)
+        )
+    except Exception as e:
+        print(f"Error finding similar design: {e}")
+        return SimilarResponse(success=False, error=str(e))
+
+async def generate_design(request: ImageRequest, caller: Caller = Caller(), from_peer: bool = False) -> ImageResponse:
+    """Cache lookups, then a (coalesced) render from the owner replica or upstream"""
+    try:
+        if not upstream.api_key:
+            raise HTTPException(status_code=500, detail="API key not configured")
         
-        # Convert generated image to PIL Image
-        generated_image = Image.open(io.BytesIO(images[0]))
+        for asset_id in (request.logo_asset_id, request.user_photo_asset_id):
+            if asset_id and asset_id not in asset_store:
+                return ImageResponse(success=False, error=f"Unknown asset: {asset_id}")
+        output_formats(request)
         
-        # Process logo if provided - blend it onto the design
-        design_with_logo = generated_image
-        if request.logo_base64:
-            try:
-                logo_image = decode_base64_image(request.logo_base64)
-                design_with_logo = blend_logo_on_design(
-                    generated_image, 
-                    logo_image, 
-                    request.logo_position or "center"
-                )
-                print(f"Logo blended successfully at position: {request.logo_position}")
-            except Exception as e:
-                print(f"Warning: Could not blend logo: {e}")
-                design_with_logo = generated_image
+        enhanced_prompt = build_enhanced_prompt(request)
+        canonical = canonical_request(request)
+        cache_key = render_cache_key(request, canonical)
         
-        # Encode the design (with logo if applied)
-        design_base64 = encode_image_to_base64(design_with_logo.convert('RGB'), "PNG")
+        # Serve identical renders from the cache instead of calling upstream
+        if render_cache:
+            cached = await render_cache.get_async(cache_key)
+            if cached is not None:
+                print(f"Render cache hit: {cache_key[:12]}")
+                return ImageResponse(success=True, **json.loads(cached))
+            
+            # A near-duplicate the caller accepted from /similar
+            if similar_index is not None and request.similar_render_key:
+                accepted = await accepted_similar(request, canonical)
+                if accepted is not None:
+                    return accepted
         
-        # Create composite with user photo if provided
-        composite_base64 = ""
-        if request.user_photo_base64:
-            try:
-                user_photo = decode_base64_image(request.user_photo_base64)
-                composite_image = create_composite_with_user_photo(design_with_logo, user_photo)
-                composite_base64 = encode_image_to_base64(composite_image, "PNG")
-                print("Composite image with user photo created successfully")
-            except Exception as e:
-                print(f"Warning: Could not create composite with user photo: {e}")
+        # Fail fast if the upstream recently refused the same prompt
+        reject_key = rejection_key(canonical)
+        if rejection_cache:
+            reason = rejection_cache.check(reject_key)
+            if reason is not None:
+                print(f"Rejected prompt short-circuited: {reject_key[:12]}")
+                return ImageResponse(success=False, rejected=True, error=reason)
         
-        return ImageResponse(
-            success=True,
-            image_base64=design_base64,
-            composite_image_base64=composite_base64,
-            revised_prompt=enhanced_prompt
-        )
+        # Coalesce with an identical request already being generated
+        return await render_coalesced(request, canonical, enhanced_prompt, cache_key, reject_key, caller, from_peer)
             
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"Error generating image: {e}")
         return ImageResponse(
@@ -246,5 +1520,34 @@ Style: High-end fashion catalog photography, clean white/light gray background,
         )
 
 if __name__ == "__main__":
+    import signal
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8002)
+    from listeners import Listeners
+    # One process per instance: base renders for reblend, Idempotency-Key
+    # replays, request coalescing and the similar-prompt index log are
+    # process-local, so a second uvicorn worker would answer 404s, render
+    # twice and drop index entries. Run more instances instead (PEERS, and
+    # the same JOB_QUEUE_DB but their own IMAGE_CACHE_DIR).
+    if int(os.environ.get('IMAGE_GENERATOR_WORKERS', '1')) > 1:
+        sys.exit("IMAGE_GENERATOR_WORKERS > 1 is not supported; run more instances instead")
+    # IMAGE_GENERATOR_UDS serves on a Unix domain socket as well (the Node
+    # backend on the same host), or instead of TCP with IMAGE_GENERATOR_TCP=0.
+    # The socket file gets IMAGE_GENERATOR_UDS_MODE (octal) and, if set,
+    # IMAGE_GENERATOR_UDS_GROUP so only that group can connect.
+    listeners = Listeners(
+        host=os.environ.get('IMAGE_GENERATOR_HOST', '0.0.0.0') if os.environ.get('IMAGE_GENERATOR_TCP', '1') == '1' else None,
+        port=int(os.environ.get('IMAGE_GENERATOR_PORT', '8002')),
+        uds_path=os.environ.get('IMAGE_GENERATOR_UDS') or None,
+        uds_mode=int(os.environ.get('IMAGE_GENERATOR_UDS_MODE', '660'), 8),
+        uds_group=os.environ.get('IMAGE_GENERATOR_UDS_GROUP') or None,
+    )
+    print(f"Image generator listening on {listeners.describe()}")
+    # uvicorn re-raises the SIGTERM it handled once shut down; exit via the finally below instead
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        uvicorn.Server(uvicorn.Config(app)).run(sockets=listeners.sockets)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listeners.close()
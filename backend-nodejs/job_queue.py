@@ -0,0 +1,317 @@
+"""
+Durable generation job queue on SQLite (WAL mode)
+
+Jobs submitted through POST /jobs are written to a local database before
+the caller gets the job ID, so they survive a restart of the service. Any
+number of processes sharing the database file run worker loops that claim
+queued jobs under a lease, renew it while they work and store the result
+for pickup. A job whose lease runs out (its worker crashed or was killed)
+is claimed again by another worker, up to `max_attempts` times.
+
+Stage transitions are written to the job row; event streams poll for them.
+All database work runs in threads: `claim` can hold the lock through a
+busy BEGIN IMMEDIATE for the whole connection timeout, so a write on the
+event loop could stall every request. Stage writes are queued per job and
+applied in order in the background. Finished jobs are deleted `ttl`
+seconds after they complete.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from jobs import DONE, FAILED, QUEUED, bind_job, sse_event
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    stages TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (stage, created_at);
+"""
+
+
+class DurableJob:
+    """Handle a worker binds to the running job so pipeline stages are persisted"""
+
+    def __init__(self, queue: "DurableJobQueue", job_id: str, worker_id: str):
+        self.queue = queue
+        self.id = job_id
+        self.worker_id = worker_id
+        self._writes: Optional[asyncio.Future] = None  # the latest queued stage write
+
+    def set_stage(self, stage: str):
+        """Record the stage in the background, after the writes queued before it"""
+        self._writes = asyncio.ensure_future(self._write(self._writes, stage, time.time()))
+
+    async def _write(self, previous: Optional[asyncio.Future], stage: str, at: float):
+        if previous is not None:
+            await previous
+        try:
+            await asyncio.to_thread(self.queue.set_stage, self.id, self.worker_id, stage, at)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not record stage {stage} of job {self.id}: {e}")
+
+    async def flush(self):
+        """Wait for the queued stage writes"""
+        if self._writes is not None:
+            await self._writes
+
+
+class DurableJobQueue:
+    def __init__(self, path: str, lease_seconds: float = 60.0, max_attempts: int = 3, ttl: float = 900.0):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.enqueued = 0
+        self.claimed = 0
+        self.recovered = 0
+        self.completed = 0
+        self.failed = 0
+        self.lost_leases = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # Connections must not cross a fork (the CPU pool may fork workers)
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def enqueue(self, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO jobs (id, payload, stage, stages, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, json.dumps(payload), QUEUED, json.dumps([{"stage": QUEUED, "at_ms": 0.0}]), time.time())
+            )
+        self.enqueued += 1
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[tuple]:
+        """Lease the oldest claimable job; returns (job_id, payload) or None"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs whose worker died before finishing: retry or give up
+                for row in db.execute(
+                    "SELECT id, attempts FROM jobs WHERE lease_expires < ? AND stage NOT IN (?, ?)",
+                    (now, DONE, FAILED)
+                ).fetchall():
+                    self.recovered += 1
+                    if row["attempts"] >= self.max_attempts:
+                        self._finish(db, row["id"], None, f"Abandoned after {row['attempts']} attempts", now)
+                    else:
+                        db.execute(
+                            "UPDATE jobs SET stage = ?, lease_owner = NULL, lease_expires = NULL WHERE id = ?",
+                            (QUEUED, row["id"])
+                        )
+                row = db.execute(
+                    "SELECT id, payload FROM jobs WHERE stage = ? AND lease_owner IS NULL ORDER BY created_at LIMIT 1",
+                    (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE jobs SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                        (worker_id, now + self.lease_seconds, row["id"])
+                    )
+                    self.claimed += 1
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return (row["id"], json.loads(row["payload"])) if row is not None else None
+
+    def renew(self, job_id: str, worker_id: str) -> bool:
+        """Extend the lease; False if another worker has taken the job over"""
+        with self._lock:
+            cursor = self._db().execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ?",
+                (time.time() + self.lease_seconds, job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def set_stage(self, job_id: str, worker_id: str, stage: str, at: Optional[float] = None):
+        at = time.time() if at is None else at
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT stages, created_at FROM jobs WHERE id = ? AND lease_owner = ?", (job_id, worker_id)
+            ).fetchone()
+            if row is None:
+                return
+            stages = json.loads(row["stages"])
+            stages.append({"stage": stage, "at_ms": round((at - row["created_at"]) * 1000, 2)})
+            db.execute(
+                "UPDATE jobs SET stage = ?, stages = ?, lease_expires = ? WHERE id = ? AND lease_owner = ?",
+                (stage, json.dumps(stages), time.time() + self.lease_seconds, job_id, worker_id)
+            )
+
+    def _finish(self, db: sqlite3.Connection, job_id: str, result: Optional[str], error: str, now: float,
+                worker_id: Optional[str] = None) -> bool:
+        stage = FAILED if error else DONE
+        row = db.execute("SELECT stages, created_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        stages = json.loads(row["stages"])
+        stages.append({"stage": stage, "at_ms": round((now - row["created_at"]) * 1000, 2)})
+        query = ("UPDATE jobs SET stage = ?, stages = ?, result = ?, error = ?, finished_at = ?,"
+                 " lease_owner = NULL, lease_expires = NULL WHERE id = ?")
+        params = [stage, json.dumps(stages), result, error, now, job_id]
+        if worker_id is not None:
+            query += " AND lease_owner = ?"
+            params.append(worker_id)
+        if db.execute(query, params).rowcount != 1:
+            return False
+        if error:
+            self.failed += 1
+        else:
+            self.completed += 1
+        return True
+
+    def complete(self, job_id: str, worker_id: str, result: Optional[str], error: str = "") -> bool:
+        """Store the outcome; False if the lease was lost and another worker owns the job"""
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                stored = self._finish(db, job_id, result, error, time.time(), worker_id)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if not stored:
+            self.lost_leases += 1
+        return stored
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT id, stage, stages, attempts, result, error FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "stage": row["stage"],
+            "stages": json.loads(row["stages"]),
+            "attempts": row["attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+        }
+
+    def purge(self) -> int:
+        """Delete jobs that finished more than `ttl` seconds ago"""
+        with self._lock:
+            cursor = self._db().execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (time.time() - self.ttl,)
+            )
+        return cursor.rowcount
+
+    async def work(self, handler: Callable[[dict], Awaitable[tuple]], worker_id: str, poll_interval: float = 0.5):
+        """
+        Claim and run jobs forever. `handler(payload)` returns
+        (result_json, error); the lease is renewed while it runs. A database
+        error (e.g. "database is locked") is logged and the loop goes on; a
+        job whose outcome could not be stored is claimed again once its
+        lease runs out.
+        """
+        while True:
+            try:
+                ran = await self._work_once(handler, worker_id)
+            except sqlite3.Error as e:
+                print(f"Warning: Job worker {worker_id} hit a database error: {e}")
+                ran = False
+            if not ran:
+                await asyncio.sleep(poll_interval)
+
+    async def _work_once(self, handler: Callable[[dict], Awaitable[tuple]], worker_id: str) -> bool:
+        """Claim and run one job; False when there was none"""
+        if time.monotonic() - self._last_purge > 60:
+            self._last_purge = time.monotonic()
+            await asyncio.to_thread(self.purge)
+        claimed = await asyncio.to_thread(self.claim, worker_id)
+        if claimed is None:
+            return False
+        job_id, payload = claimed
+        renewer = asyncio.create_task(self._keep_leased(job_id, worker_id))
+        job = DurableJob(self, job_id, worker_id)
+        try:
+            bind_job(job)
+            result, error = await handler(payload)
+        except Exception as e:
+            result, error = None, str(e)
+        finally:
+            renewer.cancel()
+            bind_job(None)
+        # Land the stage writes before the final stage
+        await job.flush()
+        await asyncio.to_thread(self.complete, job_id, worker_id, result, error)
+        return True
+
+    async def _keep_leased(self, job_id: str, worker_id: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                renewed = await asyncio.to_thread(self.renew, job_id, worker_id)
+            except sqlite3.Error as e:
+                print(f"Warning: Could not renew the lease on job {job_id}: {e}")
+                continue
+            if not renewed:
+                print(f"Warning: Lost lease on job {job_id}")
+                return
+
+    async def events(self, job_id: str, poll_interval: float = 0.5, keepalive: float = 15.0) -> AsyncIterator[str]:
+        """Server-sent stage transitions, polled from the database"""
+        last_stage, last_sent = None, time.monotonic()
+        while True:
+            job = await asyncio.to_thread(self.get, job_id)
+            if job is None:
+                return
+            if job["stage"] != last_stage:
+                last_stage, last_sent = job["stage"], time.monotonic()
+                yield sse_event({"job_id": job_id, "stage": job["stage"], "error": job["error"]})
+                if job["stage"] in (DONE, FAILED):
+                    return
+            elif time.monotonic() - last_sent >= keepalive:
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
+            await asyncio.sleep(poll_interval)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._db().execute("SELECT stage, COUNT(*) FROM jobs GROUP BY stage").fetchall())
+        return {
+            "path": self.path,
+            "stages": counts,
+            "enqueued": self.enqueued,
+            "claimed": self.claimed,
+            "recovered": self.recovered,
+            "completed": self.completed,
+            "failed": self.failed,
+            "lost_leases": self.lost_leases,
+        }
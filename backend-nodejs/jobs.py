@@ -0,0 +1,189 @@
+"""
+Asynchronous generation jobs
+
+POST /jobs starts a generation in the background and returns a job ID at
+once; the caller polls GET /jobs/{id} or follows its stage transitions
+(queued, generating, blending, compositing, done) as server-sent events
+instead of holding a connection open for the whole generation.
+
+The pipeline reports stages through `report_stage`, which finds the job
+running in the current context; calls outside a job are no-ops. A job that
+joins a render already in flight elsewhere goes from queued to done.
+Finished jobs expire after a TTL and are bounded by total result size.
+This store is in-process; job_queue.py keeps jobs in SQLite instead.
+"""
+import asyncio
+import contextvars
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+QUEUED = "queued"
+GENERATING = "generating"
+BLENDING = "blending"
+COMPOSITING = "compositing"
+DONE = "done"
+FAILED = "failed"
+
+_current_job = contextvars.ContextVar('current_job', default=None)
+
+
+def bind_job(job):
+    """Make `job` (anything with set_stage) the job running in this context"""
+    _current_job.set(job)
+
+
+def sse_event(event: dict) -> str:
+    return f"event: stage\ndata: {json.dumps(event)}\n\n"
+
+
+def report_stage(stage: str):
+    """Move the job running in this context (if any) to a new stage"""
+    job = _current_job.get()
+    if job is not None:
+        job.set_stage(stage)
+
+
+class Job:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.stage = QUEUED
+        self.created_at = time.time()
+        self.finished_at = None
+        self.result = None
+        self.error = ""
+        self.expires_at = None  # monotonic, set when finished
+        self.size = 0
+        self.task = None
+        self._started = time.monotonic()
+        self.stages = [(QUEUED, 0.0)]  # (stage, ms since submission)
+        self._subscribers = []  # asyncio.Queue per open event stream
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in (DONE, FAILED)
+
+    def set_stage(self, stage: str):
+        if self.finished or stage == self.stage:
+            return
+        self.stage = stage
+        self.stages.append((stage, round((time.monotonic() - self._started) * 1000, 2)))
+        event = self.event()
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    def event(self) -> dict:
+        return {"job_id": self.id, "stage": self.stage, "error": self.error}
+
+    def timings(self) -> list:
+        return [{"stage": stage, "at_ms": at} for stage, at in self.stages]
+
+
+class JobStore:
+    def __init__(self, ttl: float, max_bytes: int, max_jobs: int,
+                 sizeof: Callable[[object], int], succeeded: Callable[[object], bool] = lambda result: True):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_jobs = max_jobs
+        self.sizeof = sizeof
+        self.succeeded = succeeded
+        self.current_bytes = 0
+        self._jobs = OrderedDict()  # job_id -> Job, oldest first
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.refused = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def _drop(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self.current_bytes -= job.size
+
+    def _purge(self, room: int = 0):
+        now = time.monotonic()
+        for job_id in [i for i, j in self._jobs.items() if j.expires_at is not None and j.expires_at <= now]:
+            self._drop(job_id)
+            self.expired += 1
+        # Over budget: evict the oldest finished jobs
+        for job_id in list(self._jobs):
+            if self.current_bytes <= self.max_bytes and len(self._jobs) + room <= self.max_jobs:
+                break
+            if self._jobs[job_id].finished:
+                self._drop(job_id)
+                self.evictions += 1
+
+    async def _run(self, job: Job, fn: Callable[[], Awaitable]):
+        bind_job(job)
+        try:
+            job.result = await fn()
+            if not self.succeeded(job.result):
+                job.error = getattr(job.result, 'error', '') or "Generation failed"
+        except Exception as e:
+            job.error = str(e)
+        if job.error:
+            self.failed += 1
+        else:
+            self.completed += 1
+        job.finished_at = time.time()
+        job.expires_at = time.monotonic() + self.ttl
+        job.set_stage(FAILED if job.error else DONE)
+        if self._jobs.get(job.id) is job:
+            job.size = self.sizeof(job.result) if job.result is not None else 0
+            self.current_bytes += job.size
+        self._purge()
+
+    def submit(self, fn: Callable[[], Awaitable]) -> Optional[Job]:
+        """Start fn() as a job; None when the store is full of unfinished jobs"""
+        self._purge(room=1)
+        if len(self._jobs) >= self.max_jobs:
+            self.refused += 1
+            return None
+        job = Job(uuid.uuid4().hex)
+        self._jobs[job.id] = job
+        job.task = asyncio.ensure_future(self._run(job, fn))
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._purge()
+        return self._jobs.get(job_id)
+
+    async def events(self, job: Job, keepalive: float = 15.0) -> AsyncIterator[str]:
+        """Server-sent events for the job's stage transitions, ending after done/failed"""
+        queue = asyncio.Queue()
+        job._subscribers.append(queue)
+        try:
+            event = job.event()
+            while True:
+                yield sse_event(event)
+                if event["stage"] in (DONE, FAILED):
+                    return
+                while True:
+                    try:
+                        event = await asyncio.wait_for(queue.get(), keepalive)
+                        break
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+        finally:
+            job._subscribers.remove(queue)
+
+    def stats(self) -> dict:
+        self._purge()
+        return {
+            "jobs": len(self._jobs),
+            "running": sum(1 for job in self._jobs.values() if not job.finished),
+            "bytes": self.current_bytes,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "refused": self.refused,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
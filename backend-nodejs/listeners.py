@@ -0,0 +1,113 @@
+"""
+Listening sockets for the image service: TCP, a Unix domain socket, or both
+
+The Node backend runs on the same host, so it can reach the service over a
+Unix domain socket instead of loopback TCP. The sockets are bound here
+and handed to uvicorn, so one process serves both at once.
+
+The socket file is created with `mode` applied (and `group` if given)
+before anything can connect. At startup a leftover file from a crashed
+run is removed, but only if it is a socket and nothing answers on it. At
+exit the file is removed unless another instance has replaced it.
+Requests arriving over the Unix socket have no client address; `peer_host`
+reports them as UNIX_PEER so they can be trusted like a local proxy.
+"""
+import os
+import socket
+import stat
+from typing import List, Optional
+
+UNIX_PEER = "unix"
+
+
+def peer_host(scope: dict) -> Optional[str]:
+    """Client host of an ASGI request, or UNIX_PEER when it came over a Unix socket"""
+    client = scope.get("client")
+    if client:
+        return client[0]
+    server = scope.get("server")
+    if server and server[1] is None:
+        return UNIX_PEER
+    return None
+
+
+def remove_stale_socket(path: str):
+    """Remove a socket file left behind by a previous run; refuse to touch anything else"""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise RuntimeError(f"{path} exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise RuntimeError(f"Another server is already listening on {path}")
+
+
+def bind_unix(path: str, mode: int = 0o660, group: Optional[str] = None, backlog: int = 2048) -> socket.socket:
+    remove_stale_socket(path)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The umask makes the file start out with `mode`, so it is never briefly open to everyone
+    previous_umask = os.umask(0o777 & ~mode)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(previous_umask)
+    if group:
+        import grp
+        os.chown(path, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(path, mode)
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def bind_tcp(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Listeners:
+    """The sockets to serve on, and cleanup of the Unix socket file"""
+
+    def __init__(self, host: Optional[str], port: int, uds_path: Optional[str] = None,
+                 uds_mode: int = 0o660, uds_group: Optional[str] = None):
+        if host is None and not uds_path:
+            raise ValueError("Nothing to listen on: enable TCP or set a Unix socket path")
+        self.sockets: List[socket.socket] = []
+        self.uds_path = uds_path
+        self._uds_inode = None
+        if host is not None:
+            self.sockets.append(bind_tcp(host, port))
+        if uds_path:
+            self.sockets.append(bind_unix(uds_path, uds_mode, uds_group))
+            self._uds_inode = os.stat(uds_path).st_ino
+
+    def describe(self) -> str:
+        return ", ".join(
+            f"unix:{self.uds_path}" if sock.family == socket.AF_UNIX else "http://%s:%d" % sock.getsockname()[:2]
+            for sock in self.sockets
+        )
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        if self.uds_path:
+            try:
+                if os.stat(self.uds_path).st_ino == self._uds_inode:
+                    os.unlink(self.uds_path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,185 @@
+"""
+Replica-shared render cache (groupcache style)
+
+Every canonical render key has one owner replica, chosen by consistent
+hashing over a static peer list. Non-owners forward the request to the
+owner on /peer/generate, which serves it from its cache or generates it
+once (its own single-flight coalesces concurrent forwards) and never
+forwards again. Peers that cannot be reached are skipped for a cooldown
+and the key falls through to the next replica on the ring, ending with
+local generation. An owner refusing for lack of capacity or time (429,
+503, 504) is not down: the refusal goes back to the caller as Overloaded,
+rather than every replica falling back to its own upstream call.
+
+/peer/generate skips the rate limit (the forwarding replica charged the
+caller), so only replicas may call it: holders of the shared secret, or
+without one, hosts in the peer list.
+"""
+import bisect
+import hashlib
+import hmac
+import socket
+import time
+from typing import Iterable, List, Optional
+from urllib.parse import urlparse
+
+from admission import Overloaded
+
+# Owner responses that mean "no capacity/time for this", passed on to the caller
+OVERLOADED_STATUSES = (429, 503, 504)
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes"""
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = 100):
+        self.nodes = sorted(set(nodes))
+        self._points = []
+        self._owners = []
+        ring = sorted(
+            (_ring_hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(vnodes)
+        )
+        for point, node in ring:
+            self._points.append(point)
+            self._owners.append(node)
+
+    def preference_list(self, key: str) -> List[str]:
+        """Distinct nodes in ring order starting from the key's owner"""
+        if not self._points:
+            return []
+        start = bisect.bisect(self._points, _ring_hash(key)) % len(self._points)
+        seen = []
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in seen:
+                seen.append(node)
+                if len(seen) == len(self.nodes):
+                    break
+        return seen
+
+
+class PeerPool:
+    """
+    Routes keys to their owning replica and fetches results from it over
+    HTTP. `self_url` must appear in `peers` exactly as the others see it.
+    """
+
+    def __init__(self, self_url: str, peers: Iterable[str], vnodes: int = 100,
+                 timeout: float = 180.0, retry_after: float = 30.0, secret: str = ""):
+        self.self_url = self_url.rstrip('/')
+        self.ring = HashRing([p.rstrip('/') for p in peers] + [self.self_url], vnodes)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.secret = secret
+        self.peer_hosts = self._resolve_hosts(self.ring.nodes) if not secret else set()
+        self._down_until = {}  # peer -> monotonic time it may be retried
+        self._client = None
+        self.forwarded = 0
+        self.peer_hits = 0
+        self.peer_failures = 0
+        self.peer_refusals = 0
+        self.served_for_peers = 0
+        self.refused_callers = 0
+
+    @staticmethod
+    def _resolve_hosts(urls: Iterable[str]) -> set:
+        """Host names of the peer URLs and the addresses they resolve to"""
+        hosts = set()
+        for url in urls:
+            hostname = urlparse(url).hostname
+            if not hostname:
+                continue
+            hosts.add(hostname)
+            try:
+                hosts.update(info[4][0] for info in socket.getaddrinfo(hostname, None))
+            except OSError as e:
+                print(f"Warning: Could not resolve peer {hostname}: {e}")
+        return hosts
+
+    def allows(self, client_host: Optional[str], secret: Optional[str]) -> bool:
+        """Whether a /peer/generate caller is one of the replicas"""
+        if self.secret:
+            allowed = bool(secret) and hmac.compare_digest(secret.encode('utf-8'), self.secret.encode('utf-8'))
+        else:
+            allowed = client_host in self.peer_hosts
+        if not allowed:
+            self.refused_callers += 1
+        return allowed
+
+    def owner(self, key: str) -> Optional[str]:
+        """The first healthy replica for key, or None when that is this one"""
+        now = time.monotonic()
+        for node in self.ring.preference_list(key):
+            if node == self.self_url:
+                return None
+            if self._down_until.get(node, 0) <= now:
+                return node
+        return None
+
+    def _get_client(self):
+        if self._client is None:
+            import httpx
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    async def fetch(self, peer: str, body: dict, headers: Optional[dict] = None) -> Optional[dict]:
+        """
+        POST the request to the owner. None if it is unreachable (and then
+        skipped for a cooldown) or answered with another error; raises
+        Overloaded when the owner refuses for lack of capacity or time.
+        """
+        self.forwarded += 1
+        if self.secret:
+            headers = {**(headers or {}), "X-Peer-Secret": self.secret}
+        try:
+            response = await self._get_client().post(f"{peer}/peer/generate", json=body, headers=headers)
+        except Exception as e:
+            self.peer_failures += 1
+            self._down_until[peer] = time.monotonic() + self.retry_after
+            print(f"Warning: Peer {peer} unavailable, generating locally: {e}")
+            return None
+        if response.status_code in OVERLOADED_STATUSES:
+            self.peer_refusals += 1
+            try:
+                message = response.json().get("error") or response.reason_phrase
+            except ValueError:
+                message = response.reason_phrase
+            try:
+                retry_after = int(response.headers.get("Retry-After", "1"))
+            except ValueError:
+                retry_after = 1
+            raise Overloaded(message, response.status_code, retry_after)
+        try:
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            self.peer_failures += 1
+            print(f"Warning: Peer {peer} failed, generating locally: {e}")
+            return None
+        self.peer_hits += 1
+        return data
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "self": self.self_url,
+            "peers": self.ring.nodes,
+            "down": [p for p, until in self._down_until.items() if until > now],
+            "forwarded": self.forwarded,
+            "peer_hits": self.peer_hits,
+            "peer_failures": self.peer_failures,
+            "peer_refusals": self.peer_refusals,
+            "served_for_peers": self.served_for_peers,
+            "refused_callers": self.refused_callers,
+        }
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Arabic/English-aware text canonicalization for cache keys
+
+Only used to build keys: the original text is still what gets sent
+upstream. Run as a script to replay a corpus and compare exact-match vs
+canonical cache hit rates:
+
+    python prompt_canon.py requests.jsonl
+"""
+import json
+import re
+import sys
+import unicodedata
+from typing import Iterable
+
+# Tashkeel (harakat, tanween, shadda, sukun, dagger alef) and Quranic marks
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]')
+TATWEEL = '\u0640'
+
+CHAR_MAP = str.maketrans({
+    # Alef variants -> bare alef
+    '\u0623': '\u0627',  # أ
+    '\u0625': '\u0627',  # إ
+    '\u0622': '\u0627',  # آ
+    '\u0671': '\u0627',  # ٱ
+    # Hamza carriers -> base letter
+    '\u0624': '\u0648',  # ؤ -> و
+    '\u0626': '\u064a',  # ئ -> ي
+    # Alef maqsura -> ya, teh marbuta -> heh
+    '\u0649': '\u064a',  # ى -> ي
+    '\u0629': '\u0647',  # ة -> ه
+    # Arabic punctuation -> ASCII
+    '\u060c': ',',  # ،
+    '\u061b': ';',  # ؛
+    '\u061f': '?',  # ؟
+    # Eastern Arabic and Persian digits -> ASCII
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(0x06f0 + i): str(i) for i in range(10)},
+})
+
+WHITESPACE = re.compile(r'\s+')
+SPACE_BEFORE_PUNCT = re.compile(r'\s+([,.;:!?])')
+
+
+def canonicalize_text(text: str) -> str:
+    """Fold a free-text field into a stable form for cache keys"""
+    if not text:
+        return ""
+    text = unicodedata.normalize('NFKC', text)
+    text = ARABIC_DIACRITICS.sub('', text).replace(TATWEEL, '')
+    text = text.translate(CHAR_MAP).casefold()
+    text = WHITESPACE.sub(' ', text).strip()
+    return SPACE_BEFORE_PUNCT.sub(r'\1', text)
+
+
+def replay_hit_rates(records: Iterable[dict], fields=("prompt", "clothing_type", "color")) -> dict:
+    """
+    Replay request records through an unbounded cache twice - keyed on the
+    raw fields and on the canonicalized fields - and report both hit rates.
+    """
+    raw_seen, canonical_seen = set(), set()
+    total = raw_hits = canonical_hits = 0
+    for record in records:
+        total += 1
+        raw_key = tuple(record.get(f) or "" for f in fields)
+        canonical_key = tuple(canonicalize_text(v) for v in raw_key)
+        if raw_key in raw_seen:
+            raw_hits += 1
+        raw_seen.add(raw_key)
+        if canonical_key in canonical_seen:
+            canonical_hits += 1
+        canonical_seen.add(canonical_key)
+    raw_rate = raw_hits / total if total else 0.0
+    canonical_rate = canonical_hits / total if total else 0.0
+    return {
+        "requests": total,
+        "exact_hits": raw_hits,
+        "exact_hit_rate": round(raw_rate, 4),
+        "canonical_hits": canonical_hits,
+        "canonical_hit_rate": round(canonical_rate, 4),
+        "hit_rate_gain": round(canonical_rate - raw_rate, 4),
+        "distinct_exact_keys": len(raw_seen),
+        "distinct_canonical_keys": len(canonical_seen),
+    }
+
+
+def load_corpus(path: str):
+    """Read a JSONL corpus of ImageRequest bodies (plain-text lines are treated as prompts)"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = line
+            yield record if isinstance(record, dict) else {"prompt": str(record)}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python prompt_canon.py <corpus.jsonl>")
+        sys.exit(1)
+    print(json.dumps(replay_hit_rates(load_corpus(sys.argv[1])), indent=2))
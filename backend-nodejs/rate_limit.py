@@ -0,0 +1,194 @@
+"""
+Per-caller token-bucket rate limiting
+
+Each caller (forwarded user ID, API key or client IP) has a bucket of
+`burst` tokens refilled at `rate` tokens per second; a request spends
+`cost` tokens or is refused with `RateLimited` (429 + Retry-After).
+
+`LocalBucketStore` keeps buckets in process: one dict entry per caller,
+O(1) per request, ordered by last use so buckets idle long enough to be
+full again (indistinguishable from a new bucket) are evicted from the
+front. `RedisBucketStore` shares buckets between replicas with an atomic
+Lua script; any object with the same `async take(key, cost)` can stand in
+for it. When the shared store fails, the local store is used instead.
+"""
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+from admission import Overloaded
+
+
+class RateLimited(Overloaded):
+    """The caller spent its tokens; maps to a 429 with Retry-After"""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Too many image requests, slow down", 429, max(1, math.ceil(retry_after)))
+
+
+def _positive_rate(rate: float) -> float:
+    """Refill rate (tokens/s); without refill a caller would be refused for good"""
+    if rate <= 0:
+        raise ValueError("Rate limit refill rate must be positive")
+    return rate
+
+
+class LocalBucketStore:
+    def __init__(self, burst: float, rate: float, max_keys: int = 100000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.burst = burst
+        self.rate = _positive_rate(rate)
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at], least recently used first
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _evict(self, now: float):
+        full_after = self.burst / self.rate
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < full_after and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+            self.evictions += 1
+
+    def take_now(self, key: str, cost: float = 1.0) -> float:
+        """Spend `cost` tokens; returns 0 if allowed, else seconds until it would be"""
+        now = self.clock()
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        self._buckets[key] = bucket
+        self._evict(now)
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / self.rate
+
+    async def take(self, key: str, cost: float = 1.0) -> float:
+        return self.take_now(key, cost)
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets), "evictions": self.evictions}
+
+
+# KEYS[1] bucket; ARGV burst, rate (tokens/s), cost. Uses the Redis clock so
+# replicas agree, and expires the key once the bucket would be full again.
+_TAKE_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBucketStore:
+    """Buckets shared by every replica using the same Redis (redis-py, imported lazily)"""
+
+    def __init__(self, url: str, burst: float, rate: float, prefix: str = "image-rate:"):
+        self.url = url
+        self.burst = burst
+        self.rate = _positive_rate(rate)
+        self.prefix = prefix
+        self._client = None
+        self._script = None
+
+    async def take(self, key: str, cost: float = 1.0) -> float:
+        if self._client is None:
+            import redis.asyncio as redis
+            self._client = redis.from_url(self.url)
+            self._script = self._client.register_script(_TAKE_SCRIPT)
+        wait = await self._script(keys=[self.prefix + key], args=[self.burst, self.rate, cost])
+        return float(wait)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {"url": self.url}
+
+
+def client_identity(client_host: Optional[str], user_id: Optional[str] = None, api_key: Optional[str] = None,
+                    trusted_proxies: Iterable[str] = ()) -> str:
+    """
+    Who a request is for: the forwarded user when it comes from a trusted
+    proxy, else its API key (hashed) or client address
+    """
+    if user_id and client_host in trusted_proxies:
+        return f"user:{user_id}"
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]
+    return f"ip:{client_host or 'unknown'}"
+
+
+class RateLimiter:
+    """
+    Identifies the caller and charges its bucket. X-User-Id is only
+    trusted from `trusted_proxies` (the Node service); anyone else is keyed
+    by API key or client IP so rotating user IDs cannot dodge the limit.
+    """
+
+    def __init__(self, store, fallback: Optional[LocalBucketStore] = None, trusted_proxies: Iterable[str] = ()):
+        self.store = store
+        self.fallback = fallback
+        self.trusted_proxies = set(trusted_proxies)
+        self.allowed = 0
+        self.limited = 0
+        self.store_errors = 0
+
+    def identity(self, client_host: Optional[str], user_id: Optional[str] = None, api_key: Optional[str] = None) -> str:
+        return client_identity(client_host, user_id, api_key, self.trusted_proxies)
+
+    async def check(self, identity: str, cost: float = 1.0):
+        """Charge the caller's bucket or raise RateLimited"""
+        try:
+            wait = await self.store.take(identity, cost)
+        except Exception as e:
+            if self.fallback is None or self.fallback is self.store:
+                raise
+            self.store_errors += 1
+            print(f"Warning: Shared rate limit store failed, limiting locally: {e}")
+            wait = self.fallback.take_now(identity, cost)
+        if wait > 0:
+            self.limited += 1
+            raise RateLimited(wait)
+        self.allowed += 1
+
+    async def close(self):
+        await self.store.close()
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "store_errors": self.store_errors,
+            "store": self.store.stats(),
+            "local": self.fallback.stats() if self.fallback is not None and self.fallback is not self.store else None,
+        }
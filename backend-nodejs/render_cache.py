@@ -0,0 +1,451 @@
+"""
+Content-addressed caches for rendered designs and decoded logos
+
+Render results use two tiers: an in-process LRU bounded by total bytes,
+backed by a directory on disk that survives restarts. Values are opaque
+bytes (the serialized generation result); keys are hex digests of the
+normalized request. Disk reads and writes are multi-MB file operations,
+so code on the event loop uses `get_async`/`put_async`, which hand the
+disk tier to a worker thread. Logos are cached decoded, in memory only.
+Small per-key state (e.g. upstream rejections) lives in TTL-bounded maps.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+def make_cache_key(parts: dict) -> str:
+    """Hash a dict of request fields into a stable hex key"""
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def digest_payload(base64_str: Optional[str]) -> str:
+    """Hash a base64 image payload, ignoring any data URL prefix and whitespace"""
+    if not base64_str:
+        return ""
+    if ',' in base64_str:
+        base64_str = base64_str.split(',', 1)[1]
+    return hashlib.sha256("".join(base64_str.split()).encode('ascii', 'ignore')).hexdigest()
+
+
+class ByteLRU:
+    """
+    LRU mapping bounded by the total size of its values rather than the
+    number of entries. `sizeof` computes the size charged for a value.
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[object], int] = len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size: Optional[int] = None) -> int:
+        """Insert a value; returns how many entries were evicted to make room"""
+        size = self.sizeof(value) if size is None else size
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            if size > self.max_bytes:
+                # Never cache something bigger than the whole budget
+                return 0
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            evicted = 0
+            while self.current_bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.current_bytes -= old_size
+                evicted += 1
+            self.evictions += evicted
+            return evicted
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self.current_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+class DiskTier:
+    """
+    Directory of `<key>.bin` files bounded by total bytes. Recency is
+    tracked in memory and seeded from file mtimes on startup.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+        self._index = OrderedDict()  # key -> size, oldest first
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.bin'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.current_bytes += size
+        self._evict()
+
+    def _evict(self) -> int:
+        evicted = 0
+        while self.current_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self.current_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._index:
+                # Another process sharing the directory may have written it
+                try:
+                    self._index[key] = os.path.getsize(self._path(key))
+                except OSError:
+                    return None
+                self.current_bytes += self._index[key]
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                self.current_bytes -= self._index.pop(key)
+                return None
+            self._index.move_to_end(key)
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return data
+
+    def put(self, key: str, data: bytes) -> int:
+        if len(data) > self.max_bytes:
+            return 0
+        # Write to a temp file first so a crash never leaves a torn entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            old = self._index.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old
+            self._index[key] = len(data)
+            self.current_bytes += len(data)
+            return self._evict()
+
+    def pop(self, key: str):
+        with self._lock:
+            size = self._index.pop(key, None)
+            if size is None:
+                return
+            self.current_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class ResultCache:
+    """
+    Memory LRU in front of an optional disk tier. Disk hits are promoted
+    back into memory. The *_async variants serve memory hits inline and
+    run the disk tier in a worker thread.
+    """
+
+    def __init__(self, memory_max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+        self.memory = ByteLRU(memory_max_bytes)
+        self.disk = DiskTier(disk_dir, disk_max_bytes) if disk_dir and disk_max_bytes > 0 else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.memory or (self.disk is not None and key in self.disk)
+
+    def _get_memory(self, key: str) -> Optional[bytes]:
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory_hits += 1
+        return data
+
+    def _get_disk(self, key: str) -> Optional[bytes]:
+        if self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self.disk_hits += 1
+                self.memory.put(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._get_memory(key)
+        return data if data is not None else self._get_disk(key)
+
+    async def get_async(self, key: str) -> Optional[bytes]:
+        data = self._get_memory(key)
+        if data is not None:
+            return data
+        if self.disk is None:
+            self.misses += 1
+            return None
+        return await asyncio.to_thread(self._get_disk, key)
+
+    def _put_disk(self, key: str, data: bytes):
+        try:
+            self.disk.put(key, data)
+        except OSError as e:
+            print(f"Warning: Could not write render cache entry to disk: {e}")
+
+    def put(self, key: str, data: bytes):
+        self.stores += 1
+        self.memory.put(key, data)
+        if self.disk is not None:
+            self._put_disk(key, data)
+
+    async def put_async(self, key: str, data: bytes):
+        self.stores += 1
+        self.memory.put(key, data)
+        if self.disk is not None:
+            await asyncio.to_thread(self._put_disk, key, data)
+
+    def invalidate(self, key: str):
+        self.memory.pop(key)
+        if self.disk is not None:
+            self.disk.pop(key)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        stats = {
+            "hits": self.memory_hits + self.disk_hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.current_bytes,
+            "memory_evictions": self.memory.evictions,
+        }
+        if self.disk is not None:
+            stats.update({
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk.current_bytes,
+                "disk_evictions": self.disk.evictions,
+            })
+        return stats
+
+
+def image_nbytes(image) -> int:
+    """Approximate in-memory size of a decoded PIL image"""
+    width, height = image.size
+    return width * height * len(image.getbands())
+
+
+class LogoCache:
+    """
+    Decoded RGBA logos keyed by payload digest, plus their resized variants
+    keyed by (digest, target box). Bounded by decoded pixel bytes, so a few
+    huge logos cannot crowd out memory the way an entry count would allow.
+    Cached images are shared between requests and must not be mutated.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.images = ByteLRU(max_bytes, sizeof=image_nbytes)
+        self.decode_hits = 0
+        self.decode_misses = 0
+        self.resize_hits = 0
+        self.resize_misses = 0
+
+    def get_decoded(self, digest: str, decode: Callable[[], object]):
+        key = (digest, None)
+        image = self.images.get(key)
+        if image is not None:
+            self.decode_hits += 1
+            return image
+        self.decode_misses += 1
+        image = decode()
+        self.images.put(key, image)
+        return image
+
+    def get_resized(self, digest: str, box: tuple, resize: Callable[[], object]):
+        key = (digest, box)
+        image = self.images.get(key)
+        if image is not None:
+            self.resize_hits += 1
+            return image
+        self.resize_misses += 1
+        image = resize()
+        self.images.put(key, image)
+        return image
+
+    def stats(self) -> dict:
+        return {
+            "decode_hits": self.decode_hits,
+            "decode_misses": self.decode_misses,
+            "resize_hits": self.resize_hits,
+            "resize_misses": self.resize_misses,
+            "entries": len(self.images),
+            "bytes": self.images.current_bytes,
+            "evictions": self.images.evictions,
+        }
+
+
+class TTLCache:
+    """
+    Map whose entries expire `ttl` seconds after insertion, bounded to
+    `max_entries` and, given `sizeof`, to `max_bytes` in total (oldest
+    insertions are dropped first).
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000, max_bytes: Optional[int] = None,
+                 sizeof: Optional[Callable[[object], int]] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+        return entry
+
+    def _purge(self, now: float):
+        while self._entries:
+            key, (expires_at, _, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._drop(key)
+
+    def _over_budget(self) -> bool:
+        return len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.current_bytes > self.max_bytes)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                self._drop(key)
+                return None
+            return entry[1]
+
+    def put(self, key, value, ttl: Optional[float] = None):
+        now = time.monotonic()
+        size = self.sizeof(value) if self.sizeof else 0
+        with self._lock:
+            self._drop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (now + (self.ttl if ttl is None else ttl), value, size)
+            self.current_bytes += size
+            self._purge(now)
+            while self._over_budget():
+                self._drop(next(iter(self._entries)))
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._drop(key)
+            return entry[1] if entry else None
+
+
+class RejectionCache:
+    """
+    Remembers prompts the upstream refused (content policy / 400) so
+    resubmissions fail fast with the original reason until the TTL lapses.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.entries = TTLCache(ttl, max_entries)
+        self.rejections = 0
+        self.calls_avoided = 0
+
+    def check(self, key: str) -> Optional[str]:
+        reason = self.entries.get(key)
+        if reason is not None:
+            self.calls_avoided += 1
+        return reason
+
+    def reject(self, key: str, reason: str):
+        self.rejections += 1
+        self.entries.put(key, reason)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "rejections_recorded": self.rejections,
+            "upstream_calls_avoided": self.calls_avoided,
+            "ttl_seconds": self.entries.ttl,
+        }
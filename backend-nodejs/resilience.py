@@ -0,0 +1,305 @@
+"""
+Retries, hedging and a circuit breaker around upstream generations
+
+`ResilientUpstream` wraps anything with `async generate(prompt)` (the
+shared UpstreamClient, or a scripted fake in tests):
+
+- Failed attempts are retried after a full-jitter exponential backoff, but
+  only while the `RetryBudget` allows it: each call earns a fraction of a
+  retry, so retries stay a bounded share of traffic during an outage.
+- With hedging on, an attempt still running past the recent latency
+  percentile gets a second attempt started alongside it; the first success
+  wins and the other is cancelled. Hedges spend the same budget.
+- Given admission slots, every attempt holds its own: retries queue for a
+  slot again, and a hedge runs only if a slot is free right away, so the
+  concurrency limit also bounds hedges. Each attempt's outcome (a 429 that
+  a retry then recovers from included) reaches the limit's controller.
+- A `CircuitBreaker` opens after consecutive failures and fails calls fast
+  with `CircuitOpen` until a probe call succeeds after the reset timeout.
+
+Clock, sleep and random source are injectable so the behaviour can be
+driven deterministically.
+"""
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import AsyncContextManager, Awaitable, Callable, Optional
+
+from admission import Overloaded, percentile
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Overloaded):
+    """The upstream is considered down; maps to a 503 with Retry-After"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Image generation is temporarily unavailable", 503, retry_after)
+
+
+class RetryBudget:
+    """
+    Retries allowed as a share of calls: every call deposits `ratio` of a
+    retry, every retry withdraws one. `min_per_second` keeps a trickle of
+    retries available at low traffic; the balance is capped at `cap`.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 0.2, cap: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.cap = cap
+        self.clock = clock
+        self.balance = cap
+        self._refilled_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.balance = min(self.cap, self.balance + (now - self._refilled_at) * self.min_per_second)
+        self._refilled_at = now
+
+    def deposit(self):
+        self._refill()
+        self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+    def refund(self):
+        """Give back a withdrawal that was not spent"""
+        self.balance = min(self.cap, self.balance + 1)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max: int = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0  # consecutive
+        self.opened_at = 0.0
+        self._probes = 0
+        self.opens = 0
+        self.fast_failures = 0
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.opened_at + self.reset_timeout - self.clock()))
+
+    def check(self):
+        """Raise CircuitOpen while open, without taking a probe slot"""
+        if self.state == OPEN and self.clock() < self.opened_at + self.reset_timeout:
+            self.fast_failures += 1
+            raise CircuitOpen(self._retry_after())
+
+    def acquire(self):
+        """Admit one call; after the reset timeout, only `half_open_max` probes at a time"""
+        self.check()
+        if self.state == OPEN:
+            self.state = HALF_OPEN
+            self._probes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_max:
+                self.fast_failures += 1
+                raise CircuitOpen(1)
+            self._probes += 1
+
+    def release(self):
+        """A call ended without telling anything about upstream health (cancelled)"""
+        if self.state == HALF_OPEN and self._probes:
+            self._probes -= 1
+
+    def record_success(self):
+        self.failures = 0
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = self.clock()
+            self.opens += 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opens": self.opens,
+            "fast_failures": self.fast_failures,
+        }
+
+
+class ResilientUpstream:
+    def __init__(self, client, is_failure: Callable[[BaseException], bool] = lambda e: True,
+                 max_attempts: int = 3, backoff_base: float = 0.5, backoff_cap: float = 8.0,
+                 attempt_timeout: float = 0.0, budget: Optional[RetryBudget] = None,
+                 breaker: Optional[CircuitBreaker] = None, hedge: bool = False,
+                 hedge_percentile: float = 0.95, hedge_min_samples: int = 20,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Awaitable] = asyncio.sleep,
+                 rng: Optional[random.Random] = None):
+        self.client = client
+        self.is_failure = is_failure  # False for errors that are the request's fault (not retried)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.attempt_timeout = attempt_timeout  # 0 disables
+        self.budget = budget or RetryBudget(clock=clock)
+        self.breaker = breaker or CircuitBreaker(clock=clock)
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+        self._latencies = deque(maxlen=200)  # successful attempts
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.retries_denied = 0  # budget or deadline
+        self.attempt_timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0  # no free slot
+
+    def check(self):
+        """Fail fast (CircuitOpen) before queueing for a slot"""
+        self.breaker.check()
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < self.hedge_min_samples:
+            return None
+        return percentile(self._latencies, self.hedge_percentile)
+
+    def _fits(self, deadline: Optional[float], extra: float = 0.0) -> bool:
+        """Whether another attempt (typical latency plus `extra`) fits before the deadline"""
+        if deadline is None or not self._latencies:
+            return True
+        return deadline - self.clock() >= percentile(self._latencies, 0.5) + extra
+
+    async def _call(self, prompt: str, slot: AsyncContextManager):
+        """One upstream attempt inside `slot`, recorded by the circuit breaker"""
+        async with slot:
+            return await self._call_upstream(prompt)
+
+    async def _call_upstream(self, prompt: str):
+        self.breaker.acquire()
+        self.attempts += 1
+        started = self.clock()
+        task = asyncio.ensure_future(self.client.generate(prompt))
+        try:
+            done, _ = await asyncio.wait({task}, timeout=self.attempt_timeout or None)
+            if not done:
+                task.cancel()
+                self.attempt_timeouts += 1
+                raise asyncio.TimeoutError(f"Upstream attempt timed out after {self.attempt_timeout}s")
+            images = task.result()
+        except asyncio.CancelledError:
+            task.cancel()
+            self.breaker.release()
+            raise
+        except Exception as e:
+            if self.is_failure(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()  # the upstream answered
+            raise
+        self.breaker.record_success()
+        self._latencies.append(self.clock() - started)
+        return images
+
+    async def _attempt(self, prompt: str, deadline: Optional[float],
+                       slot: Callable[[], AsyncContextManager],
+                       hedge_slot: Callable[[], Optional[AsyncContextManager]]):
+        """One attempt, hedged with a second one if it runs past the hedge delay"""
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._call(prompt, slot())
+        first = asyncio.ensure_future(self._call(prompt, slot()))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.breaker.state == CLOSED and self._fits(deadline) and self.budget.withdraw():
+                hedge = hedge_slot()
+                if hedge is None:
+                    self.budget.refund()
+                    self.hedges_skipped += 1
+                else:
+                    self.hedges += 1
+                    tasks.add(asyncio.ensure_future(self._call(prompt, hedge)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks | {first}:
+                if not task.done():
+                    task.cancel()
+
+    async def generate(self, prompt: str, deadline: Optional[float] = None,
+                       slot: Optional[Callable[[], AsyncContextManager]] = None,
+                       hedge_slot: Optional[Callable[[], Optional[AsyncContextManager]]] = None):
+        """
+        Generate with retries/hedging; `deadline` is a time.monotonic() value.
+        `slot` makes the context each attempt runs in (waiting for capacity);
+        `hedge_slot` one for a hedge, or None when there is no capacity to
+        spare. Without `slot` attempts run unbounded; without `hedge_slot`
+        but with `slot` there is no hedging.
+        """
+        if slot is None:
+            slot = nullcontext
+            hedge_slot = hedge_slot or nullcontext
+        hedge_slot = hedge_slot or (lambda: None)
+        self.calls += 1
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await self._attempt(prompt, deadline, slot, hedge_slot)
+            except Overloaded:
+                # Circuit open, or no slot for the retry
+                raise
+            except Exception as e:
+                if not self.is_failure(e) or attempt >= self.max_attempts:
+                    raise
+                backoff = self.rng.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+                if not self._fits(deadline, backoff) or not self.budget.withdraw():
+                    self.retries_denied += 1
+                    raise
+                print(f"Warning: Upstream attempt {attempt} failed, retrying in {backoff:.2f}s: {e}")
+                self.retries += 1
+                await self.sleep(backoff)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "retries_denied": self.retries_denied,
+            "retry_budget": round(self.budget.balance, 2),
+            "attempt_timeouts": self.attempt_timeouts,
+            "hedging": self.hedge,
+            "hedge_delay_seconds": round(self.hedge_delay(), 3) if self.hedge_delay() is not None else None,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+            "circuit": self.breaker.stats(),
+        }
@@ -12,11 +12,24 @@ const router = express.Router();
 
 // Image Generator Service URL
 const IMAGE_GENERATOR_URL = process.env.IMAGE_GENERATOR_URL || 'http://localhost:8002';
+const IMAGE_GENERATOR_TIMEOUT_MS = 180000; // 3 minutes timeout for AI generation
+// Unix socket of a co-located generator (its IMAGE_GENERATOR_UDS); skips loopback TCP when set
+const IMAGE_GENERATOR_SOCKET = process.env.IMAGE_GENERATOR_SOCKET || '';
 
 // AI Image Generation Helper - calls Python microservice
 const generateImageWithAI = async (prompt, clothingType, color, options = {}) => {
   try {
-    const { logo_base64, logo_position, user_photo_base64, view_angle } = options;
+    const {
+      logo_base64,
+      logo_asset_id,
+      logo_position,
+      user_photo_base64,
+      user_photo_asset_id,
+      view_angle,
+      idempotency_key,
+      priority,
+      user_id
+    } = options;
     
     const response = await axios.post(
       `${IMAGE_GENERATOR_URL}/generate`,
@@ -25,24 +38,43 @@ const generateImageWithAI = async (prompt, clothingType, color, options = {}) =>
         clothing_type: clothingType,
         color: color || '',
         logo_base64: logo_base64 || null,
+        logo_asset_id: logo_asset_id || null,
         logo_position: logo_position || 'center',
         user_photo_base64: user_photo_base64 || null,
+        user_photo_asset_id: user_photo_asset_id || null,
         view_angle: view_angle || 'front'
       },
       {
-        timeout: 180000 // 3 minutes timeout for AI generation
+        timeout: IMAGE_GENERATOR_TIMEOUT_MS,
+        ...(IMAGE_GENERATOR_SOCKET ? { socketPath: IMAGE_GENERATOR_SOCKET } : {}),
+        headers: {
+          // Lets the generator refuse early or skip optional stages instead of running past our timeout
+          'X-Deadline-Ms': String(IMAGE_GENERATOR_TIMEOUT_MS),
+          // Lets the generator replay or join the first attempt when a request is retried
+          ...(idempotency_key ? { 'Idempotency-Key': idempotency_key } : {}),
+          // Priority lane and per-user fairness in the generator's queue
+          ...(priority ? { 'X-Priority': priority } : {}),
+          ...(user_id ? { 'X-User-Id': user_id } : {})
+        }
       }
     );
 
     if (response.data?.success && response.data?.image_base64) {
       return {
         image_base64: response.data.image_base64,
+        image_media_type: response.data.image_media_type || 'image/png',
         composite_image_base64: response.data.composite_image_base64 || '',
+        composite_media_type: response.data.composite_media_type || 'image/png',
         revised_prompt: response.data.revised_prompt || prompt
       };
     }
 
-    throw new Error(response.data?.error || 'فشل في توليد الصورة');
+    const generationError = new Error(response.data?.error || 'فشل في توليد الصورة');
+    if (response.data?.rejected) {
+      // Prompt refused upstream - surface it like a 400 so /preview shows the right message
+      generationError.response = { status: 400, data: response.data };
+    }
+    throw generationError;
   } catch (error) {
     console.error('Image Generator Error:', error.response?.data || error.message);
     throw error;
@@ -129,7 +161,17 @@ router.post('/enhance-prompt', protect, async (req, res) => {
 // @access  Private
 router.post('/preview', protect, async (req, res) => {
   try {
-    const { prompt, clothing_type, color, logo_base64, logo_position, user_photo_base64, view_angle } = req.body;
+    const {
+      prompt,
+      clothing_type,
+      color,
+      logo_base64,
+      logo_asset_id,
+      logo_position,
+      user_photo_base64,
+      user_photo_asset_id,
+      view_angle
+    } = req.body;
 
     if (!prompt || !clothing_type) {
       return res.status(400).json({ 
@@ -157,12 +199,20 @@ router.post('/preview', protect, async (req, res) => {
     };
     const englishClothingType = clothingTypeMap[clothing_type] || clothing_type;
 
+    // Scope the client's Idempotency-Key to this user
+    const idempotencyKey = req.get('Idempotency-Key');
+
     // Generate image using OpenAI with logo and user photo options
     const result = await generateImageWithAI(prompt, englishClothingType, color, {
       logo_base64,
+      logo_asset_id,
       logo_position: logo_position || 'center',
       user_photo_base64,
-      view_angle: view_angle || 'front'
+      user_photo_asset_id,
+      view_angle: view_angle || 'front',
+      idempotency_key: idempotencyKey ? `${req.user.id}:${idempotencyKey}` : undefined,
+      priority: user.is_unlimited ? 'premium' : 'standard',
+      user_id: req.user.id
     });
 
     // Increment designs_used after successful generation
@@ -178,7 +228,9 @@ router.post('/preview', protect, async (req, res) => {
     res.json({
       success: true,
       image_base64: result.image_base64,
+      image_media_type: result.image_media_type,
       composite_image_base64: result.composite_image_base64 || '',
+      composite_media_type: result.composite_media_type,
       prompt: result.revised_prompt || prompt,
       message: 'تم إنشاء التصميم بنجاح',
       designs_remaining: designsRemaining,
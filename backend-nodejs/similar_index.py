@@ -0,0 +1,203 @@
+"""
+Near-duplicate prompt index (MinHash + LSH banding)
+
+Maps canonicalized prompts to the render cache keys of past generations so
+a request that differs by a word or two can be offered an existing design.
+Entries are grouped by an exact "group" string (clothing type, color, logo,
+photo...) and only prompts within the same group are compared.
+
+Text similarity cannot tell a rewording from a different design: "red" vs
+"blue" in an otherwise equal prompt still scores around 0.8. Matches are
+therefore only offered; the caller decides whether to take one. A query
+costs roughly 1-3 ms of pure Python (64 MinHash permutations over the
+prompt's shingles, then exact Jaccard on the candidates), more when many
+indexed prompts share its buckets.
+
+The index is persisted as an append-only JSONL log (adds and tombstones),
+replayed on startup and compacted when tombstones dominate.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def shingles(text: str) -> frozenset:
+    """Word tokens plus character trigrams inside each word"""
+    features = set()
+    for word in text.split():
+        features.add(f"w:{word}")
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            features.add(f"c:{padded[i:i + 3]}")
+    return frozenset(features)
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class SimilarPromptIndex:
+    """
+    MinHash signatures of `bands * rows` permutations, bucketed per band.
+    Candidates from the buckets are verified with exact Jaccard on the
+    stored shingle sets before being returned.
+    """
+
+    def __init__(self, path: Optional[str] = None, bands: int = 16, rows: int = 4,
+                 threshold: float = 0.8, max_entries: int = 50000):
+        self.path = path
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        self.max_entries = max_entries
+        seeds = [_hash64(f"minhash-{i}") for i in range(bands * rows * 2)]
+        self._perms = [(seeds[2 * i] | 1, seeds[2 * i + 1]) for i in range(bands * rows)]
+        self._entries = OrderedDict()  # key -> (group, text, shingle set, band keys)
+        self._buckets = {}  # (band key) -> set of entry keys
+        self._tombstones = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.matches = 0
+        if path:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _band_keys(self, group: str, features: frozenset) -> list:
+        hashes = [_hash64(f) for f in features] or [0]
+        signature = [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self._perms]
+        return [
+            (group, band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def _insert(self, key: str, group: str, text: str):
+        self._remove(key)
+        features = shingles(text)
+        band_keys = self._band_keys(group, features)
+        self._entries[key] = (group, text, features, band_keys)
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, set()).add(key)
+
+    def _remove(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for band_key in entry[3]:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+        return True
+
+    def _append(self, record: dict):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"Warning: Could not persist similar-prompt index: {e}")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn last line after a crash
+                if record.get("deleted"):
+                    self._remove(record["key"])
+                    self._tombstones += 1
+                else:
+                    self._insert(record["key"], record["group"], record["text"])
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+        if self._tombstones > len(self._entries):
+            self.compact()
+
+    def add(self, key: str, group: str, text: str):
+        """Index (or re-index) a rendered request under its cache key"""
+        with self._lock:
+            self._insert(key, group, text)
+            self._append({"key": key, "group": group, "text": text})
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key: str):
+        if self._remove(key):
+            self._tombstones += 1
+            self._append({"key": key, "deleted": True})
+
+    def discard(self, key: str):
+        """Drop an entry, e.g. when its render is no longer cached"""
+        with self._lock:
+            self._discard(key)
+            if self._tombstones > max(len(self._entries), 1000):
+                self.compact()
+
+    def query(self, group: str, text: str, exclude: Optional[str] = None) -> Optional[tuple]:
+        """Return (key, indexed text, similarity) of the closest match above threshold"""
+        features = shingles(text)
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band_key in self._band_keys(group, features):
+                candidates.update(self._buckets.get(band_key, ()))
+            candidates.discard(exclude)
+            best = None
+            for key in candidates:
+                _, indexed_text, indexed_features, _ = self._entries[key]
+                score = jaccard(features, indexed_features)
+                if score >= self.threshold and (best is None or score > best[2]):
+                    best = (key, indexed_text, score)
+            if best is not None:
+                self.matches += 1
+            return best
+
+    def score(self, key: str, group: str, text: str) -> Optional[tuple]:
+        """(indexed text, similarity) of `text` to the entry `key`, or None if it is not indexed in `group`"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != group:
+                return None
+            return entry[1], jaccard(shingles(text), entry[2])
+
+    def compact(self):
+        """Rewrite the log with only the live entries"""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for key, (group, text, _, _) in self._entries.items():
+                    f.write(json.dumps({"key": key, "group": group, "text": text}, ensure_ascii=False) + '\n')
+            os.replace(tmp_path, self.path)
+            self._tombstones = 0
+        except OSError as e:
+            print(f"Warning: Could not compact similar-prompt index: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "buckets": len(self._buckets),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "threshold": self.threshold,
+        }
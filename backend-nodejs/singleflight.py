@@ -0,0 +1,71 @@
+"""
+In-flight request coalescing (single-flight)
+
+Concurrent callers asking for the same key share one running task. The task
+is shielded, so a caller being cancelled (e.g. the client disconnected)
+only stops that caller from waiting - the shared work keeps going for the
+others. With `cancel_abandoned`, the task is cancelled once the last caller
+waiting on it goes away; otherwise it runs on and still lands in the caches.
+"""
+import asyncio
+from typing import Awaitable, Callable
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, cancel_abandoned: bool = False):
+        self.cancel_abandoned = cancel_abandoned
+        self._calls = {}  # key -> _Call
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def _finished(self, key, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        task = call.task
+        # Mark the exception retrieved in case every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, fn: Callable[[], Awaitable]):
+        """Run fn() for key, or wait for the call already in flight"""
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._finished(key, call))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if self.cancel_abandoned and call.waiters == 1 and not call.task.done():
+                # Nobody is left to read the result; later callers start afresh
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call.task.cancel()
+                self.abandoned += 1
+            raise
+        finally:
+            call.waiters -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
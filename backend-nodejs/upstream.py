@@ -0,0 +1,80 @@
+"""
+Long-lived upstream image-generation client
+
+The emergentintegrations client is imported and constructed once at app
+startup and shared by every request, instead of being imported and built
+inside each /generate call. Its constructor only takes `api_key`, so its
+HTTP connections are the library's own business; whatever connection
+reuse it does lives as long as the shared client does.
+
+Per-request setup time is recorded either way; with reuse disabled the
+old per-request construction is kept so the two can be compared.
+"""
+import time
+from typing import List, Optional
+
+
+class UpstreamClient:
+    def __init__(self, api_key: Optional[str], model: str, reuse: bool = True):
+        self.api_key = api_key
+        self.model = model
+        self.reuse = reuse
+        self._generator_class = None
+        self._generator = None
+        self.import_ms = 0.0
+        self.construct_ms = 0.0
+        self.requests = 0
+        self.setup_total_ms = 0.0
+        self.setup_max_ms = 0.0
+
+    def _import(self):
+        if self._generator_class is None:
+            started = time.perf_counter()
+            from emergentintegrations.llm.openai.image_generation import OpenAIImageGeneration
+            self._generator_class = OpenAIImageGeneration
+            self.import_ms = (time.perf_counter() - started) * 1000
+        return self._generator_class
+
+    def _construct(self):
+        generator_class = self._import()
+        started = time.perf_counter()
+        generator = generator_class(api_key=self.api_key)
+        self.construct_ms = (time.perf_counter() - started) * 1000
+        return generator
+
+    def start(self):
+        """Import the client library and build the shared client (app startup)"""
+        self._import()
+        if self.reuse and self.api_key and self._generator is None:
+            self._generator = self._construct()
+
+    async def generate(self, prompt: str) -> List[bytes]:
+        started = time.perf_counter()
+        if not self.reuse:
+            generator = self._construct()
+        else:
+            if self._generator is None:
+                self._generator = self._construct()
+            generator = self._generator
+        setup_ms = (time.perf_counter() - started) * 1000
+        self.requests += 1
+        self.setup_total_ms += setup_ms
+        self.setup_max_ms = max(self.setup_max_ms, setup_ms)
+        return await generator.generate_images(
+            prompt=prompt,
+            model=self.model,
+            number_of_images=1
+        )
+
+    async def close(self):
+        self._generator = None
+
+    def stats(self) -> dict:
+        return {
+            "reuse": self.reuse,
+            "import_ms": round(self.import_ms, 3),
+            "construct_ms": round(self.construct_ms, 3),
+            "requests": self.requests,
+            "avg_setup_ms": round(self.setup_total_ms / self.requests, 4) if self.requests else 0.0,
+            "max_setup_ms": round(self.setup_max_ms, 4),
+        }
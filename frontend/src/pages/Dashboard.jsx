@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import axios from "axios";
 import { toast } from "sonner";
 import { Sparkles, Heart, Trash2, LogOut, Loader2, Wand2, Save, Edit, X, Phone, ShoppingCart, Package, Ruler, Eye, TrendingUp, Bell, Moon, Sun, Tag, Truck, ArrowRight } from "lucide-react";
@@ -30,6 +30,14 @@ const LOGO_POSITIONS = [
   { value: "bottom", label: "أسفل الملابس", icon: "▼" }
 ];
 
+// Idempotency-Key for a preview attempt: a retry of the same preview sends the
+// same key, so the generator replays or joins that render instead of starting another
+const newIdempotencyKey = () =>
+  window.crypto?.randomUUID?.() ?? `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
+const samePreviewPayload = (a, b) =>
+  Object.keys(a).length === Object.keys(b).length && Object.keys(a).every((key) => a[key] === b[key]);
+
 export default function Dashboard({ user, onLogout }) {
   const { isDark, toggleTheme } = useTheme();
   
@@ -62,6 +70,7 @@ export default function Dashboard({ user, onLogout }) {
   const [compositeImage, setCompositeImage] = useState(null);
   const [showComposite, setShowComposite] = useState(false);
   const [selectedLogoPosition, setSelectedLogoPosition] = useState("center");
+  const unfinishedPreview = useRef(null); // { payload, idempotencyKey } until the preview succeeds
   
   // Coupon State
   const [availableCoupons, setAvailableCoupons] = useState([]);
@@ -395,10 +404,20 @@ export default function Dashboard({ user, onLogout }) {
         view_angle: selectedViewAngle
       };
 
-      const response = await axios.post(`${API}/designs/preview`, payload);
+      const unfinished = unfinishedPreview.current;
+      const idempotencyKey = unfinished && samePreviewPayload(unfinished.payload, payload)
+        ? unfinished.idempotencyKey
+        : newIdempotencyKey();
+      unfinishedPreview.current = { payload, idempotencyKey };
+
+      const response = await axios.post(`${API}/designs/preview`, payload, {
+        headers: { "Idempotency-Key": idempotencyKey }
+      });
+      unfinishedPreview.current = null;
       
       setGeneratedDesign({
         image_base64: response.data.image_base64,
+        image_media_type: response.data.image_media_type || 'image/png',
         prompt: finalPrompt,
         clothing_type: selectedClothingType,
         template_id: null
@@ -406,7 +425,7 @@ export default function Dashboard({ user, onLogout }) {
       
       // Store composite image if available
       if (response.data.composite_image_base64) {
-        setCompositeImage(response.data.composite_image_base64);
+        setCompositeImage(`data:${response.data.composite_media_type || 'image/png'};base64,${response.data.composite_image_base64}`);
         toast.success("🎨 تم إنشاء التصميم مع صورتك!");
       } else {
         toast.success("تم إنشاء التصميم بنجاح!");
@@ -1269,13 +1288,13 @@ export default function Dashboard({ user, onLogout }) {
                     {generatedDesign ? (
                       showComposite && compositeImage ? (
                         <img 
-                          src={`data:image/png;base64,${compositeImage}`}
+                          src={compositeImage}
                           alt="Your Photo with Design" 
                           className="w-full h-full object-contain"
                         />
                       ) : (
                         <img 
-                          src={`data:image/png;base64,${generatedDesign.image_base64}`}
+                          src={`data:${generatedDesign.image_media_type};base64,${generatedDesign.image_base64}`}
                           alt="Generated Design" 
                           className="w-full h-full object-contain"
                         />
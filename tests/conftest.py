@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The image service modules live in backend-nodejs/, which is not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend-nodejs"))
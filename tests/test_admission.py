@@ -0,0 +1,210 @@
+import asyncio
+
+import pytest
+
+from admission import (ERROR, OK, THROTTLED, TIMEOUT, AdmissionController, AIMDController, Caller,
+                       Overloaded, classify_outcome)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_controller(initial=4, **kwargs):
+    clock = FakeClock()
+    return AIMDController(initial, minimum=1, maximum=8, clock=clock, **kwargs), clock
+
+
+def test_increases_after_limit_saturated_healthy_calls():
+    controller, _ = make_controller()
+    for _ in range(3):
+        assert controller.record(1.0, OK) == 4
+    assert controller.record(1.0, OK) == 5
+    assert controller.increases == 1
+
+
+def test_does_not_increase_without_saturation():
+    controller, _ = make_controller()
+    for _ in range(100):
+        controller.record(1.0, OK, saturated=False)
+    assert controller.limit == 4
+    assert controller.increases == 0
+
+
+def test_increase_stops_at_maximum():
+    controller, _ = make_controller(initial=8)
+    for _ in range(50):
+        controller.record(1.0, OK)
+    assert controller.limit == 8
+
+
+@pytest.mark.parametrize("outcome", [THROTTLED, TIMEOUT])
+def test_throttle_and_timeout_halve_the_limit(outcome):
+    controller, _ = make_controller()
+    assert controller.record(1.0, outcome) == 2
+    assert controller.decreases == 1
+
+
+def test_plain_errors_do_not_move_the_limit():
+    controller, _ = make_controller()
+    for _ in range(10):
+        controller.record(1.0, ERROR)
+    assert controller.limit == 4
+
+
+def test_decreases_at_most_once_per_cooldown():
+    controller, clock = make_controller(initial=8, cooldown=5.0)
+    controller.record(1.0, THROTTLED)
+    clock.now = 4.9
+    controller.record(1.0, THROTTLED)
+    assert controller.limit == 4
+    clock.now = 5.0
+    controller.record(1.0, THROTTLED)
+    assert controller.limit == 2
+    assert controller.decreases == 2
+
+
+def test_decrease_respects_minimum():
+    controller, clock = make_controller(initial=1)
+    controller.record(1.0, THROTTLED)
+    assert controller.limit == 1
+
+
+def test_latency_spike_decreases():
+    controller, _ = make_controller(spike_factor=2.0)
+    controller.record(1.0, OK)
+    controller.record(1.0, OK)
+    assert controller.record(2.5, OK) == 2
+    assert controller.decreases == 1
+
+
+def test_throttle_resets_healthy_streak():
+    controller, clock = make_controller()
+    for _ in range(3):
+        controller.record(1.0, OK)
+    controller.record(1.0, THROTTLED)  # 4 -> 2
+    clock.now = 100.0
+    controller.record(1.0, OK)
+    assert controller.limit == 2
+    controller.record(1.0, OK)
+    assert controller.limit == 3
+
+
+def test_classify_outcome():
+    assert classify_outcome(None) == OK
+    assert classify_outcome(asyncio.TimeoutError()) == TIMEOUT
+    assert classify_outcome(RuntimeError("Error code: 429 - rate limit")) == THROTTLED
+    assert classify_outcome(RuntimeError("content policy")) == ERROR
+
+
+async def hold_slots(admission: AdmissionController, count: int, release: asyncio.Event):
+    async def hold():
+        async with admission.slot(Caller()):
+            await release.wait()
+    tasks = [asyncio.ensure_future(hold()) for _ in range(count)]
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_slot_only_grows_the_limit_when_saturated():
+    async def scenario():
+        # Holds here are microseconds, so latency spikes are noise
+        controller = AIMDController(2, maximum=8, spike_factor=float("inf"))
+        admission = AdmissionController(2, max_queue=10, max_wait=5, controller=controller)
+        # One call at a time never fills two slots
+        for _ in range(10):
+            async with admission.slot(Caller()):
+                pass
+        assert admission.limit == 2
+        # Both slots busy and one caller queued: completions count toward an increase
+        release = asyncio.Event()
+        tasks = await hold_slots(admission, 3, release)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert admission.limit == 3
+
+    asyncio.run(scenario())
+
+
+def test_queue_full_is_refused():
+    async def scenario():
+        admission = AdmissionController(1, max_queue=1, max_wait=5)
+        release = asyncio.Event()
+        tasks = await hold_slots(admission, 2, release)  # one running, one queued
+        with pytest.raises(Overloaded) as raised:
+            async with admission.slot(Caller()):
+                pass
+        assert raised.value.status_code == 429
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+async def admission_order(admission: AdmissionController, callers):
+    """Queue callers behind a held slot and return the order they are admitted in"""
+    order = []
+    release = asyncio.Event()
+    holders = await hold_slots(admission, admission.limit, release)
+
+    async def run(name, caller):
+        async with admission.slot(caller):
+            order.append(name)
+
+    tasks = []
+    for name, caller in callers:
+        tasks.append(asyncio.ensure_future(run(name, caller)))
+        await asyncio.sleep(0)  # queue in submission order
+    release.set()
+    await asyncio.gather(*holders, *tasks)
+    return order
+
+
+def test_lanes_are_served_strictly_in_priority_order():
+    async def scenario():
+        admission = AdmissionController(1, max_queue=10, max_wait=5)
+        return await admission_order(admission, [
+            ("batch", Caller("batch", "a")),
+            ("standard", Caller("standard", "a")),
+            ("premium", Caller("premium", "a")),
+            ("unknown", Caller("no-such-lane", "a")),  # the default lane
+        ])
+
+    assert asyncio.run(scenario()) == ["premium", "standard", "unknown", "batch"]
+
+
+def test_users_take_turns_within_a_lane():
+    async def scenario():
+        admission = AdmissionController(1, max_queue=10, max_wait=5)
+        return await admission_order(admission, [
+            ("alice-1", Caller("standard", "alice")),
+            ("alice-2", Caller("standard", "alice")),
+            ("alice-3", Caller("standard", "alice")),
+            ("bob-1", Caller("standard", "bob")),
+            ("carol-1", Caller("standard", "carol")),
+            ("bob-2", Caller("standard", "bob")),
+        ])
+
+    assert asyncio.run(scenario()) == ["alice-1", "bob-1", "carol-1", "alice-2", "bob-2", "alice-3"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        admission = AdmissionController(1, max_queue=10, max_wait=5)
+        release = asyncio.Event()
+        holders = await hold_slots(admission, 1, release)
+        waiter = (await hold_slots(admission, 1, asyncio.Event()))[0]
+        assert admission.queue_depth == 1
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert admission.queue_depth == 0
+        assert admission.stats()["cancelled_waiting"] == 1
+        release.set()
+        await asyncio.gather(*holders)
+        assert admission.in_flight == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,42 @@
+import asyncio
+import multiprocessing
+
+import pytest
+
+from cpu_pool import CpuPool
+
+needs_fork = pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+
+
+@pytest.mark.parametrize("kind", ["thread", pytest.param("process", marks=needs_fork)])
+def test_runs_a_job_in_each_mode(kind):
+    pool = CpuPool(kind, 2)
+    try:
+        pool.warm()
+        assert asyncio.run(pool.run("stage", pow, 2, 10)) == 1024
+        stats = pool.stats()["stages"]["stage"]
+        assert (stats["completed"], stats["pending"], stats["failed"]) == (1, 0, 0)
+    finally:
+        pool.shutdown()
+
+
+@needs_fork
+def test_warm_forks_every_worker_before_the_first_job():
+    before = {child.pid for child in multiprocessing.active_children()}
+    pool = CpuPool("process", 2)
+    try:
+        pool.warm()
+        assert len({child.pid for child in multiprocessing.active_children()} - before) == 2
+    finally:
+        pool.shutdown()
+
+
+def test_failures_are_counted():
+    pool = CpuPool("thread", 1)
+    try:
+        with pytest.raises(ZeroDivisionError):
+            asyncio.run(pool.run("stage", divmod, 1, 0))
+        assert pool.stats()["stages"]["stage"]["failed"] == 1
+        assert pool.expected_seconds("stage", 3.0) == 3.0  # nothing completed yet
+    finally:
+        pool.shutdown()
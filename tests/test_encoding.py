@@ -0,0 +1,75 @@
+import io
+
+import pytest
+
+pytest.importorskip("PIL")
+
+from PIL import Image  # noqa: E402
+
+from encoding import OutputEncoder  # noqa: E402
+
+
+def make_encoder(available=("png", "jpeg", "webp", "avif")):
+    encoder = OutputEncoder()
+    encoder.available = list(available)
+    return encoder
+
+
+@pytest.mark.parametrize("requested, fmt", [
+    (None, "webp"),
+    ("", "webp"),
+    ("PNG", "png"),
+    (" jpg ", "jpeg"),
+    ("image/jpg", "jpeg"),
+    ("image/avif", "avif"),
+])
+def test_resolve_normalizes_names_and_media_types(requested, fmt):
+    assert make_encoder().resolve(requested, "webp") == fmt
+
+
+def test_resolve_rejects_unknown_and_unavailable_formats():
+    encoder = make_encoder(("png", "jpeg"))
+    with pytest.raises(ValueError, match="Unknown"):
+        encoder.resolve("gif", "png")
+    with pytest.raises(ValueError, match="not supported"):
+        encoder.resolve("avif", "png")
+
+
+@pytest.mark.parametrize("accept, fmt", [
+    (None, "png"),
+    ("text/html,application/json", "png"),  # no image types named
+    ("image/png,image/webp", "png"),  # the default is acceptable
+    ("image/*", "png"),
+    ("image/webp,image/avif", "avif"),  # preference order, not header order
+    ("image/avif;q=0,image/webp;q=0.5", "webp"),
+    ("image/webp;q=oops,image/jpeg", "jpeg"),  # an unparseable q counts as 0
+    ("image/heic", "png"),  # nothing we can produce
+])
+def test_negotiate_reads_the_accept_header(accept, fmt):
+    assert make_encoder().negotiate(accept, "png") == fmt
+
+
+def test_negotiate_skips_formats_this_server_cannot_encode():
+    assert make_encoder(("png", "jpeg", "webp")).negotiate("image/avif,image/webp", "png") == "webp"
+
+
+def test_encode_produces_the_requested_format():
+    encoder = OutputEncoder()
+    image = Image.new("RGBA", (8, 8), (255, 0, 0, 128))
+    for fmt in ("png", "jpeg"):
+        encoded = encoder.encode(image, fmt)
+        assert encoded.format == fmt
+        assert Image.open(io.BytesIO(encoded.data)).format == fmt.upper()
+    assert encoded.media_type == "image/jpeg"
+
+
+def test_record_keeps_per_format_stats():
+    encoder = OutputEncoder()
+    image = Image.new("RGB", (8, 8), "white")
+    encoder.record(encoder.encode(image, "png"))
+    encoder.record(encoder.encode(image, "png"))
+    encoder.record(None)
+    stats = encoder.stats()["formats"]
+    assert list(stats) == ["png"]
+    assert stats["png"]["images"] == 2
+    assert stats["png"]["avg_bytes"] == stats["png"]["bytes"] // 2
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+from disconnect import ClientDisconnected, DisconnectGuard
+from idempotency import IdempotencyConflict, IdempotencyStore
+
+
+class FakeRequest:
+    """ASGI request whose client disconnects once `leave` is set"""
+
+    def __init__(self):
+        self.leave = asyncio.Event()
+
+    async def receive(self):
+        await self.leave.wait()
+        return {"type": "http.disconnect"}
+
+
+def make_store(**kwargs):
+    return IdempotencyStore(**{"ttl": 60, "max_bytes": 1000, "sizeof": len, **kwargs})
+
+
+def counting(result="image"):
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        return result
+
+    return generate, calls
+
+
+def test_repeat_after_completion_replays_the_response():
+    async def scenario():
+        store = make_store()
+        generate, calls = counting()
+        assert await store.run("key", "body", generate) == "image"
+        assert await store.run("key", "body", generate) == "image"
+        assert len(calls) == 1
+        assert store.stats()["replayed"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_repeat_while_running_attaches():
+    async def scenario():
+        store = make_store()
+        release = asyncio.Event()
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await release.wait()
+            return "image"
+
+        callers = [asyncio.ensure_future(store.run("key", "body", generate)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(*callers) == ["image", "image"]
+        assert len(calls) == 1
+        assert store.stats()["attached"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_key_reused_with_a_different_body_is_a_conflict():
+    async def scenario():
+        store = make_store()
+        generate, _ = counting()
+        await store.run("key", "body", generate)
+        with pytest.raises(IdempotencyConflict):
+            await store.run("key", "other body", generate)
+        assert store.stats()["conflicts"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_attempts_are_not_stored():
+    async def scenario():
+        store = make_store(keep=lambda result: result != "failed")
+        failing, _ = counting("failed")
+        assert await store.run("key", "body", failing) == "failed"
+        generate, calls = counting()
+        assert await store.run("key", "body", generate) == "image"
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_responses_expire_after_the_ttl():
+    async def scenario():
+        store = make_store(ttl=0)
+        generate, calls = counting()
+        await store.run("key", "body", generate)
+        await store.run("key", "other body", generate)  # expired, so no conflict either
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_oldest_responses_are_evicted_over_the_byte_budget():
+    async def scenario():
+        store = make_store(max_bytes=10)
+        for key in ("a", "b"):
+            generate, _ = counting("123456")
+            await store.run(key, "body", generate)
+        stats = store.stats()
+        assert (stats["entries"], stats["bytes"], stats["evictions"]) == (1, 6, 1)
+        generate, calls = counting("123456")
+        await store.run("a", "body", generate)  # evicted, so generated again
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_disconnect_joins_the_first_generation():
+    async def scenario():
+        store = make_store()
+        guard = DisconnectGuard()
+        release = asyncio.Event()
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await release.wait()
+            return "image"
+
+        first = FakeRequest()
+        waiting = asyncio.ensure_future(guard.run(first, store.run("key", "body", generate)))
+        await asyncio.sleep(0)
+        first.leave.set()  # the caller's own timeout dropped the connection
+        with pytest.raises(ClientDisconnected):
+            await waiting
+        retry = asyncio.ensure_future(guard.run(FakeRequest(), store.run("key", "body", generate)))
+        await asyncio.sleep(0)
+        release.set()
+        assert await retry == "image"
+        assert len(calls) == 1
+        assert store.stats()["attached"] == 1
+
+    asyncio.run(scenario())
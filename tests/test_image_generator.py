@@ -0,0 +1,463 @@
+import asyncio
+import base64
+import email
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import unquote
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("PIL")
+os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp())
+
+from fastapi import HTTPException  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import image_generator  # noqa: E402
+from admission import Caller, DeadlineExceeded, Overloaded  # noqa: E402
+from idempotency import IdempotencyStore  # noqa: E402
+from image_generator import ImageRequest, ImageResponse, ReblendRequest  # noqa: E402
+from jobs import DONE, FAILED, JobStore  # noqa: E402
+from rate_limit import LocalBucketStore, RateLimiter  # noqa: E402
+from render_cache import ResultCache, TTLCache  # noqa: E402
+from singleflight import SingleFlight  # noqa: E402
+
+
+def test_in_memory_job_waits_out_a_full_queue(monkeypatch):
+    attempts = []
+
+    async def generate_design(request, caller):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise Overloaded("Image generation queue is full", 429, 0)
+        return ImageResponse(success=True, image_base64="aW1hZ2U=")
+
+    monkeypatch.setattr(image_generator, "generate_design", generate_design)
+
+    async def scenario():
+        store = JobStore(ttl=60, max_bytes=1000, max_jobs=10, sizeof=lambda response: 0,
+                         succeeded=lambda response: response.success)
+        job = store.submit(lambda: image_generator.generate_for_job(ImageRequest(prompt="p"), Caller()))
+        await job.task
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.stage == DONE
+    assert len(attempts) == 2
+
+
+def test_job_gives_up_on_a_sustained_outage(monkeypatch):
+    async def generate_design(request, caller):
+        raise Overloaded("Image generation is unavailable", 503, 1)
+
+    monkeypatch.setattr(image_generator, "generate_design", generate_design)
+    monkeypatch.setattr(image_generator, "JOB_OVERLOAD_MAX_WAIT", 0.05)
+
+    async def scenario():
+        store = JobStore(ttl=60, max_bytes=1000, max_jobs=10, sizeof=lambda response: 0,
+                         succeeded=lambda response: response.success)
+        job = store.submit(lambda: image_generator.generate_for_job(ImageRequest(prompt="p"), Caller()))
+        await asyncio.wait_for(job.task, 5)
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.stage == FAILED
+    assert job.error == "Image generation is unavailable"
+
+
+def png_bytes(size, color, mode="RGB") -> bytes:
+    buffer = io.BytesIO()
+    Image.new(mode, size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_reblend_keeps_the_logo_the_render_was_made_with(monkeypatch):
+    monkeypatch.setattr(image_generator, "rate_limiter", None)
+    logo = base64.b64encode(png_bytes((32, 32), (255, 0, 0, 255), "RGBA")).decode("ascii")
+    generated = ImageRequest(prompt="p", logo_base64=logo)
+    image_generator.base_renders.put("render", (png_bytes((256, 256), "white"), "prompt",
+                                                image_generator.blend_inputs(generated)))
+
+    response = asyncio.run(image_generator.reblend_render(
+        "render", ReblendRequest(logo_position="left"), http_request=None))
+
+    assert response.success
+    design = Image.open(io.BytesIO(base64.b64decode(response.image_base64))).convert("RGB")
+    # A 64px logo at the upper left chest (15% across, 20% down)
+    assert design.getpixel((60, 80)) == (255, 0, 0)
+    assert design.getpixel((128, 80)) == (255, 255, 255)
+
+
+def test_reblend_keeps_the_position_the_render_was_made_with(monkeypatch):
+    monkeypatch.setattr(image_generator, "rate_limiter", None)
+    red = base64.b64encode(png_bytes((32, 32), (255, 0, 0, 255), "RGBA")).decode("ascii")
+    blue = base64.b64encode(png_bytes((32, 32), (0, 0, 255, 255), "RGBA")).decode("ascii")
+    generated = ImageRequest(prompt="p", logo_base64=red, logo_position="right")
+    image_generator.base_renders.put("right-render", (png_bytes((256, 256), "white"), "prompt",
+                                                      image_generator.blend_inputs(generated)))
+
+    # Only the logo changes
+    response = asyncio.run(image_generator.reblend_render(
+        "right-render", ReblendRequest(logo_base64=blue), http_request=None))
+
+    design = Image.open(io.BytesIO(base64.b64decode(response.image_base64))).convert("RGB")
+    # Upper right chest: ends 85% across, 20% down
+    assert design.getpixel((200, 80)) == (0, 0, 255)
+    assert design.getpixel((60, 80)) == (255, 255, 255)
+
+
+@pytest.mark.parametrize("size", [(100, 100), (300, 97), (20, 196), (27, 196), (641, 1000)])
+def test_fitted_logo_is_not_resized_again(size):
+    box = image_generator.logo_box((256, 256))
+    fitted = image_generator.fit_logo(Image.new("RGBA", size), box)
+    assert fitted.width <= box[0] and fitted.height <= box[1]
+    assert image_generator.fit_logo(fitted, box) is fitted
+
+
+def test_idempotency_key_reused_with_another_body_is_a_422(monkeypatch):
+    async def generate_design(request, caller):
+        return ImageResponse(success=True, image_base64="aW1hZ2U=")
+
+    monkeypatch.setattr(image_generator, "generate_design", generate_design)
+    monkeypatch.setattr(image_generator, "CANCEL_ON_DISCONNECT", False)
+    monkeypatch.setattr(image_generator, "idempotency_store", IdempotencyStore(
+        ttl=60, max_bytes=1000, sizeof=lambda response: 0))
+
+    async def scenario():
+        first = await image_generator.serve_generation(ImageRequest(prompt="red"), None, Caller(), "key")
+        assert first.success
+        with pytest.raises(HTTPException) as raised:
+            await image_generator.serve_generation(ImageRequest(prompt="blue"), None, Caller(), "key")
+        return raised.value
+
+    assert asyncio.run(scenario()).status_code == 422
+
+
+def coalesced_responses(monkeypatch, leader_outcome):
+    """A leader with a short deadline and a follower without one, sharing a render"""
+    release = asyncio.Event()
+    led_by = []
+
+    async def render_shared(request, canonical, enhanced_prompt, cache_key, reject_key, caller, from_peer):
+        led_by.append(caller)
+        if caller.deadline is not None:
+            await release.wait()
+            return leader_outcome()
+        return ImageResponse(success=True, composite_image_base64="Y29tcG9zaXRl")
+
+    monkeypatch.setattr(image_generator, "render_shared", render_shared)
+    monkeypatch.setattr(image_generator, "in_flight", SingleFlight())
+
+    async def scenario():
+        request = ImageRequest(prompt="p")
+        leader = Caller(deadline=time.monotonic() + 1)
+
+        def render(caller):
+            return asyncio.ensure_future(image_generator.render_coalesced(
+                request, request, "prompt", "key", "reject", caller, False))
+
+        leading = render(leader)
+        await asyncio.sleep(0)
+        following = render(Caller())
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(leading, following, return_exceptions=True)
+        return results, led_by
+
+    return asyncio.run(scenario())
+
+
+def test_follower_reruns_a_render_shed_for_the_leaders_deadline(monkeypatch):
+    (leader, follower), led_by = coalesced_responses(
+        monkeypatch, lambda: ImageResponse(success=True, skipped_stages=["composite"]))
+    assert leader.skipped_stages == ["composite"]
+    assert follower.skipped_stages == [] and follower.composite_image_base64
+    assert len(led_by) == 2
+
+
+def test_follower_reruns_after_the_leader_ran_out_of_time(monkeypatch):
+    def refuse():
+        raise DeadlineExceeded("Not enough time left", 1)
+
+    (leader, follower), led_by = coalesced_responses(monkeypatch, refuse)
+    assert isinstance(leader, DeadlineExceeded)
+    assert follower.success
+    assert len(led_by) == 2
+
+
+class OwnerPeer:
+    """PeerPool stand-in whose owner replica answers with `data`"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def owner(self, key):
+        return "http://owner"
+
+    async def fetch(self, peer, body, headers=None):
+        return self.data
+
+
+@pytest.mark.parametrize("skipped_stages, cached", [([], True), (["composite"], False)])
+def test_only_full_owner_results_are_cached_locally(monkeypatch, skipped_stages, cached):
+    cache = ResultCache(memory_max_bytes=10 ** 6)
+    monkeypatch.setattr(image_generator, "render_cache", cache)
+    monkeypatch.setattr(image_generator, "peer_pool", OwnerPeer(
+        {"success": True, "image_base64": "aW1hZ2U=", "skipped_stages": skipped_stages}))
+    request = ImageRequest(prompt="p")
+
+    response = asyncio.run(image_generator.render_shared(
+        request, request, "prompt", "key", "reject", Caller(), False))
+
+    assert response.skipped_stages == skipped_stages
+    assert ("key" in cache) == cached
+
+
+class UpstreamError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize("error, rejected", [
+    (UpstreamError("Bad request", 400), True),
+    (UpstreamError("Your request was rejected by the safety system"), True),
+    (RuntimeError("Error code: 400 - {'code': 'content_policy_violation'}"), True),
+    (UpstreamError("Incorrect API key provided (invalid_request_error)", 401), False),
+    (UpstreamError("The model does not exist (invalid_request_error)", 404), False),
+    (RuntimeError("Error code: 429 - rate limit"), False),
+    (TimeoutError("timed out"), False),
+])
+def test_is_upstream_rejection(error, rejected):
+    assert image_generator.is_upstream_rejection(error) == rejected
+
+
+class RecordingIndex:
+    """Similar-prompt index stand-in recording the thread each call runs on"""
+    threshold = 0.8
+
+    def __init__(self):
+        self.threads = {}
+
+    def query(self, group, text, exclude=None):
+        self.threads["query"] = threading.current_thread()
+        return "evicted", "old prompt", 0.9
+
+    def discard(self, key):
+        self.threads["discard"] = threading.current_thread()
+
+
+def test_similar_index_work_runs_off_the_event_loop(monkeypatch):
+    index = RecordingIndex()
+    monkeypatch.setattr(image_generator, "similar_index", index)
+    monkeypatch.setattr(image_generator, "render_cache", ResultCache(memory_max_bytes=10 ** 6))
+    monkeypatch.setattr(image_generator, "rate_limiter", None)
+
+    response = asyncio.run(image_generator.find_similar(ImageRequest(prompt="p"), http_request=None))
+
+    assert response.success and response.similar_design is None
+    assert set(index.threads) == {"query", "discard"}
+    assert threading.main_thread() not in index.threads.values()
+
+
+def test_render_cache_key_includes_the_output_format():
+    def key(**fields):
+        request = ImageRequest(prompt="p", **fields)
+        return image_generator.render_cache_key(request, image_generator.canonical_request(request))
+
+    assert key() == key()
+    assert len({key(), key(output_format="webp"), key(output_format="png"),
+                key(output_format="webp", output_quality=50)}) == 4
+
+
+@pytest.fixture
+def binary_client(monkeypatch):
+    """A /generate/binary client with fresh assets; `requests` collects what reaches generation"""
+    requests = []
+    outcome = [ImageResponse(
+        success=True, render_id="render-1", revised_prompt="قميص أحمر, 100%",
+        image_base64=base64.b64encode(png_bytes((4, 4), "white")).decode("ascii"),
+        composite_image_base64=base64.b64encode(b"jpeg bytes").decode("ascii"), composite_media_type="image/jpeg")]
+
+    async def generate_design(request, caller):
+        requests.append(request)
+        if isinstance(outcome[0], Exception):
+            raise outcome[0]
+        return outcome[0]
+
+    monkeypatch.setattr(image_generator, "generate_design", generate_design)
+    monkeypatch.setattr(image_generator, "rate_limiter", None)
+    monkeypatch.setattr(image_generator, "CANCEL_ON_DISCONNECT", False)
+    monkeypatch.setattr(image_generator, "asset_store", ResultCache(memory_max_bytes=10 ** 6))
+    monkeypatch.setattr(image_generator, "asset_aliases", TTLCache(60, 100))
+    client = TestClient(image_generator.app)
+    client.requests, client.outcome = requests, outcome
+    return client
+
+
+def multipart_parts(response) -> dict:
+    message = email.message_from_bytes(
+        f"Content-Type: {response.headers['content-type']}\r\n\r\n".encode("ascii") + response.content)
+    assert message.is_multipart()
+    return {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+
+
+def test_binary_uploads_become_normalized_assets(binary_client):
+    jpeg = io.BytesIO()
+    Image.new("RGB", (16, 16), "red").save(jpeg, format="JPEG")
+
+    response = binary_client.post("/generate/binary", data={"prompt": "p", "logo_position": "left"},
+                                  files={"logo": ("logo.jpg", jpeg.getvalue(), "image/jpeg"),
+                                         "user_photo": ("empty.png", b"", "image/png")})
+
+    assert response.status_code == 200
+    request, = binary_client.requests
+    assert request.logo_position == "left"
+    assert request.logo_base64 is None and request.user_photo_asset_id is None  # an empty part is no upload
+    logo = Image.open(io.BytesIO(image_generator.asset_store.get(request.logo_asset_id)))
+    assert (logo.format, logo.mode, logo.size) == ("PNG", "RGBA", (16, 16))
+
+
+def test_binary_result_is_multipart_with_metadata_and_images(binary_client):
+    response = binary_client.post("/generate/binary", data={"prompt": "p"})
+
+    assert response.headers["content-type"].startswith("multipart/form-data; boundary=")
+    parts = multipart_parts(response)
+    assert list(parts) == ["metadata", "design", "composite"]
+    metadata = json.loads(parts["metadata"].get_payload(decode=True))
+    assert metadata["render_id"] == "render-1"
+    assert "image_base64" not in metadata and "composite_image_base64" not in metadata
+    assert parts["design"].get_content_type() == "image/png"
+    assert parts["design"].get_filename() == "design.png"
+    assert parts["design"].get_payload(decode=True) == png_bytes((4, 4), "white")
+    assert parts["composite"].get_filename() == "composite.jpeg"
+    assert parts["composite"].get_payload(decode=True) == b"jpeg bytes"
+
+
+def test_binary_single_part_carries_metadata_in_headers(binary_client):
+    response = binary_client.post("/generate/binary?part=composite", data={"prompt": "p"})
+
+    assert response.status_code == 200
+    assert response.content == b"jpeg bytes"
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["x-render-id"] == "render-1"
+    # Header values are latin-1, so the Arabic prompt is percent-encoded
+    assert response.headers["x-revised-prompt"].isascii()
+    assert unquote(response.headers["x-revised-prompt"]) == "قميص أحمر, 100%"
+
+
+def test_binary_missing_or_unknown_part(binary_client):
+    binary_client.outcome[0] = ImageResponse(success=True, image_base64="aW1hZ2U=")
+    missing = binary_client.post("/generate/binary?part=composite", data={"prompt": "p"})
+    assert missing.status_code == 404 and not missing.json()["success"]
+    assert binary_client.post("/generate/binary?part=logo", data={"prompt": "p"}).status_code == 422
+
+
+def test_binary_failures_stay_json(binary_client):
+    binary_client.outcome[0] = ImageResponse(success=False, error="upstream failed")
+    failed = binary_client.post("/generate/binary", data={"prompt": "p"})
+    assert failed.status_code == 200
+    assert failed.json()["error"] == "upstream failed"
+
+    broken = binary_client.post("/generate/binary", data={"prompt": "p"},
+                                files={"logo": ("logo.png", b"not an image", "image/png")})
+    assert not broken.json()["success"]
+    assert len(binary_client.requests) == 1  # never reached generation
+
+
+def test_binary_overloaded_is_a_429_with_retry_after(binary_client):
+    binary_client.outcome[0] = Overloaded("Image generation queue is full", 429, 7)
+    response = binary_client.post("/generate/binary", data={"prompt": "p"})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "7"
+    assert response.json() == ImageResponse(success=False, error="Image generation queue is full").model_dump()
+
+
+def test_unix_socket_callers_are_trusted_by_default():
+    assert {"127.0.0.1", "::1", "unix"} <= image_generator.TRUSTED_PROXIES
+
+
+@pytest.fixture
+def asset_client(monkeypatch):
+    """A client with a fresh, memory-only asset store of 200 bytes"""
+    monkeypatch.setattr(image_generator, "rate_limiter", None)
+    monkeypatch.setattr(image_generator, "asset_store", ResultCache(memory_max_bytes=200))
+    monkeypatch.setattr(image_generator, "asset_aliases", TTLCache(60, 100))
+    monkeypatch.setattr(image_generator.upstream, "api_key", "key")
+    return TestClient(image_generator.app)
+
+
+def upload(client, color, kind="logo"):
+    image_base64 = base64.b64encode(png_bytes((8, 8), color)).decode("ascii")
+    return client.post("/assets", json={"image_base64": image_base64, "kind": kind}).json()
+
+
+def test_uploaded_asset_is_normalized_and_found_by_id(asset_client, monkeypatch):
+    rendered = []
+
+    async def render_coalesced(request, *args):
+        rendered.append(request.logo_asset_id)
+        return ImageResponse(success=True, image_base64="aW1hZ2U=")
+
+    monkeypatch.setattr(image_generator, "render_coalesced", render_coalesced)
+    asset = upload(asset_client, "red")
+    assert asset["success"] and (asset["width"], asset["height"]) == (8, 8)
+    assert upload(asset_client, "red")["asset_id"] == asset["asset_id"]  # same upload, same ID
+    stored = Image.open(io.BytesIO(image_generator.asset_store.get(asset["asset_id"])))
+    assert stored.mode == "RGBA"  # logos keep an alpha channel
+
+    response = asyncio.run(image_generator.generate_design(ImageRequest(prompt="p", logo_asset_id=asset["asset_id"])))
+    assert response.success and rendered == [asset["asset_id"]]
+
+
+def test_unknown_asset_kind_and_payload_are_refused(asset_client):
+    assert "Unknown asset kind" in asset_client.post(
+        "/assets", json={"image_base64": "aW1hZ2U=", "kind": "banner"}).json()["error"]
+    assert not asset_client.post("/assets", json={"image_base64": "bm90IGFuIGltYWdl"}).json()["success"]
+
+
+def test_unknown_and_evicted_assets_fail_the_request(asset_client):
+    first = upload(asset_client, "red")["asset_id"]
+    upload(asset_client, "blue")
+    upload(asset_client, "green", "user_photo")
+    assert first not in image_generator.asset_store  # least recently used, over 200 bytes
+
+    for request in (ImageRequest(prompt="p", logo_asset_id="missing"),
+                    ImageRequest(prompt="p", user_photo_asset_id=first)):
+        response = asyncio.run(image_generator.generate_design(request))
+        assert not response.success and response.error.startswith("Unknown asset: ")
+
+
+def test_asset_evicted_before_the_peer_hop_is_an_unknown_asset(asset_client, monkeypatch):
+    monkeypatch.setattr(image_generator, "peer_pool", OwnerPeer({"success": True}))
+    request = ImageRequest(prompt="p", logo_asset_id="evicted")
+    with pytest.raises(ValueError, match="Unknown asset: evicted"):
+        asyncio.run(image_generator.render_shared(request, request, "prompt", "key", "reject", Caller(), False))
+
+
+def test_logo_cache_key_is_the_asset_id_or_the_payload_digest():
+    inline = ImageRequest(prompt="p", logo_base64="data:image/png;base64,aW1hZ2U=")
+    assert image_generator.logo_digest(inline) == image_generator.logo_digest(ImageRequest(prompt="q", logo_base64="aW1hZ2U="))
+    # An asset ID wins over an inline payload, and never collides with a digest
+    both = ImageRequest(prompt="p", logo_base64="aW1hZ2U=", logo_asset_id="abc")
+    assert image_generator.logo_digest(both) == "asset:abc"
+    assert image_generator.logo_digest(ImageRequest(prompt="p")) == ""
+
+
+def test_similar_lookups_are_rate_limited(monkeypatch):
+    buckets = LocalBucketStore(burst=1, rate=0.01, clock=lambda: 0.0)
+    monkeypatch.setattr(image_generator, "rate_limiter", RateLimiter(buckets))
+    monkeypatch.setattr(image_generator, "RATE_LIMIT_CPU_COST", 0.5)
+    client = TestClient(image_generator.app)
+
+    statuses = [client.post("/similar", json={"prompt": "p"}).status_code for _ in range(3)]
+
+    assert statuses == [200, 200, 429]
+    refused = client.post("/similar", json={"prompt": "p"})
+    assert refused.json()["success"] is False and "retry-after" in refused.headers
@@ -0,0 +1,94 @@
+import asyncio
+import sqlite3
+import time
+
+from job_queue import DurableJob, DurableJobQueue
+from jobs import BLENDING, DONE, FAILED, GENERATING, QUEUED
+
+
+def test_stage_writes_do_not_block_the_loop(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.enqueue({"prompt": "p"})
+    claimed_id, _ = queue.claim("worker")
+    assert claimed_id == job_id
+
+    async def scenario():
+        job = DurableJob(queue, job_id, "worker")
+        # Another thread (a claim waiting on a busy database) holds the lock
+        queue._lock.acquire()
+        started = time.perf_counter()
+        job.set_stage(GENERATING)
+        job.set_stage(BLENDING)
+        await asyncio.sleep(0.05)
+        blocked = time.perf_counter() - started
+        queue._lock.release()
+        await job.flush()
+        return blocked
+
+    blocked = asyncio.run(scenario())
+    assert blocked < 1
+    stages = queue.get(job_id)["stages"]
+    assert [s["stage"] for s in stages] == [QUEUED, GENERATING, BLENDING]
+    assert stages[1]["at_ms"] <= stages[2]["at_ms"]
+
+
+def test_complete_after_lost_lease_is_refused(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "jobs.db"), lease_seconds=0)
+    job_id = queue.enqueue({"prompt": "p"})
+    queue.claim("first")
+    assert queue.claim("second")[0] == job_id  # the first lease ran out
+    assert not queue.complete(job_id, "first", None, "late")
+    assert queue.complete(job_id, "second", '{"success": true}')
+    assert queue.get(job_id)["result"] == {"success": True}
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "jobs.db"), lease_seconds=0, max_attempts=3)
+    job_id = queue.enqueue({"prompt": "p"})
+    queue.claim("crashed")
+    assert queue.claim("second") == (job_id, {"prompt": "p"})
+    assert queue.get(job_id)["attempts"] == 2
+    assert queue.recovered == 1
+
+
+def test_job_is_abandoned_after_max_attempts(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "jobs.db"), lease_seconds=0, max_attempts=2)
+    job_id = queue.enqueue({"prompt": "p"})
+    queue.claim("first")
+    queue.claim("second")
+    assert queue.claim("third") is None
+    job = queue.get(job_id)
+    assert job["stage"] == FAILED
+    assert job["error"] == "Abandoned after 2 attempts"
+    assert queue.stats()["failed"] == 1
+
+
+def test_worker_survives_database_errors(tmp_path):
+    queue = DurableJobQueue(str(tmp_path / "jobs.db"))
+    job_id = queue.enqueue({"prompt": "p"})
+    failures = []
+    complete = queue.complete
+
+    def flaky_complete(*args):
+        if not failures:
+            failures.append(1)
+            raise sqlite3.OperationalError("database is locked")
+        return complete(*args)
+
+    queue.complete = flaky_complete
+    queue.lease_seconds = 0  # so the job whose outcome was lost is claimed again
+
+    async def handler(payload):
+        return '{"success": true}', ""
+
+    async def scenario():
+        worker = asyncio.ensure_future(queue.work(handler, "worker", poll_interval=0.01))
+        for _ in range(200):
+            if queue.get(job_id)["stage"] == DONE:
+                break
+            await asyncio.sleep(0.01)
+        worker.cancel()
+
+    asyncio.run(scenario())
+    assert failures
+    assert queue.get(job_id)["stage"] == DONE
@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+from jobs import BLENDING, DONE, FAILED, GENERATING, QUEUED, JobStore, report_stage
+
+
+class Result:
+    def __init__(self, success=True, error=""):
+        self.success = success
+        self.error = error
+
+
+def make_store(**kwargs):
+    return JobStore(**{"ttl": 60, "max_bytes": 1000, "max_jobs": 10, "sizeof": lambda result: 0,
+                       "succeeded": lambda result: result.success, **kwargs})
+
+
+async def read_events(stream) -> list:
+    events = []
+    async for chunk in stream:
+        assert chunk.startswith("event: stage\ndata: ") and chunk.endswith("\n\n")
+        events.append(json.loads(chunk[len("event: stage\ndata: "):]))
+    return events
+
+
+def test_events_stream_stage_transitions_until_done():
+    async def scenario():
+        store = make_store()
+        release = asyncio.Event()
+
+        async def generate():
+            await release.wait()
+            report_stage(GENERATING)
+            await asyncio.sleep(0)
+            report_stage(BLENDING)
+            return Result()
+
+        job = store.submit(generate)
+        reader = asyncio.ensure_future(read_events(store.events(job)))
+        await asyncio.sleep(0)
+        release.set()
+        return job, await asyncio.wait_for(reader, 5)
+
+    job, events = asyncio.run(scenario())
+    assert [event["stage"] for event in events] == [QUEUED, GENERATING, BLENDING, DONE]
+    assert all(event["job_id"] == job.id for event in events)
+    assert [stage for stage, _ in job.stages] == [QUEUED, GENERATING, BLENDING, DONE]
+
+
+def test_events_for_a_finished_job_end_at_once():
+    async def scenario():
+        store = make_store()
+
+        async def generate():
+            return Result(success=False, error="content policy")
+
+        job = store.submit(generate)
+        await job.task
+        return job, await read_events(store.events(job))
+
+    job, events = asyncio.run(scenario())
+    assert events == [{"job_id": job.id, "stage": FAILED, "error": "content policy"}]
+
+
+def test_events_send_keepalives_while_waiting():
+    async def scenario():
+        store = make_store()
+        release = asyncio.Event()
+
+        async def generate():
+            await release.wait()
+            return Result()
+
+        job = store.submit(generate)
+        stream = store.events(job, keepalive=0.01)
+        chunks = [await stream.__anext__(), await stream.__anext__()]
+        release.set()
+        async for chunk in stream:
+            chunks.append(chunk)
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    assert chunks[1] == ": keepalive\n\n"
+    assert json.loads(chunks[-1].split("data: ", 1)[1])["stage"] == DONE
+
+
+def test_full_store_refuses_new_jobs():
+    async def scenario():
+        store = make_store(max_jobs=1)
+        release = asyncio.Event()
+
+        async def generate():
+            await release.wait()
+            return Result()
+
+        first = store.submit(generate)
+        assert store.submit(generate) is None
+        release.set()
+        await first.task
+        assert store.submit(generate) is not None  # finished jobs make room
+        return store.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["refused"] == 1
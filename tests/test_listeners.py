@@ -0,0 +1,98 @@
+import os
+import socket
+import stat
+
+import pytest
+
+from listeners import UNIX_PEER, Listeners, bind_unix, peer_host, remove_stale_socket
+from rate_limit import client_identity
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix domain sockets")
+
+
+def leftover_socket(path):
+    """A socket file whose server is gone, as after a crash"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(path))
+    sock.close()
+
+
+def test_stale_socket_is_replaced(tmp_path):
+    path = tmp_path / "gen.sock"
+    leftover_socket(path)
+    sock = bind_unix(str(path))
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(str(path))
+        client.close()
+    finally:
+        sock.close()
+
+
+def test_live_socket_is_left_alone(tmp_path):
+    path = tmp_path / "gen.sock"
+    live = bind_unix(str(path))
+    try:
+        with pytest.raises(RuntimeError, match="already listening"):
+            remove_stale_socket(str(path))
+        assert stat.S_ISSOCK(os.lstat(path).st_mode)
+    finally:
+        live.close()
+
+
+def test_other_files_are_never_removed(tmp_path):
+    path = tmp_path / "gen.sock"
+    path.write_text("data")
+    with pytest.raises(RuntimeError, match="not a socket"):
+        bind_unix(str(path))
+    assert path.read_text() == "data"
+
+
+def test_socket_gets_its_mode_and_the_umask_is_restored(tmp_path):
+    path = tmp_path / "run" / "gen.sock"
+    previous = os.umask(0o022)
+    try:
+        sock = bind_unix(str(path), mode=0o600)
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(previous)
+    sock.close()
+    assert stat.S_IMODE(os.lstat(path).st_mode) == 0o600
+
+
+def test_close_removes_the_socket_file(tmp_path):
+    path = tmp_path / "gen.sock"
+    listeners = Listeners(None, 0, str(path))
+    assert listeners.describe() == f"unix:{path}"
+    listeners.close()
+    assert not path.exists()
+
+
+def test_close_keeps_a_socket_another_instance_replaced(tmp_path):
+    path = tmp_path / "gen.sock"
+    listeners = Listeners(None, 0, str(path))
+    os.unlink(path)
+    replacement = bind_unix(str(path))
+    try:
+        listeners.close()
+        assert stat.S_ISSOCK(os.lstat(path).st_mode)
+    finally:
+        replacement.close()
+
+
+def test_nothing_to_listen_on():
+    with pytest.raises(ValueError):
+        Listeners(None, 0)
+
+
+def test_peer_host():
+    assert peer_host({"client": ("10.0.0.5", 51000), "server": ("10.0.0.1", 8001)}) == "10.0.0.5"
+    # uvicorn on a Unix socket: no client address, server is (path, None)
+    assert peer_host({"client": None, "server": ("/run/gen.sock", None)}) == UNIX_PEER
+    assert peer_host({}) is None
+
+
+def test_unix_socket_callers_are_trusted_like_a_local_proxy():
+    scope = {"client": None, "server": ("/run/gen.sock", None)}
+    assert client_identity(peer_host(scope), "alice", None, {"127.0.0.1", UNIX_PEER}) == "user:alice"
+    assert client_identity(peer_host(scope), "alice", None, {"127.0.0.1"}) == "ip:unix"
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from admission import Overloaded
+from peer_cache import HashRing, PeerPool
+
+# peer_cache imports httpx lazily; without it skip this module, not the suite
+httpx = pytest.importorskip("httpx")
+
+INSTANCES = [f"http://127.0.0.1:{port}" for port in (8000, 8001, 8002)]
+KEYS = [f"render-{i}" for i in range(300)]
+
+
+def make_pool(handler) -> PeerPool:
+    pool = PeerPool("http://127.0.0.1:8000", ["http://127.0.0.1:8001"], secret="s3")
+    pool._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return pool
+
+
+def fetch(pool: PeerPool):
+    return asyncio.run(pool.fetch("http://127.0.0.1:8001", {"prompt": "p"}))
+
+
+def test_success_returns_body_and_sends_secret():
+    seen = {}
+
+    def handler(request):
+        seen["secret"] = request.headers.get("X-Peer-Secret")
+        return httpx.Response(200, json={"success": True})
+
+    pool = make_pool(handler)
+    assert fetch(pool) == {"success": True}
+    assert seen["secret"] == "s3"
+    assert pool.peer_hits == 1
+
+
+@pytest.mark.parametrize("status", [429, 503, 504])
+def test_owner_refusal_passes_through_without_cooldown(status):
+    pool = make_pool(lambda request: httpx.Response(
+        status, json={"success": False, "error": "busy"}, headers={"Retry-After": "7"}))
+    with pytest.raises(Overloaded) as raised:
+        fetch(pool)
+    assert raised.value.status_code == status
+    assert raised.value.retry_after == 7
+    assert pool.stats()["down"] == []
+
+
+def test_other_error_falls_back_without_cooldown():
+    pool = make_pool(lambda request: httpx.Response(500, text="boom"))
+    assert fetch(pool) is None
+    assert pool.peer_failures == 1
+    assert pool.stats()["down"] == []
+
+
+def test_unreachable_peer_is_cooled_down():
+    def handler(request):
+        raise httpx.ConnectError("refused")
+
+    pool = make_pool(handler)
+    assert fetch(pool) is None
+    assert pool.stats()["down"] == ["http://127.0.0.1:8001"]
+
+
+def test_peer_callers_need_the_secret():
+    pool = PeerPool("http://127.0.0.1:8000", ["http://127.0.0.1:8001"], secret="s3")
+    assert pool.allows("10.0.0.9", "s3")
+    assert not pool.allows("127.0.0.1", "wrong")
+    assert not pool.allows("127.0.0.1", None)
+
+
+def test_peer_callers_without_secret_must_be_peer_hosts():
+    pool = PeerPool("http://127.0.0.1:8000", ["http://127.0.0.1:8001"])
+    assert pool.allows("127.0.0.1", None)
+    assert not pool.allows("10.0.0.9", None)
+
+
+def test_preference_list_covers_every_node_once():
+    ring = HashRing(INSTANCES, vnodes=50)
+    for key in KEYS[:20]:
+        preference = ring.preference_list(key)
+        assert sorted(preference) == INSTANCES
+
+
+def test_preference_list_ignores_peer_order():
+    assert all(HashRing(INSTANCES).preference_list(key) == HashRing(INSTANCES[::-1]).preference_list(key)
+               for key in KEYS)
+
+
+def test_removing_a_node_only_moves_its_keys():
+    full = HashRing(INSTANCES)
+    reduced = HashRing(INSTANCES[:2])
+    for key in KEYS:
+        owner = full.preference_list(key)[0]
+        if owner in INSTANCES[:2]:
+            assert reduced.preference_list(key)[0] == owner
+
+
+def instance_pools():
+    # Every instance lists all of them (itself included) as PEERS
+    return {url: PeerPool(url, INSTANCES) for url in INSTANCES}
+
+
+def test_instances_agree_on_the_owner_of_each_key():
+    pools = instance_pools()
+    owners = set()
+    for key in KEYS:
+        # owner() is None on the owner itself
+        seen = {pool.owner(key) or url for url, pool in pools.items()}
+        assert len(seen) == 1
+        owners |= seen
+    assert owners == set(INSTANCES)
+
+
+def test_key_falls_through_to_the_next_replica_when_its_owner_is_down():
+    def handler(request):
+        raise httpx.ConnectError("refused")
+
+    pools = instance_pools()
+    pool = pools[INSTANCES[0]]
+    pool._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    down = INSTANCES[1]
+    keys = [key for key in KEYS if pool.ring.preference_list(key)[0] == down]
+    assert keys
+    assert asyncio.run(pool.fetch(down, {"prompt": "p"})) is None
+    for key in keys:
+        following = pool.ring.preference_list(key)[1]
+        assert pool.owner(key) == (None if following == pool.self_url else following)
+    # Keys owned by healthy replicas do not move
+    for key in KEYS:
+        owner = pool.ring.preference_list(key)[0]
+        if owner != down:
+            assert pool.owner(key) == (None if owner == pool.self_url else owner)
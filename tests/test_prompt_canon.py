@@ -0,0 +1,43 @@
+import pytest
+
+from prompt_canon import canonicalize_text, replay_hit_rates
+
+
+@pytest.mark.parametrize("variant, plain", [
+    ("قَمِيصٌ أَحْمَرُ", "قميص احمر"),  # tashkeel
+    ("قمـــيص", "قميص"),  # tatweel
+    ("أحمر إسلامي آمن ٱلنور", "احمر اسلامي امن النور"),  # alef variants
+    ("مؤسسة شاطئ", "موسسه شاطي"),  # hamza carriers, teh marbuta
+    ("على", "علي"),  # alef maqsura
+    ("مقاس ٤٢ و۴۲", "مقاس 42 و42"),  # Eastern Arabic and Persian digits
+    ("Red T-Shirt", "red t-shirt"),  # case
+    ("Straße", "strasse"),  # casefold, not just lower
+])
+def test_variants_fold_to_one_form(variant, plain):
+    assert canonicalize_text(variant) == plain
+
+
+def test_whitespace_and_punctuation_are_normalized():
+    assert canonicalize_text("  قميص \n أحمر ، مع  شعار ؟ ") == "قميص احمر, مع شعار?"
+    assert canonicalize_text("ｒｅｄ　shirt") == "red shirt"  # NFKC fullwidth
+
+
+def test_empty_text():
+    assert canonicalize_text("") == ""
+    assert canonicalize_text(None) == ""
+
+
+def test_different_words_stay_different():
+    assert canonicalize_text("قميص أحمر") != canonicalize_text("قميص أزرق")
+
+
+def test_replay_counts_canonical_hits():
+    stats = replay_hit_rates([
+        {"prompt": "قَمِيصٌ أحمر"},
+        {"prompt": "قميص احمر"},
+        {"prompt": "Red shirt"},
+        {"prompt": "red shirt"},
+    ])
+    assert stats["exact_hits"] == 0
+    assert stats["canonical_hits"] == 2
+    assert stats["distinct_canonical_keys"] == 2
@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+from rate_limit import LocalBucketStore, RateLimited, RateLimiter, client_identity
+
+TRUSTED = {"127.0.0.1", "unix"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SharedStore:
+    """Stand-in for RedisBucketStore: a local store behind the async interface"""
+
+    def __init__(self, store: LocalBucketStore):
+        self.store = store
+        self.down = False
+
+    async def take(self, key: str, cost: float = 1.0) -> float:
+        if self.down:
+            raise ConnectionError("store unreachable")
+        return self.store.take_now(key, cost)
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+
+def make_store(burst=3, rate=1.0, **kwargs):
+    clock = FakeClock()
+    return LocalBucketStore(burst, rate, clock=clock, **kwargs), clock
+
+
+def test_burst_then_refused_with_wait():
+    store, _ = make_store(burst=3, rate=0.5)
+    assert [store.take_now("a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert store.take_now("a") == pytest.approx(2.0)
+    # Other callers have their own bucket
+    assert store.take_now("b") == 0.0
+
+
+def test_refill_is_capped_at_burst():
+    store, clock = make_store(burst=2, rate=1.0)
+    store.take_now("a", 2)
+    clock.now = 1.0
+    assert store.take_now("a") == 0.0
+    assert store.take_now("a") == pytest.approx(1.0)
+    clock.now = 100.0
+    assert store.take_now("a", 2) == 0.0
+    assert store.take_now("a") > 0
+
+
+def test_fractional_cost():
+    store, _ = make_store(burst=1, rate=1.0)
+    assert [store.take_now("a", 0.25) for _ in range(4)] == [0.0] * 4
+    assert store.take_now("a", 0.25) == pytest.approx(0.25)
+
+
+def test_idle_buckets_are_evicted_once_full_again():
+    store, clock = make_store(burst=2, rate=1.0)
+    store.take_now("idle")
+    clock.now = 1.0
+    store.take_now("busy")
+    assert len(store) == 2
+    clock.now = 2.5  # "idle" would be full again, "busy" not yet
+    store.take_now("busy")
+    assert len(store) == 1
+    assert store.evictions == 1
+
+
+def test_max_keys_evicts_least_recently_used():
+    store, _ = make_store(max_keys=2)
+    for key in ("a", "b", "c"):
+        store.take_now(key)
+    assert len(store) == 2
+    store.take_now("a")  # evicted, so a fresh full bucket
+    assert store.stats()["evictions"] == 2
+
+
+def test_zero_rate_is_refused():
+    with pytest.raises(ValueError):
+        LocalBucketStore(burst=1, rate=0)
+
+
+def test_limiter_raises_with_retry_after():
+    async def scenario():
+        store, _ = make_store(burst=1, rate=0.25)
+        limiter = RateLimiter(SharedStore(store), fallback=None)
+        await limiter.check("a")
+        with pytest.raises(RateLimited) as raised:
+            await limiter.check("a")
+        assert raised.value.status_code == 429
+        assert raised.value.retry_after == 4
+        assert limiter.stats()["limited"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_limiter_falls_back_to_local_buckets_when_shared_store_fails():
+    async def scenario():
+        shared_buckets, _ = make_store(burst=1)
+        local, _ = make_store(burst=1)
+        shared = SharedStore(shared_buckets)
+        limiter = RateLimiter(shared, fallback=local)
+        await limiter.check("a")
+        shared.down = True
+        await limiter.check("a")  # charged to the local bucket instead
+        with pytest.raises(RateLimited):
+            await limiter.check("a")
+        assert limiter.store_errors == 2
+        assert len(local) == 1
+
+    asyncio.run(scenario())
+
+
+def test_limiter_without_fallback_surfaces_store_errors():
+    async def scenario():
+        store, _ = make_store()
+        shared = SharedStore(store)
+        shared.down = True
+        with pytest.raises(ConnectionError):
+            await RateLimiter(shared).check("a")
+
+    asyncio.run(scenario())
+
+
+def test_forwarded_user_from_trusted_proxy():
+    assert client_identity("127.0.0.1", "alice", None, TRUSTED) == "user:alice"
+    assert client_identity("unix", "alice", "key", TRUSTED) == "user:alice"
+
+
+def test_forwarded_user_ignored_from_anyone_else():
+    assert client_identity("10.0.0.5", "alice", None, TRUSTED) == "ip:10.0.0.5"
+
+
+def test_api_key_is_hashed():
+    identity = client_identity("10.0.0.5", "alice", "secret", TRUSTED)
+    assert identity.startswith("key:")
+    assert "secret" not in identity
+    assert identity == client_identity("10.0.0.6", None, "secret", TRUSTED)
+
+
+def test_unknown_address():
+    assert client_identity(None, None, None, TRUSTED) == "ip:unknown"
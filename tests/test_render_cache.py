@@ -0,0 +1,204 @@
+import asyncio
+import os
+
+from render_cache import ByteLRU, DiskTier, LogoCache, RejectionCache, ResultCache, TTLCache, digest_payload
+
+
+def test_byte_lru_evicts_oldest_by_size():
+    lru = ByteLRU(10)
+    lru.put("a", b"1234")
+    lru.put("b", b"1234")
+    assert lru.get("a") == b"1234"  # now "b" is the oldest
+    assert lru.put("c", b"1234") == 1
+    assert "b" not in lru
+    assert "a" in lru and "c" in lru
+    assert lru.current_bytes == 8
+    assert lru.evictions == 1
+
+
+def test_byte_lru_skips_values_over_budget():
+    lru = ByteLRU(4)
+    lru.put("a", b"12")
+    assert lru.put("big", b"12345") == 0
+    assert "big" not in lru
+    assert lru.get("a") == b"12"
+
+
+def test_byte_lru_replacing_a_key_recharges_its_size():
+    lru = ByteLRU(10)
+    lru.put("a", b"123456")
+    lru.put("a", b"12")
+    assert lru.current_bytes == 2
+    assert len(lru) == 1
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    disk = DiskTier(str(tmp_path), 100)
+    disk.put("a", b"render-a")
+    disk.put("b", b"render-b")
+    reopened = DiskTier(str(tmp_path), 100)
+    assert len(reopened) == 2
+    assert reopened.current_bytes == 16
+    assert reopened.get("a") == b"render-a"
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_disk_tier_evicts_by_bytes(tmp_path):
+    disk = DiskTier(str(tmp_path), 10)
+    disk.put("a", b"12345")
+    disk.put("b", b"12345")
+    assert disk.get("a") == b"12345"  # now "b" is the oldest
+    assert disk.put("c", b"12345") == 1
+    assert "b" not in disk
+    assert not os.path.exists(tmp_path / "b.bin")
+    assert disk.current_bytes == 10
+
+
+def test_disk_tier_shrinks_to_a_smaller_budget_on_load(tmp_path):
+    disk = DiskTier(str(tmp_path), 100)
+    for key in ("a", "b", "c"):
+        disk.put(key, b"12345")
+    reopened = DiskTier(str(tmp_path), 10)
+    assert len(reopened) == 2
+    assert reopened.evictions == 1
+
+
+def test_result_cache_counts_hits_and_promotes_disk_hits(tmp_path):
+    cache = ResultCache(memory_max_bytes=5, disk_dir=str(tmp_path), disk_max_bytes=100)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")  # pushes "a" out of memory, both stay on disk
+    assert cache.get("a") == b"12345"
+    assert cache.get("a") == b"12345"
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert stats["disk_hits"] == 1
+    assert stats["memory_hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == round(2 / 3, 4)
+    assert stats["stores"] == 2
+    assert stats["memory_evictions"] == 2
+    assert stats["disk_entries"] == 2
+
+
+def test_result_cache_reloads_from_disk_after_restart(tmp_path):
+    ResultCache(memory_max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=100).put("a", b"render")
+    cache = ResultCache(memory_max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=100)
+    assert "a" in cache
+    assert cache.get("a") == b"render"
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_async_access_matches_sync(tmp_path):
+    async def scenario():
+        cache = ResultCache(memory_max_bytes=5, disk_dir=str(tmp_path), disk_max_bytes=100)
+        await cache.put_async("a", b"12345")
+        await cache.put_async("b", b"12345")
+        assert await cache.get_async("b") == b"12345"
+        assert await cache.get_async("a") == b"12345"
+        assert await cache.get_async("missing") is None
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+    assert stats["disk_entries"] == 2
+
+
+def test_memory_only_cache_counts_misses():
+    async def scenario():
+        cache = ResultCache(memory_max_bytes=100)
+        assert await cache.get_async("a") is None
+        await cache.put_async("a", b"render")
+        assert await cache.get_async("a") == b"render"
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert "disk_entries" not in stats
+
+
+def test_rejection_cache_remembers_the_reason():
+    cache = RejectionCache(ttl=60)
+    assert cache.check("prompt") is None
+    cache.reject("prompt", "content policy")
+    assert cache.check("prompt") == "content policy"
+    assert cache.check("other") is None
+    stats = cache.stats()
+    assert (stats["entries"], stats["rejections_recorded"], stats["upstream_calls_avoided"]) == (1, 1, 1)
+
+
+def test_rejections_expire_after_the_ttl():
+    cache = RejectionCache(ttl=0)
+    cache.reject("prompt", "content policy")
+    assert cache.check("prompt") is None
+    assert cache.stats()["upstream_calls_avoided"] == 0
+
+
+def test_rejection_cache_is_bounded():
+    cache = RejectionCache(ttl=60, max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.reject(key, "refused")
+    assert cache.check("a") is None
+    assert cache.check("c") == "refused"
+
+
+def test_ttl_cache_evicts_oldest_over_the_byte_budget():
+    cache = TTLCache(ttl=60, max_bytes=10, sizeof=len)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.put("c", b"123")
+    assert cache.get("a") is None
+    assert cache.get("b") == b"12345"
+    assert cache.current_bytes == 8
+    cache.put("big", b"12345678901")  # larger than the whole budget
+    assert cache.get("big") is None
+    assert cache.pop("b") == b"12345"
+    assert cache.current_bytes == 3
+
+
+class FakeImage:
+    """Just enough of a PIL image for image_nbytes"""
+
+    def __init__(self, width, height):
+        self.size = (width, height)
+
+    def getbands(self):
+        return ("R", "G", "B", "A")
+
+
+def test_logo_cache_decodes_and_resizes_once_per_key():
+    cache = LogoCache(10 ** 6)
+    decodes, resizes = [], []
+    logo = FakeImage(100, 100)
+
+    def decode():
+        decodes.append(1)
+        return logo
+
+    def resize():
+        resizes.append(1)
+        return FakeImage(64, 64)
+
+    assert cache.get_decoded("digest", decode) is logo
+    assert cache.get_decoded("digest", decode) is logo
+    small = cache.get_resized("digest", (64, 64), resize)
+    assert cache.get_resized("digest", (64, 64), resize) is small
+    cache.get_resized("digest", (32, 32), resize)  # another box is another entry
+    assert (len(decodes), len(resizes)) == (1, 2)
+    stats = cache.stats()
+    assert (stats["decode_hits"], stats["decode_misses"], stats["resize_hits"], stats["resize_misses"]) == (1, 1, 1, 2)
+    assert stats["bytes"] == 100 * 100 * 4 + 64 * 64 * 4 * 2
+
+
+def test_logo_cache_evicts_by_decoded_bytes():
+    cache = LogoCache(2 * 100 * 100 * 4)
+    for digest in ("a", "b", "c"):
+        cache.get_decoded(digest, lambda: FakeImage(100, 100))
+    assert cache.stats()["evictions"] == 1
+    cache.get_decoded("a", lambda: FakeImage(100, 100))  # evicted, so decoded again
+    assert cache.stats()["decode_misses"] == 4
+
+
+def test_payload_digest_ignores_data_url_prefix_and_whitespace():
+    assert digest_payload("data:image/png;base64,aW1h\nZ2U=") == digest_payload("aW1hZ2U=")
+    assert digest_payload("aW1hZ2U=") != digest_payload("aW1hZ2V=")
+    assert digest_payload(None) == digest_payload("") == ""
@@ -0,0 +1,194 @@
+import asyncio
+
+import pytest
+
+from admission import OK, THROTTLED, AdmissionController, AIMDController, Caller
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, ResilientUpstream, RetryBudget
+
+
+class ScriptedUpstream:
+    """Plays back a script of (delay seconds, result or exception) per call"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def generate(self, prompt):
+        delay, result = self.script[min(self.calls, len(self.script) - 1)]
+        self.calls += 1
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.running -= 1
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def no_sleep(seconds):
+    pass
+
+
+class RecordingController(AIMDController):
+    def __init__(self, initial):
+        super().__init__(initial, spike_factor=float("inf"))
+        self.outcomes = []
+
+    def record(self, latency, outcome, saturated=True):
+        self.outcomes.append(outcome)
+        return super().record(latency, outcome, saturated)
+
+
+def upstream(client, **kwargs):
+    kwargs.setdefault("sleep", no_sleep)
+    return ResilientUpstream(client, **kwargs)
+
+
+def test_retries_until_success():
+    client = ScriptedUpstream((0, RuntimeError("boom")), (0, RuntimeError("boom")), (0, ["image"]))
+    resilient = upstream(client, max_attempts=3)
+    assert asyncio.run(resilient.generate("p")) == ["image"]
+    assert client.calls == 3
+    assert resilient.retries == 2
+
+
+def test_request_errors_are_not_retried():
+    client = ScriptedUpstream((0, ValueError("content policy")))
+    resilient = upstream(client, is_failure=lambda e: not isinstance(e, ValueError))
+    with pytest.raises(ValueError):
+        asyncio.run(resilient.generate("p"))
+    assert client.calls == 1
+    assert resilient.breaker.failures == 0
+
+
+def test_retry_budget_limits_retries():
+    client = ScriptedUpstream((0, RuntimeError("boom")))
+    clock = FakeClock()
+    budget = RetryBudget(ratio=0.0, min_per_second=0.0, cap=1.0, clock=clock)
+    resilient = upstream(client, max_attempts=5, budget=budget, clock=clock,
+                         breaker=CircuitBreaker(failure_threshold=100, clock=clock))
+    with pytest.raises(RuntimeError):
+        asyncio.run(resilient.generate("p"))
+    assert client.calls == 2  # the first attempt and the one retry the budget held
+    assert resilient.retries_denied == 1
+
+
+def test_attempt_timeout_is_retried():
+    client = ScriptedUpstream((1.0, ["slow"]), (0, ["fast"]))
+    resilient = upstream(client, attempt_timeout=0.02)
+    assert asyncio.run(resilient.generate("p")) == ["fast"]
+    assert resilient.attempt_timeouts == 1
+
+
+def test_breaker_opens_fails_fast_and_recovers():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    client = ScriptedUpstream((0, RuntimeError("boom")), (0, RuntimeError("boom")), (0, ["image"]))
+    resilient = upstream(client, max_attempts=1, breaker=breaker, clock=clock)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            asyncio.run(resilient.generate("p"))
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen) as raised:
+        asyncio.run(resilient.generate("p"))
+    assert raised.value.status_code == 503
+    assert client.calls == 2
+    clock.now = 10
+    assert asyncio.run(resilient.generate("p")) == ["image"]
+    assert breaker.state == CLOSED
+
+
+def test_cancelled_probe_frees_half_open_slot():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    client = ScriptedUpstream((0, RuntimeError("boom")), (1.0, ["image"]))
+    resilient = upstream(client, max_attempts=1, breaker=breaker, clock=clock)
+    with pytest.raises(RuntimeError):
+        asyncio.run(resilient.generate("p"))
+    clock.now = 10
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(resilient.generate("p"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_probe())
+    assert breaker.state == HALF_OPEN
+    assert breaker._probes == 0
+
+
+def hedging_upstream(client, **kwargs):
+    resilient = upstream(client, hedge=True, hedge_min_samples=1, hedge_percentile=0.5, **kwargs)
+    resilient._latencies.append(0.01)
+    return resilient
+
+
+def test_hedge_wins_over_slow_attempt():
+    client = ScriptedUpstream((1.0, ["slow"]), (0, ["hedge"]))
+    resilient = hedging_upstream(client)
+    assert asyncio.run(resilient.generate("p")) == ["hedge"]
+    assert resilient.hedges == 1
+    assert resilient.hedge_wins == 1
+
+
+def test_hedge_takes_its_own_slot():
+    async def scenario():
+        admission = AdmissionController(2, max_queue=10, max_wait=5)
+        client = ScriptedUpstream((1.0, ["slow"]), (0, ["hedge"]))
+        resilient = hedging_upstream(client)
+        images = await resilient.generate("p", slot=lambda: admission.slot(Caller()), hedge_slot=admission.try_slot)
+        return admission, client, resilient, images
+
+    admission, client, resilient, images = asyncio.run(scenario())
+    assert images == ["hedge"]
+    assert resilient.hedges == 1
+    assert client.max_running == 2
+    assert admission.in_flight == 0
+
+
+def test_hedge_skipped_without_free_slot():
+    async def scenario():
+        admission = AdmissionController(1, max_queue=10, max_wait=5)
+        client = ScriptedUpstream((0.05, ["first"]))
+        resilient = hedging_upstream(client)
+        balance = resilient.budget.balance
+        images = await resilient.generate("p", slot=lambda: admission.slot(Caller()), hedge_slot=admission.try_slot)
+        return admission, client, resilient, images, balance
+
+    admission, client, resilient, images, balance = asyncio.run(scenario())
+    assert images == ["first"]
+    assert resilient.hedges == 0
+    assert resilient.hedges_skipped == 1
+    assert client.max_running == 1
+    assert admission.in_flight == 0
+    assert resilient.budget.balance >= balance  # the unused hedge was refunded
+
+
+def test_every_attempt_outcome_reaches_the_controller():
+    async def scenario():
+        controller = RecordingController(4)
+        admission = AdmissionController(4, max_queue=10, max_wait=5, controller=controller)
+        client = ScriptedUpstream((0, RuntimeError("Error code: 429 - rate limit")), (0, ["image"]))
+        resilient = upstream(client)
+        images = await resilient.generate("p", slot=lambda: admission.slot(Caller()), hedge_slot=admission.try_slot)
+        return controller, admission, images
+
+    controller, admission, images = asyncio.run(scenario())
+    assert images == ["image"]
+    assert controller.outcomes == [THROTTLED, OK]
+    assert controller.decreases == 1
+    assert admission.limit == 2
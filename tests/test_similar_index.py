@@ -0,0 +1,43 @@
+from similar_index import SimilarPromptIndex
+
+
+def test_query_finds_rewording_above_threshold():
+    index = SimilarPromptIndex()
+    index.add("surf", "group", "vintage surf club graphic with palm trees")
+    key, text, score = index.query("group", "vintage surf club graphic with palm trees and waves")
+    assert key == "surf"
+    assert score >= index.threshold
+
+
+def test_query_ignores_other_groups_and_distant_prompts():
+    index = SimilarPromptIndex()
+    index.add("surf", "group", "vintage surf club graphic with palm trees")
+    assert index.query("other", "vintage surf club graphic with palm trees") is None
+    assert index.query("group", "cute cartoon cat eating ramen") is None
+
+
+def test_default_threshold_rejects_changed_placement():
+    index = SimilarPromptIndex()
+    index.add("back", "group", "wolf logo on the back of the shirt")
+    assert index.query("group", "wolf logo on the front of the shirt") is None
+
+
+def test_score_requires_same_group():
+    index = SimilarPromptIndex()
+    index.add("surf", "group", "vintage surf club graphic with palm trees")
+    text, score = index.score("surf", "group", "vintage surf club graphic with palm trees")
+    assert text == "vintage surf club graphic with palm trees"
+    assert score == 1.0
+    assert index.score("surf", "other", "vintage surf club graphic with palm trees") is None
+    assert index.score("missing", "group", "anything") is None
+
+
+def test_log_replay_and_tombstones(tmp_path):
+    path = str(tmp_path / "index.jsonl")
+    index = SimilarPromptIndex(path=path)
+    index.add("a", "group", "vintage surf club graphic with palm trees")
+    index.add("b", "group", "minimalist mountain sunset print")
+    index.discard("a")
+    replayed = SimilarPromptIndex(path=path)
+    assert len(replayed) == 1
+    assert replayed.score("b", "group", "minimalist mountain sunset print") is not None
@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from disconnect import ClientDisconnected, DisconnectGuard
+from singleflight import SingleFlight
+
+
+class Work:
+    """Counts calls and finishes when released"""
+
+    def __init__(self, result="image"):
+        self.result = result
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        work = Work()
+        callers = [asyncio.ensure_future(flight.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        work.release.set()
+        assert await asyncio.gather(*callers) == ["image"] * 3
+        assert work.calls == 1
+        assert flight.stats()["coalesced"] == 2
+        assert len(flight) == 0
+
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_caller_and_free_the_key():
+    async def scenario():
+        flight = SingleFlight()
+        work = Work(RuntimeError("upstream failed"))
+        callers = [asyncio.ensure_future(flight.do("key", work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        work.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        retry = Work()
+        retry.release.set()
+        assert await flight.do("key", retry) == "image"
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("cancel_abandoned", [False, True])
+def test_cancelled_waiter_does_not_kill_the_shared_work(cancel_abandoned):
+    async def scenario():
+        flight = SingleFlight(cancel_abandoned=cancel_abandoned)
+        work = Work()
+        leaving = asyncio.ensure_future(flight.do("key", work))
+        staying = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        await asyncio.sleep(0)
+        work.release.set()
+        assert await staying == "image"
+        assert leaving.cancelled()
+        assert work.calls == 1
+        assert flight.abandoned == 0
+
+    asyncio.run(scenario())
+
+
+def test_work_nobody_waits_for_runs_on_by_default():
+    async def scenario():
+        flight = SingleFlight()
+        work = Work()
+        caller = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.sleep(0)
+        # A later caller joins the work still running
+        late = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        work.release.set()
+        assert await late == "image"
+        assert work.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_abandoned_work_is_cancelled_when_asked():
+    async def scenario():
+        flight = SingleFlight(cancel_abandoned=True)
+        work = Work()
+        caller = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.sleep(0)
+        assert flight.abandoned == 1
+        assert len(flight) == 0
+        # The next caller starts afresh
+        work.release.set()
+        assert await flight.do("key", work) == "image"
+        assert work.calls == 2
+
+    asyncio.run(scenario())
+
+
+class Client:
+    """ASGI request whose client disconnects once `leave` is set"""
+
+    def __init__(self):
+        self.leave = asyncio.Event()
+
+    async def receive(self):
+        await self.leave.wait()
+        return {"type": "http.disconnect"}
+
+
+def test_disconnect_cancels_the_wait_but_a_follower_keeps_the_work():
+    async def scenario():
+        flight = SingleFlight(cancel_abandoned=True)
+        guard = DisconnectGuard()
+        work = Work()
+        client = Client()
+        leaving = asyncio.ensure_future(guard.run(client, flight.do("key", work)))
+        staying = asyncio.ensure_future(guard.run(Client(), flight.do("key", work)))
+        await asyncio.sleep(0)
+        client.leave.set()
+        with pytest.raises(ClientDisconnected):
+            await leaving
+        assert not staying.done()
+        work.release.set()
+        assert await staying == "image"
+        assert work.calls == 1
+        assert flight.abandoned == 0
+        assert guard.stats()["disconnects"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_of_the_last_waiter_cancels_the_work():
+    async def scenario():
+        flight = SingleFlight(cancel_abandoned=True)
+        guard = DisconnectGuard()
+        work = Work()
+        client = Client()
+        leaving = asyncio.ensure_future(guard.run(client, flight.do("key", work)))
+        await asyncio.sleep(0)
+        client.leave.set()
+        with pytest.raises(ClientDisconnected):
+            await leaving
+        assert flight.abandoned == 1
+        assert len(flight) == 0
+
+    asyncio.run(scenario())